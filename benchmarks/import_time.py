@@ -0,0 +1,70 @@
+"""Measure the cold import time of the package modules.
+
+Each module is imported in a fresh interpreter with `-X importtime`, so the
+numbers include every dependency the module pulls in.
+
+Usage:
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --max-ms 500 src src.utils src.mail
+"""
+
+import argparse
+import subprocess
+import sys
+from typing import Optional
+
+DEFAULT_MODULES = ["src", "src.db", "src.models", "src.utils", "src.mail"]
+HEAVY_MODULES = ["streamlit", "streamlit_cookies_controller", "pymongo", "pydantic", "requests"]
+
+
+def measure_import(module: str) -> tuple[float, list[str]]:
+    """
+    Import a module in a fresh interpreter.
+
+    Returns:
+        tuple: The cumulative import time in milliseconds and the heavy
+        modules that were loaded by the import.
+    """
+    code = (
+        f"import sys, {module}; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    cumulative_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.strip() == module:
+            cumulative_us = int(cumulative)
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return cumulative_us / 1000, loaded
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=None,
+        help="Exit with an error when a module takes longer to import.",
+    )
+    args = parser.parse_args(argv)
+
+    exit_code = 0
+    for module in args.modules:
+        elapsed_ms, loaded = measure_import(module)
+        print(f"{module:<20} {elapsed_ms:>9.1f} ms  loads: {', '.join(loaded) or '-'}")
+        if args.max_ms is not None and elapsed_ms > args.max_ms:
+            exit_code = 1
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
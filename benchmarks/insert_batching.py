@@ -0,0 +1,190 @@
+"""Throughput of magic link inserts with and without the insert coalescer.
+
+Runs `--threads` script threads that each insert `--inserts` magic links,
+once with one `insert_one` per link and once through an `InsertCoalescer`,
+and reports inserts per second and the latency percentiles of each mode.
+
+The default backend is an in-process mongomock stand-in. Every operation
+costs `--latency` milliseconds of network round trip, which concurrent
+operations overlap, and `--commit-cost` milliseconds of acknowledged write
+(journal flush, majority replication), which the server serializes. Pass
+`--mongo-uri` to run against a real server instead.
+
+Usage:
+    python -m benchmarks.insert_batching --threads 64 --inserts 50 --latency 2 --commit-cost 0.5
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+from typing import Any, Optional
+
+from benchmarks.load_test import _percentile
+from src.coalescer import InsertCoalescer
+from src.db import CollectionRegistry
+from src.utils import insert_magic_link
+
+
+class _RoundTripCollection:
+    """Mongomock collection with a simulated round trip and commit per operation."""
+
+    def __init__(self, collection: Any, lock: threading.Lock, latency: float, commit_cost: float):
+        self._collection = collection
+        self._lock = lock
+        self._latency = latency
+        self._commit_cost = commit_cost
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args: Any, **kwargs: Any) -> Any:
+            time.sleep(self._latency)
+            with self._lock:
+                time.sleep(self._commit_cost)
+                return attribute(*args, **kwargs)
+
+        return call
+
+
+class _RoundTripRegistry(CollectionRegistry):
+    """Collection registry that hands out mongomock collections with a round trip and commit."""
+
+    def __init__(self, client: Any, latency: float, commit_cost: float):
+        super().__init__(client)
+        self._operation_lock = threading.Lock()
+        self._latency = latency
+        self._commit_cost = commit_cost
+
+    def get(self, key: str) -> Any:
+        return _RoundTripCollection(
+            super().get(key), self._operation_lock, self._latency, self._commit_cost
+        )
+
+
+def run_inserts(
+    collections: CollectionRegistry,
+    threads: int,
+    inserts: int,
+    coalescer: Optional[InsertCoalescer] = None,
+) -> dict[str, Any]:
+    """
+    Insert `inserts` magic links from each of `threads` threads at once.
+
+    Returns:
+        dict: Inserts per second and latency percentiles in milliseconds.
+    """
+    latencies: list[float] = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads + 1)
+
+    def run(number: int) -> None:
+        barrier.wait()
+        for _ in range(inserts):
+            started = time.perf_counter()
+            insert_magic_link(collections, f"user-{number}", coalescer=coalescer)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+
+    workers = [threading.Thread(target=run, args=(number,)) for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "inserts": len(latencies),
+        "elapsed_s": elapsed,
+        "inserts_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "batches": coalescer.batches if coalescer is not None else len(latencies),
+    }
+
+
+def compare(
+    threads: int = 32,
+    inserts: int = 50,
+    latency: float = 0.002,
+    commit_cost: float = 0.0005,
+    max_batch_size: int = 100,
+    max_wait: float = 0.005,
+    mongo_client: Optional[Any] = None,
+) -> dict[str, dict[str, Any]]:
+    """
+    Run the inserts once per call and once coalesced, each against a fresh collection.
+    """
+
+    def registry() -> CollectionRegistry:
+        if mongo_client is not None:
+            return CollectionRegistry(
+                mongo_client, database_name=f"insert-batching-{time.time_ns()}"
+            )
+        import mongomock
+
+        return _RoundTripRegistry(mongomock.MongoClient(), latency, commit_cost)
+
+    per_call = registry()
+    coalesced = registry()
+    coalescer = InsertCoalescer(coalesced, max_batch_size=max_batch_size, max_wait=max_wait)
+    try:
+        return {
+            "per_call": run_inserts(per_call, threads, inserts),
+            "coalesced": run_inserts(coalesced, threads, inserts, coalescer),
+        }
+    finally:
+        coalescer.close()
+        if mongo_client is not None:
+            for collections in (per_call, coalesced):
+                mongo_client.drop_database(collections.database_name)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--inserts", type=int, default=50, help="Inserts per thread.")
+    parser.add_argument("--latency", type=float, default=2.0, help="Simulated round trip in ms.")
+    parser.add_argument(
+        "--commit-cost", type=float, default=0.5, help="Simulated serialized write cost in ms."
+    )
+    parser.add_argument("--max-batch-size", type=int, default=100)
+    parser.add_argument("--max-wait", type=float, default=5.0, help="Coalescer wait in ms.")
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    mongo_client: Optional[Any] = None
+    if args.mongo_uri:
+        from pymongo.mongo_client import MongoClient
+
+        mongo_client = MongoClient(args.mongo_uri)
+
+    report = compare(
+        threads=args.threads,
+        inserts=args.inserts,
+        latency=args.latency / 1000,
+        commit_cost=args.commit_cost / 1000,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait / 1000,
+        mongo_client=mongo_client,
+    )
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'mode':<10} {'inserts':>8} {'inserts/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'batches':>8}")
+    for mode, stats in report.items():
+        print(
+            f"{mode:<10} {stats['inserts']:>8} {stats['inserts_per_s']:>10.1f} "
+            f"{stats['p50_ms']:>8.2f} {stats['p99_ms']:>8.2f} {stats['batches']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
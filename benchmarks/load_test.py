@@ -0,0 +1,393 @@
+"""Concurrent multi-session load generator for StreamlitMagicLink.
+
+Simulates N concurrent Streamlit sessions, each with its own cookie jar and
+query parameters, against one StreamlitMagicLink setup. Every session runs a
+random mix of flows:
+
+- rerun: a script rerun of a signed in user (construct + sign_in without token)
+- sign_in: request a magic link and open it in a new rerun
+- update: update the profile of the signed in user
+- sign_out: sign out the signed in user
+
+With `--contention`, a fraction of the magic links is opened from two
+sessions at the same time (double clicks, link scanners). A link that signs
+in more than one session is reported as a double redemption.
+
+The default backend is an in-process mongomock stand-in with a lock around
+every operation; pass `--mongo-uri` to run against a real server. Emails go
+to an in-memory transport.
+
+Usage:
+    python -m benchmarks.load_test --sessions 32 --iterations 200
+"""
+
+import argparse
+import json
+import logging
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from typing import Any, Callable, Optional
+from unittest import mock
+
+from src.db import CollectionRegistry
+from src.magiclink import StreamlitMagicLink
+from src.transports import MailTransport
+
+DEFAULT_MIX = {"rerun": 0.7, "sign_in": 0.1, "update": 0.15, "sign_out": 0.05}
+
+
+class FakeCookieController:
+    """Cookie controller backed by a dict, one per simulated browser."""
+
+    def __init__(self) -> None:
+        self.cookies: dict[str, Any] = {}
+
+    def get(self, name: str) -> Any:
+        return self.cookies.get(name)
+
+    def set(self, name: str, value: Any) -> None:
+        self.cookies[name] = value
+
+    def remove(self, name: str) -> None:
+        self.cookies.pop(name, None)
+
+
+class _QueryParams:
+    """Query parameters of the session running on the current thread."""
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+
+    @property
+    def _params(self) -> dict[str, str]:
+        if not hasattr(self._local, "params"):
+            self._local.params = {}
+        return self._local.params
+
+    def get(self, name: str) -> Optional[str]:
+        return self._params.get(name)
+
+    def clear(self) -> None:
+        self._params.clear()
+
+    def set(self, name: str, value: str) -> None:
+        self._params[name] = value
+
+
+class _Rerun(Exception):
+    """Raised by the fake `st.rerun`, like Streamlit stops the script."""
+
+
+class FakeStreamlit:
+    """The parts of the `streamlit` module used by StreamlitMagicLink."""
+
+    def __init__(self) -> None:
+        self.query_params = _QueryParams()
+        self._local = threading.local()
+
+    @property
+    def toasts(self) -> list[str]:
+        """The toasts shown to the session running on the current thread."""
+        if not hasattr(self._local, "toasts"):
+            self._local.toasts = []
+        return self._local.toasts
+
+    @property
+    def session_state(self) -> dict[str, Any]:
+        """The session state of the session running on the current thread."""
+        if not hasattr(self._local, "session_state"):
+            self._local.session_state = {}
+        return self._local.session_state
+
+    def toast(self, body: str, *args: Any, **kwargs: Any) -> None:
+        self.toasts.append(body)
+
+    def rerun(self) -> None:
+        raise _Rerun()
+
+
+class LatestLinkTransport(MailTransport):
+    """Mail transport that keeps the latest magic link per recipient."""
+
+    def __init__(self) -> None:
+        self.tokens: dict[str, str] = {}
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def send(self, to_email: str, body: str, subject: str) -> None:
+        with self._lock:
+            self.tokens[to_email] = body.rsplit("token=", 1)[1]
+            self.sent += 1
+
+
+class _LockedCollection:
+    """Serialize the operations on a mongomock collection, which is not thread-safe."""
+
+    def __init__(self, collection: Any, lock: threading.Lock):
+        self._collection = collection
+        self._lock = lock
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args: Any, **kwargs: Any) -> Any:
+            with self._lock:
+                result = attribute(*args, **kwargs)
+                return list(result) if name in ("find", "aggregate") else result
+
+        return call
+
+
+class _LockedRegistry(CollectionRegistry):
+    """Collection registry that hands out locked mongomock collections."""
+
+    def __init__(self, client: Any):
+        super().__init__(client)
+        self._operation_lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        return _LockedCollection(super().get(key), self._operation_lock)
+
+
+class LoadReport:
+    """Latencies, errors and double redemptions of a load test run."""
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.redemptions: dict[str, int] = defaultdict(int)
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, flow: str, seconds: float) -> None:
+        with self._lock:
+            self.latencies[flow].append(seconds)
+
+    def record_error(self, flow: str) -> None:
+        with self._lock:
+            self.errors[flow] += 1
+
+    def record_redemption(self, token: str) -> None:
+        with self._lock:
+            self.redemptions[token] += 1
+
+    @property
+    def double_redemptions(self) -> int:
+        return sum(1 for count in self.redemptions.values() if count > 1)
+
+    def summary(self) -> dict[str, Any]:
+        """The report as a dict: throughput, and count and percentiles per flow."""
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        flows = {}
+        for flow, latencies in sorted(self.latencies.items()):
+            flows[flow] = {
+                "count": len(latencies),
+                "errors": self.errors.get(flow, 0),
+                "p50_ms": _percentile(latencies, 50) * 1000,
+                "p95_ms": _percentile(latencies, 95) * 1000,
+                "p99_ms": _percentile(latencies, 99) * 1000,
+            }
+        return {
+            "elapsed_s": self.elapsed,
+            "flows_per_s": total / self.elapsed if self.elapsed else 0.0,
+            "flows": flows,
+            "double_redemptions": self.double_redemptions,
+        }
+
+
+def _percentile(values: list[float], percentile: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[percentile - 1]
+
+
+class _Session:
+    """One simulated browser session."""
+
+    def __init__(self, number: int, harness: "_Harness"):
+        self.email = f"user-{number}@load.test"
+        self.cookies = FakeCookieController()
+        self.harness = harness
+
+    def rerun(self, token: Optional[str] = None) -> StreamlitMagicLink:
+        """Run the auth part of a script rerun, opening `token` if given."""
+        self.harness.streamlit.query_params.clear()
+        if token:
+            self.harness.streamlit.query_params.set("token", token)
+        self.harness.streamlit.toasts.clear()
+        magic_link = self.harness.create(self.cookies)
+        magic_link.sign_in()
+        if token and "You are now signed in." in self.harness.streamlit.toasts:
+            self.harness.report.record_redemption(token)
+        return magic_link
+
+    def sign_in(self) -> None:
+        self.rerun().authenticate(self.email)
+        token = self.harness.transport.tokens.get(self.email)
+        if token is None:
+            return
+        if self.harness.rng.random() < self.harness.contention:
+            other = _Session(-1, self.harness)
+            other.email = self.email
+            barrier = threading.Barrier(2)
+            thread = threading.Thread(target=self._open_together, args=(other, token, barrier))
+            thread.start()
+            self._open_together(self, token, barrier)
+            thread.join()
+        else:
+            self.rerun(token)
+
+    @staticmethod
+    def _open_together(session: "_Session", token: str, barrier: threading.Barrier) -> None:
+        barrier.wait()
+        session.rerun(token)
+
+    def update(self) -> None:
+        magic_link = self.rerun()
+        if magic_link.user:
+            magic_link.update_user(name=f"Name {self.harness.rng.randint(0, 1_000_000)}")
+
+    def sign_out(self) -> None:
+        magic_link = self.rerun()
+        if magic_link.user:
+            try:
+                magic_link.sign_out()
+            except _Rerun:
+                pass
+
+
+class _Harness:
+    def __init__(
+        self,
+        create: Callable[[FakeCookieController], StreamlitMagicLink],
+        transport: LatestLinkTransport,
+        contention: float,
+        seed: int,
+    ):
+        self.create = create
+        self.transport = transport
+        self.contention = contention
+        self.streamlit = FakeStreamlit()
+        self.report = LoadReport()
+        self.rng = random.Random(seed)
+
+
+def run_load_test(
+    sessions: int = 16,
+    iterations: int = 100,
+    mix: Optional[dict[str, float]] = None,
+    contention: float = 0.0,
+    mongo_client: Optional[Any] = None,
+    skip_sign_out_sleep: bool = True,
+    seed: int = 0,
+) -> LoadReport:
+    """
+    Run `iterations` flows in each of `sessions` concurrent sessions.
+
+    Args:
+        sessions (int): Number of concurrent sessions.
+        iterations (int): Number of flows per session.
+        mix (dict): Relative weight of each flow, see `DEFAULT_MIX`.
+        contention (float): Fraction of magic links opened by two sessions at once.
+        mongo_client: Client of a real server. Defaults to a mongomock stand-in.
+        skip_sign_out_sleep (bool): Skip the one second sleep of `_remove_user`,
+            which would otherwise dominate the sign out latency.
+        seed (int): Seed of the flow selection.
+    """
+    mix = mix or DEFAULT_MIX
+    if mongo_client is None:
+        import mongomock
+
+        collections: CollectionRegistry = _LockedRegistry(mongomock.MongoClient())
+    else:
+        collections = CollectionRegistry(mongo_client)
+    transport = LatestLinkTransport()
+
+    def create(cookies: FakeCookieController) -> StreamlitMagicLink:
+        return StreamlitMagicLink(
+            collections.client,
+            "http://localhost:8501/",
+            cookie_controller=cookies,  # type: ignore[arg-type]
+            collections=collections,
+            mail_transport=transport,
+        )
+
+    harness = _Harness(create, transport, contention, seed)
+    flows = list(mix)
+    weights = [mix[flow] for flow in flows]
+
+    def run_session(number: int) -> None:
+        session = _Session(number, harness)
+        session.sign_in()
+        for _ in range(iterations):
+            flow = harness.rng.choices(flows, weights)[0]
+            if flow != "sign_in" and not session.cookies.get("user"):
+                flow = "sign_in"
+            started = time.perf_counter()
+            try:
+                getattr(session, flow)()
+            except Exception:
+                harness.report.record_error(flow)
+            harness.report.record(flow, time.perf_counter() - started)
+
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch("src.magiclink.st", harness.streamlit))
+        if skip_sign_out_sleep:
+            stack.enter_context(mock.patch("src.magiclink.time.sleep"))
+        threads = [threading.Thread(target=run_session, args=(number,)) for number in range(sessions)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        harness.report.elapsed = time.perf_counter() - started
+    return harness.report
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--contention", type=float, default=0.0)
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--keep-sign-out-sleep", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    mongo_client: Optional[Any] = None
+    if args.mongo_uri:
+        from pymongo.mongo_client import MongoClient
+
+        mongo_client = MongoClient(args.mongo_uri)
+
+    report = run_load_test(
+        sessions=args.sessions,
+        iterations=args.iterations,
+        contention=args.contention,
+        mongo_client=mongo_client,
+        skip_sign_out_sleep=not args.keep_sign_out_sleep,
+        seed=args.seed,
+    ).summary()
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{args.sessions} sessions, {report['elapsed_s']:.2f}s, {report['flows_per_s']:.1f} flows/s")
+    print(f"{'flow':<10} {'count':>7} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for flow, stats in report["flows"].items():
+        print(
+            f"{flow:<10} {stats['count']:>7} {stats['errors']:>7} "
+            f"{stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}"
+        )
+    print(f"double redemptions: {report['double_redemptions']}")
+
+
+if __name__ == "__main__":
+    main()
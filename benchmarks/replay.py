@@ -0,0 +1,347 @@
+"""Replay a recorded auth trace against a storage backend and mail transport.
+
+Re-runs the operations of a trace written by `src.recorder.TraceRecorder`,
+each recorded session in its own thread with its own cookie jar, at the
+recorded pace divided by `--speedup`. Hashed emails become
+`<hash>@replay.test`, the magic links of the trace are mapped to the links
+issued by the replay, and links that were invalid in the trace are replayed
+with unknown or malformed tokens. Profile updates are replayed as name
+updates.
+
+The replay is recorded itself, and its latency per operation (including
+the `src.utils` helpers) and throughput are compared with the recorded
+trace, or with a previous replay saved with `--save`:
+
+    python -m benchmarks.replay auth-trace.jsonl --speedup 10 --save mongomock.json
+    python -m benchmarks.replay auth-trace.jsonl --speedup 10 --mongo-uri mongodb://localhost \\
+        --baseline mongomock.json
+
+The default backend is an in-process mongomock stand-in; pass `--mongo-uri`
+to run against a real server. Emails go to a `FakeTransport` with
+`--mail-latency` milliseconds of latency.
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import ExitStack
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+from unittest import mock
+
+from benchmarks.load_test import (
+    FakeCookieController,
+    FakeStreamlit,
+    _LockedRegistry,
+    _percentile,
+    _Rerun,
+)
+from src.db import CollectionRegistry
+from src.magiclink import StreamlitMagicLink
+from src.recorder import TraceEntry, TraceRecorder, load_trace
+from src.transports import FakeTransport, MailTransport
+
+SESSION_OPERATIONS = (
+    "rerun",
+    "authenticate",
+    "sign_in",
+    "update_user",
+    "sign_out",
+    "sign_out_everywhere",
+    "delete_user",
+)
+
+
+class _TokenCapture(MailTransport):
+    """Mail transport passing emails on, keeping the latest magic link token per recipient."""
+
+    def __init__(self, transport: MailTransport):
+        self.transport = transport
+        self.tokens: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def send(self, to_email: str, body: str, subject: str) -> None:
+        self.transport.send(to_email=to_email, body=body, subject=subject)
+        with self._lock:
+            self.tokens[to_email] = body.rsplit("token=", 1)[1]
+
+
+class _Tokens:
+    """The tokens issued by the replay, by the hashed token of the trace."""
+
+    def __init__(self, issued: set[str]):
+        self._tokens: dict[str, str] = {}
+        self._events = {token: threading.Event() for token in issued}
+
+    def add(self, recorded: str, token: str) -> None:
+        self._tokens[recorded] = token
+        self._events[recorded].set()
+
+    def get(self, recorded: Optional[str], outcome: str, timeout: float) -> str:
+        """
+        The replayed token of a recorded token. A token issued in the trace is
+        waited for, as it may be issued by another session that is still running.
+        """
+        if recorded in self._events:
+            self._events[recorded].wait(timeout)
+        if recorded is not None and recorded in self._tokens:
+            return self._tokens[recorded]
+        return "malformed" if outcome == "malformed" else str(uuid.uuid4())
+
+
+class _ReplaySession:
+    """One recorded session, replayed in order."""
+
+    def __init__(self, replay: "_Replay"):
+        self.replay = replay
+        self.cookies = FakeCookieController()
+        self.magic_link: Optional[StreamlitMagicLink] = None
+
+    def run(self, entry: TraceEntry) -> None:
+        streamlit = self.replay.streamlit
+        streamlit.query_params.clear()
+        if entry.op == "sign_in":
+            token = self.replay.tokens.get(entry.token, entry.outcome, self.replay.token_timeout)
+            streamlit.query_params.set("token", token)
+        if entry.op == "rerun" or self.magic_link is None:
+            self.magic_link = self.replay.create(self.cookies)
+        magic_link = self.magic_link
+        try:
+            if entry.op == "authenticate":
+                email = f"{entry.email}@replay.test"
+                magic_link.authenticate(email)
+                issued = self.replay.transport.tokens.get(email)
+                if entry.token is not None and issued is not None:
+                    self.replay.tokens.add(entry.token, issued)
+            elif entry.op == "sign_in":
+                magic_link.sign_in()
+            elif entry.op == "update_user":
+                magic_link.update_user(name=f"Replay {entry.at:.3f}")
+            elif entry.op in ("sign_out", "sign_out_everywhere", "delete_user"):
+                getattr(magic_link, entry.op)()
+        except _Rerun:
+            self.magic_link = None
+
+
+class _Replay:
+    def __init__(
+        self,
+        create: Callable[[FakeCookieController], StreamlitMagicLink],
+        transport: _TokenCapture,
+        tokens: _Tokens,
+        token_timeout: float,
+    ):
+        self.create = create
+        self.transport = transport
+        self.tokens = tokens
+        self.token_timeout = token_timeout
+        self.streamlit = FakeStreamlit()
+
+
+def replay(
+    entries: list[TraceEntry],
+    speedup: float = 1.0,
+    collections: Optional[CollectionRegistry] = None,
+    mail_transport: Optional[MailTransport] = None,
+    skip_sign_out_sleep: bool = True,
+    token_timeout: float = 5.0,
+) -> list[TraceEntry]:
+    """
+    Replay the session operations of a trace.
+
+    Args:
+        entries (list): The entries of the trace.
+        speedup (float): How many times faster than recorded the operations are started.
+        collections: The storage backend. Defaults to a mongomock stand-in.
+        mail_transport: The mail transport. Defaults to a `FakeTransport` without latency.
+        skip_sign_out_sleep (bool): Skip the one second sleep of `_remove_user`.
+        token_timeout (float): Seconds a sign in waits for the replay of the request of its link.
+
+    Returns:
+        list: The entries recorded during the replay.
+    """
+    if collections is None:
+        import mongomock
+
+        collections = _LockedRegistry(mongomock.MongoClient())
+    transport = _TokenCapture(mail_transport or FakeTransport())
+    operations = sorted(
+        (entry for entry in entries if entry.depth == 0 and entry.op in SESSION_OPERATIONS),
+        key=lambda entry: entry.at,
+    )
+    issued = {entry.token for entry in operations if entry.op == "authenticate" and entry.token}
+    recorder = TraceRecorder()
+    registry = collections
+
+    def create(cookies: FakeCookieController) -> StreamlitMagicLink:
+        return StreamlitMagicLink(
+            registry.client,
+            "http://localhost:8501/",
+            cookie_controller=cookies,  # type: ignore[arg-type]
+            collections=registry,
+            mail_transport=transport,
+            recorder=recorder,
+        )
+
+    state = _Replay(create, transport, _Tokens(issued), token_timeout)
+    sessions: dict[str, list[TraceEntry]] = defaultdict(list)
+    for number, entry in enumerate(operations):
+        sessions[entry.session or f"anonymous-{number}"].append(entry)
+    first = operations[0].at if operations else 0.0
+
+    def run_session(session_entries: list[TraceEntry], started: float) -> None:
+        session = _ReplaySession(state)
+        for entry in session_entries:
+            delay = started + (entry.at - first) / speedup - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                session.run(entry)
+            except Exception as error:
+                logging.debug(f"Replaying {entry.op} failed: {error!r}")
+
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch("src.magiclink.st", state.streamlit))
+        if skip_sign_out_sleep:
+            # Only skip the sleep of StreamlitMagicLink, not the pacing or a simulated latency.
+            no_sleep = SimpleNamespace(sleep=lambda seconds: None)
+            stack.enter_context(mock.patch("src.magiclink.time", no_sleep))
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=run_session, args=(session_entries, started))
+            for session_entries in sessions.values()
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return recorder.entries
+
+
+def summarize(entries: list[TraceEntry]) -> dict[str, Any]:
+    """
+    The throughput of the session operations of a trace, and the count, errors
+    and latency percentiles of every operation and helper.
+    """
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    for entry in entries:
+        latencies[entry.op].append(entry.duration_ms / 1000)
+        if entry.outcome == "error":
+            errors[entry.op] += 1
+    top = [entry for entry in entries if entry.depth == 0]
+    elapsed = (
+        max(entry.at + entry.duration_ms / 1000 for entry in top) - min(entry.at for entry in top)
+        if top
+        else 0.0
+    )
+    return {
+        "operations": len(top),
+        "elapsed_s": elapsed,
+        "operations_per_s": len(top) / elapsed if elapsed else 0.0,
+        "ops": {
+            op: {
+                "count": len(values),
+                "errors": errors.get(op, 0),
+                "p50_ms": _percentile(values, 50) * 1000,
+                "p95_ms": _percentile(values, 95) * 1000,
+                "p99_ms": _percentile(values, 99) * 1000,
+            }
+            for op, values in sorted(latencies.items())
+        },
+    }
+
+
+def compare(baseline: dict[str, Any], candidate: dict[str, Any]) -> dict[str, Any]:
+    """
+    The differences between two summaries: the throughput ratio, and the p50
+    and p95 latency change in percent of every operation in both.
+    """
+
+    def change(before: float, after: float) -> Optional[float]:
+        return (after - before) / before * 100 if before else None
+
+    ops = {}
+    for op in sorted(set(baseline["ops"]) & set(candidate["ops"])):
+        before, after = baseline["ops"][op], candidate["ops"][op]
+        ops[op] = {
+            "p50_ms": (before["p50_ms"], after["p50_ms"]),
+            "p50_change_pct": change(before["p50_ms"], after["p50_ms"]),
+            "p95_ms": (before["p95_ms"], after["p95_ms"]),
+            "p95_change_pct": change(before["p95_ms"], after["p95_ms"]),
+        }
+    throughput = baseline["operations_per_s"]
+    return {
+        "operations_per_s": (throughput, candidate["operations_per_s"]),
+        "throughput_ratio": candidate["operations_per_s"] / throughput if throughput else None,
+        "ops": ops,
+    }
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace", help="The JSON lines trace to replay.")
+    parser.add_argument("--speedup", type=float, default=1.0)
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--mail-latency", type=float, default=0.0, help="Mail latency in ms.")
+    parser.add_argument("--baseline", default=None, help="Summary of a previous replay to compare with.")
+    parser.add_argument("--save", default=None, help="Write the summary of the replay to this file.")
+    parser.add_argument("--keep-sign-out-sleep", action="store_true")
+    parser.add_argument("--json", action="store_true", help="Print the comparison as JSON.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    entries = load_trace(args.trace)
+    collections: Optional[CollectionRegistry] = None
+    mongo_client: Optional[Any] = None
+    if args.mongo_uri:
+        from pymongo.mongo_client import MongoClient
+
+        mongo_client = MongoClient(args.mongo_uri)
+        collections = CollectionRegistry(mongo_client, database_name=f"replay-{time.time_ns()}")
+    try:
+        summary = summarize(
+            replay(
+                entries,
+                speedup=args.speedup,
+                collections=collections,
+                mail_transport=FakeTransport(latency=args.mail_latency / 1000),
+                skip_sign_out_sleep=not args.keep_sign_out_sleep,
+            )
+        )
+    finally:
+        if mongo_client is not None and collections is not None:
+            mongo_client.drop_database(collections.database_name)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        label = "baseline"
+    else:
+        baseline = summarize(entries)
+        label = "recorded"
+    comparison = compare(baseline, summary)
+    if args.json:
+        print(json.dumps(comparison, indent=2))
+        return
+    before, after = comparison["operations_per_s"]
+    print(f"{summary['operations']} operations, {label} {before:.1f}/s, replay {after:.1f}/s")
+    print(f"{'operation':<28} {'p50 ms':>17} {'change':>8} {'p95 ms':>17} {'change':>8}")
+    for op, stats in comparison["ops"].items():
+        p50_change = f"{stats['p50_change_pct']:+.0f}%" if stats["p50_change_pct"] is not None else "-"
+        p95_change = f"{stats['p95_change_pct']:+.0f}%" if stats["p95_change_pct"] is not None else "-"
+        print(
+            f"{op:<28} {stats['p50_ms'][0]:>8.2f} {stats['p50_ms'][1]:>8.2f} {p50_change:>8} "
+            f"{stats['p95_ms'][0]:>8.2f} {stats['p95_ms'][1]:>8.2f} {p95_change:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,8 @@ from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 
 from src import StreamlitMagicLink
+from src.service import MagicLinkService
+from src.widgets import login_widget, profile_widget, sign_out_widget
 
 
 @st.cache_resource
@@ -22,11 +24,21 @@ def get_mongo_client() -> MongoClient:
     return client
 
 
+@st.cache_resource
+def get_service() -> MagicLinkService:
+    """
+    Create the magic link service shared by all sessions
+    """
+    return MagicLinkService(get_mongo_client(), base_url="http://localhost:8501/")
+
+
 mongo_client = get_mongo_client()
 
 magic_link = StreamlitMagicLink(
     mongo_client=mongo_client,
     base_url="http://localhost:8501/",
+    service=get_service(),
+    debug=bool(os.environ.get("MAGIC_LINK_DEBUG")),
 )
 
 magic_link.sign_in()
@@ -34,48 +46,9 @@ magic_link.sign_in()
 st.title("Example Magic Link Streamlit App!")
 
 if not magic_link.user:
-    with st.container(border=True):
-        email = st.text_input("Email", "Enter your email")
-        if st.button("Login or Sign up"):
-            magic_link.authenticate(email)
+    login_widget(magic_link)
 else:
-    with st.container(border=True):
-        st.text(f"Hello, {magic_link.user['email']}!")
-        if st.button("Sign out"):
-            magic_link.sign_out()
-
-
-    with st.container(border=True):
-        email = st.text_input(
-            "Email",
-            magic_link.user.get("email") if magic_link.user.get("email") else "",
-        )
-        name = st.text_input(
-            "Name",
-            magic_link.user.get("name") if magic_link.user.get("name") else "",
-        )
-
-        is_payed_user = st.checkbox(
-            "Is payed user",
-            value=magic_link.user.get("is_payed_user")
-            if magic_link.user.get("is_payed_user")
-            else False,
-        )
-
-        additional_data = st.text_input(
-            "Additional data",
-            magic_link.user.get("additional_data")
-            if magic_link.user.get("additional_data")
-            else "",
-        )
-
-        if st.button("Update user"):
-            magic_link.update_user(
-                email=email,
-                name=name,
-                is_payed_user=is_payed_user,
-                additional_data=additional_data,
-            )
+    sign_out_widget(magic_link, everywhere=True)
+    profile_widget(magic_link)
 
-        if st.button("Delete user", type="primary"):
-            magic_link.delete_user()
+magic_link.debug_panel()
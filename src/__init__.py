@@ -1,3 +1,20 @@
-from src.magiclink import StreamlitMagicLink
+from typing import TYPE_CHECKING, Any
 
-__all__ = ["StreamlitMagicLink"]
\ No newline at end of file
+if TYPE_CHECKING:
+    from src.magiclink import StreamlitMagicLink
+
+__all__ = ["StreamlitMagicLink"]
+
+
+def __getattr__(name: str) -> Any:
+    """Import the public classes on first access.
+
+    `src.magiclink` imports Streamlit, which is slow to import. Loading it
+    lazily keeps `import src.utils` and `import src.mail` cheap for
+    processes that do not render a Streamlit app.
+    """
+    if name == "StreamlitMagicLink":
+        from src.magiclink import StreamlitMagicLink
+
+        return StreamlitMagicLink
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
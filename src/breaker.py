@@ -0,0 +1,117 @@
+import threading
+import time
+from typing import Any, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker that stops calling a failing dependency.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls
+    fail immediately with `CircuitOpenError`. After `reset_timeout` seconds a
+    single trial call is let through (half open); it closes the circuit when
+    it succeeds and opens it again when it fails.
+
+    Attributes:
+        name (str): Name of the protected dependency, used in errors and snapshots.
+        failure_threshold (int): Consecutive failures before the circuit opens.
+        reset_timeout (float): Seconds the circuit stays open before a trial call.
+        is_failure (Callable): Decides whether an exception counts as a failure.
+            Errors caused by the request itself, like a validation error, should not open the circuit.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        is_failure: Callable[[BaseException], bool] = lambda error: True,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+        self._rejected = 0
+        self._last_error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """The current state: `closed`, `open` or `half_open`."""
+        with self._lock:
+            return self._current_state()
+
+    def call(self, function: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Call `function` through the circuit breaker.
+
+        Raises:
+            CircuitOpenError: If the circuit is open.
+        """
+        self._before_call()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as error:
+            self._after_call(error)
+            raise
+        self._after_call(None)
+        return result
+
+    def snapshot(self) -> dict[str, Any]:
+        """
+        Get the state and counters of the circuit breaker, for monitoring.
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "state": self._current_state(),
+                "consecutive_failures": self._failures,
+                "rejected_calls": self._rejected,
+                "opened_at": self._opened_at,
+                "last_error": self._last_error,
+            }
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and self._opened_at is not None:
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+        return self._state
+
+    def _before_call(self) -> None:
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            self._rejected += 1
+        raise CircuitOpenError(f"Circuit for {self.name} is open.")
+
+    def _after_call(self, error: Optional[BaseException]) -> None:
+        with self._lock:
+            self._trial_running = False
+            if error is None or not self.is_failure(error):
+                self._state = CLOSED
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            self._last_error = repr(error)
+            if self._state == OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
@@ -0,0 +1,278 @@
+"""Two-tier cache of users, shared by the Streamlit processes of a host.
+
+The first tier is a bounded in-process LRU with a short TTL. The second tier
+is a SQLite database in WAL mode on the local disk, which every process on
+the host reads and writes, so a user loaded by one process is warm for the
+others. Updates and deletes through `src.utils` invalidate both tiers of the
+writing process and the shared tier; other processes may serve the previous
+value from their first tier until its TTL expires.
+
+Enable the cache by passing it to the collection registry:
+
+    collections = CollectionRegistry(mongo_client, user_cache=UserCache())
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from src.models import User
+
+logger = logging.getLogger(__name__)
+
+class LRUCache:
+    """
+    Bounded in-process cache with least recently used eviction and a TTL.
+
+    Attributes:
+        max_size (int): Maximum number of entries.
+        ttl (float): Seconds an entry is kept.
+        evictions (int): Number of entries evicted because the cache was full.
+    """
+
+    def __init__(self, max_size: int = 1_000, ttl: float = 5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get an entry, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        """Add or replace an entry, evicting the least recently used one when full."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        """Remove an entry."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """
+    Cache of JSON values in a SQLite database shared by the processes of a host.
+
+    Errors of the database are logged and treated as misses, so the cache
+    never breaks a sign in.
+
+    The database holds emails and names, and every process trusts the users
+    in it, so it must live in a directory only the user running the app can
+    write to. The file is created readable and writable by that user only,
+    and an existing file owned by another user or accessible to others is
+    refused.
+
+    Attributes:
+        path (str): Path of the database file.
+        ttl (float): Seconds an entry is kept.
+        max_size (int): Maximum number of entries, enforced every `prune_every` writes.
+        evictions (int): Number of entries removed by this process because they
+            expired or the cache was full.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 60.0,
+        max_size: int = 100_000,
+        prune_every: int = 1_000,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.prune_every = prune_every
+        self.evictions = 0
+        self._writes = 0
+        self._local = threading.local()
+        _create_private_file(path)
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        """Get an entry, or None if it is missing or expired."""
+        rows = self._execute(
+            "SELECT value FROM entries WHERE key = ? AND expires_at > ?", (key, time.time())
+        )
+        return rows[0][0] if rows else None
+
+    def set(self, key: str, value: str) -> None:
+        """Add or replace an entry."""
+        self._execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + self.ttl),
+        )
+        self._writes += 1
+        if self._writes % self.prune_every == 0:
+            self.prune()
+
+    def delete(self, key: str) -> None:
+        """Remove an entry."""
+        self._execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def prune(self) -> None:
+        """Remove expired entries, and the entries closest to expiry beyond `max_size`."""
+        connection = self._connection()
+        if connection is None:
+            return
+        try:
+            with connection:
+                expired = connection.execute(
+                    "DELETE FROM entries WHERE expires_at <= ?", (time.time(),)
+                ).rowcount
+                overflow = connection.execute(
+                    "DELETE FROM entries WHERE key IN "
+                    "(SELECT key FROM entries ORDER BY expires_at LIMIT "
+                    "max(0, (SELECT count(*) FROM entries) - ?))",
+                    (self.max_size,),
+                ).rowcount
+            self.evictions += expired + overflow
+        except sqlite3.Error as error:
+            logger.warning(f"Pruning the shared user cache failed: {error}")
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            try:
+                connection = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+            except sqlite3.Error as error:
+                logger.warning(f"Opening the shared user cache at {self.path} failed: {error}")
+                return None
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+        connection = self._connection()
+        if connection is None:
+            return []
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        except sqlite3.Error as error:
+            logger.warning(f"Shared user cache query failed: {error}")
+            return []
+
+
+class UserCache:
+    """
+    Two-tier cache of users by id.
+
+    Attributes:
+        local (LRUCache): The in-process tier.
+        shared (SQLiteCache): The optional host-local tier.
+        hits (int): Lookups served by the in-process tier.
+        shared_hits (int): Lookups served by the shared tier.
+        misses (int): Lookups served by neither tier.
+    """
+
+    def __init__(
+        self,
+        local: Optional[LRUCache] = None,
+        shared: Optional[SQLiteCache] = None,
+    ):
+        self.local = local or LRUCache()
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get(self, key: str, min_version: Optional[int] = None) -> Optional[User]:
+        """
+        Get a cached user, or None on a miss.
+
+        A cached user older than `min_version` counts as a miss.
+        """
+        document = self.local.get(key)
+        if document is not None and _is_current(document, min_version):
+            self.hits += 1
+            return User.from_document(document)
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                user = User.model_validate_json(value)
+                if _is_current(user.model_dump(), min_version):
+                    self.shared_hits += 1
+                    self.local.set(key, user.model_dump())
+                    user.mark_saved()
+                    return user
+        self.misses += 1
+        return None
+
+    def set(self, key: str, user: User) -> None:
+        """Cache a user loaded from the database."""
+        self.local.set(key, user.model_dump())
+        if self.shared is not None:
+            self.shared.set(key, user.model_dump_json())
+
+    def invalidate(self, key: str) -> None:
+        """Remove a user from the in-process and shared tier."""
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def stats(self) -> dict[str, int]:
+        """The hit, miss and eviction counters of both tiers."""
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "evictions": self.local.evictions,
+            "shared_evictions": self.shared.evictions if self.shared is not None else 0,
+            "size": len(self.local),
+        }
+
+
+def _create_private_file(path: str) -> None:
+    """
+    Create a file only the current user can read and write, or check that an
+    existing file is. SQLite creates its WAL files with the same permissions.
+
+    Raises:
+        PermissionError: If the file is owned by another user or accessible to others.
+    """
+    try:
+        descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as error:
+        # Like the other errors of the database, reported when it is used.
+        logger.warning(f"Opening the shared user cache at {path} failed: {error}")
+        return
+    try:
+        status = os.fstat(descriptor)
+    finally:
+        os.close(descriptor)
+    if hasattr(os, "getuid") and status.st_uid != os.getuid():
+        raise PermissionError(f"The shared user cache {path} is owned by another user.")
+    if status.st_mode & 0o077:
+        raise PermissionError(
+            f"The shared user cache {path} is accessible to other users, "
+            f"restrict it with `chmod 600 {path}`."
+        )
+
+
+def _is_current(document: dict[str, Any], min_version: Optional[int]) -> bool:
+    return min_version is None or document.get("version", 0) >= min_version
@@ -0,0 +1,167 @@
+"""Group commit of concurrent inserts.
+
+Under burst load every `authenticate` call of every script thread inserts
+its own magic link. An `InsertCoalescer` collects the inserts arriving
+within `max_wait` seconds, up to `max_batch_size`, and writes them with one
+`insert_many`. Each caller blocks on a future that completes with the id of
+its own document, or raises the error of its own document, so callers see
+the same result as with `insert_one`, after at most `max_wait` more seconds.
+
+    magic_link = StreamlitMagicLink(
+        mongo_client, base_url, link_coalescer=get_link_coalescer(mongo_client)
+    )
+"""
+
+import atexit
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Optional
+
+from pymongo.errors import BulkWriteError, WriteError
+
+from src.db import MAGIC_LINKS, ClientLike, get_registry
+
+logger = logging.getLogger(__name__)
+
+
+class InsertCoalescer:
+    """
+    Writer batching the inserts of concurrent callers into one collection.
+
+    Attributes:
+        key (str): The collection key of the inserts.
+        max_batch_size (int): Maximum number of documents written with one `insert_many`.
+            Reaching it writes the batch before `max_wait`.
+        max_wait (float): Maximum seconds the first insert of a batch waits for others.
+        batches (int): Number of `insert_many` calls.
+        inserted (int): Number of inserted documents.
+    """
+
+    def __init__(
+        self,
+        client: ClientLike,
+        key: str = MAGIC_LINKS,
+        max_batch_size: int = 100,
+        max_wait: float = 0.005,
+    ):
+        self.collections = get_registry(client)
+        self.key = key
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.inserted = 0
+        self._pending: list[tuple[dict[str, Any], Future]] = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, document: dict[str, Any]) -> Future:
+        """
+        Queue a document for the next batch.
+
+        Returns:
+            Future: Completes with the `_id` of the document once it is written.
+        """
+        future: Future = Future()
+        with self._condition:
+            if not self._stopped:
+                self._pending.append((document, future))
+                if self._thread is None:
+                    self._start()
+                if len(self._pending) == 1 or len(self._pending) >= self.max_batch_size:
+                    self._condition.notify()
+                return future
+        # After `close`, insert right away.
+        self._write([(document, future)])
+        return future
+
+    def insert(self, document: dict[str, Any], timeout: Optional[float] = None) -> Any:
+        """
+        Insert a document with the next batch, and wait until it is written.
+
+        Returns:
+            The `_id` of the document.
+
+        Raises:
+            WriteError: If the document could not be inserted, e.g. a duplicate key.
+        """
+        return self.submit(document).result(timeout)
+
+    def close(self) -> None:
+        """Write the pending documents and stop the writer."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="insert-coalescer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                deadline = time.monotonic() + self.max_wait
+                while len(self._pending) < self.max_batch_size and not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[: self.max_batch_size]
+                del self._pending[: self.max_batch_size]
+            self._write(batch)
+
+    def _write(self, batch: list[tuple[dict[str, Any], Future]]) -> None:
+        """Insert a batch and complete the future of every document with its own result."""
+        documents = [document for document, _ in batch]
+        try:
+            result = self.collections.get(self.key).insert_many(documents, ordered=False)
+        except BulkWriteError as error:
+            failed = {
+                write_error["index"]: write_error
+                for write_error in error.details.get("writeErrors", [])
+            }
+            for index, (document, future) in enumerate(batch):
+                if index in failed:
+                    write_error = failed[index]
+                    future.set_exception(
+                        WriteError(write_error.get("errmsg"), write_error.get("code"), write_error)
+                    )
+                elif error.details.get("writeConcernErrors"):
+                    future.set_exception(error)
+                else:
+                    future.set_result(document.get("_id"))
+            self._count(len(batch) - len(failed))
+            logger.warning(f"{len(failed)} of {len(batch)} batched inserts failed.")
+        except Exception as error:
+            for _, future in batch:
+                future.set_exception(error)
+            logger.error(f"Writing {len(batch)} batched inserts failed: {error}")
+        else:
+            for (_, future), inserted_id in zip(batch, result.inserted_ids):
+                future.set_result(inserted_id)
+            self._count(len(batch))
+
+    def _count(self, inserted: int) -> None:
+        with self._condition:
+            self.batches += 1
+            self.inserted += inserted
+
+
+def get_link_coalescer(client: ClientLike) -> InsertCoalescer:
+    """
+    Get the magic link insert coalescer shared by the process for a client or registry.
+    """
+    registry = get_registry(client)
+    return registry.resource("magic_link_inserts", lambda: InsertCoalescer(registry.base))
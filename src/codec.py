@@ -0,0 +1,405 @@
+"""Compact storage of users and magic links.
+
+By default users and magic links are stored as their `model_dump`: UUIDs as
+36 character strings and long field names like `expiration_time`. With a
+`CompactCodec` on the collection registry, they are stored with
+
+- UUIDs as 16 byte BSON binaries (subtype 4),
+- one or two character field names, and
+- the magic link expiry as integer epoch seconds,
+
+which roughly halves the size of the id and token indexes:
+
+    collections = CollectionRegistry(mongo_client, codec=CompactCodec())
+
+The codec wraps the users and magic links collections of the registry, so
+the helpers of `src.utils` and the `User`/`MagicLink` models are unchanged:
+queries, updates, projections, sorts and indexes are written with the model
+field names and translated, and documents are translated back when read.
+Aggregation pipelines only get their leading `$match` translated, followed
+by a stage restoring the model field names; values are not converted.
+
+Existing documents are converted with `src.migrations.migrate_to_compact`.
+Until then, with `read_legacy` (the default), every lookup that finds no
+compact document is repeated against the documents in the previous layout,
+and writes go to whichever layout the document is stored in. Disable
+`read_legacy` once all documents are converted.
+
+The compact layout is not supported with the sharded layout, as shard keys
+cannot be renamed in place.
+"""
+
+import uuid
+from datetime import datetime
+from typing import Any, Iterator, Optional, Union
+
+from bson.binary import Binary, UuidRepresentation
+
+from src.db import MAGIC_LINKS, USERS
+
+FIELD_NAMES = {
+    USERS: {
+        "id": "i",
+        "email": "e",
+        "email_key": "k",
+        "name": "n",
+        "is_verified": "v",
+        "is_payed_user": "p",
+        "additional_data": "d",
+        "created_at": "c",
+        "version": "r",
+    },
+    MAGIC_LINKS: {
+        "token": "t",
+        "user_id": "u",
+        "is_used": "s",
+        "expiration_time": "x",
+        "created_at": "c",
+        "used_at": "a",
+        "version": "r",
+    },
+}
+UUID_FIELDS = {USERS: {"id"}, MAGIC_LINKS: {"token", "user_id"}}
+EPOCH_FIELDS = {USERS: set(), MAGIC_LINKS: {"expiration_time"}}
+# A field every compact document has, telling the two layouts apart.
+MARKER_FIELDS = {USERS: "id", MAGIC_LINKS: "token"}
+
+_LOGICAL_OPERATORS = ("$or", "$and", "$nor")
+_LIST_OPERATORS = ("$in", "$nin", "$all")
+_UPDATE_OPERATORS = ("$set", "$setOnInsert", "$inc", "$unset", "$min", "$max")
+
+
+class CompactCodec:
+    """
+    Translates the users and magic links between the model layout and the compact layout.
+
+    Attributes:
+        read_legacy (bool): Whether documents in the model layout are still read
+            and written, while they are being migrated.
+    """
+
+    def __init__(self, read_legacy: bool = True):
+        self.read_legacy = read_legacy
+
+    def field(self, key: str, name: str) -> str:
+        """The stored name of a model field"""
+        return FIELD_NAMES[key].get(name, name)
+
+    def encode_value(self, key: str, name: str, value: Any) -> Any:
+        """The stored form of a model field value"""
+        if name in UUID_FIELDS[key] and isinstance(value, str):
+            try:
+                return Binary.from_uuid(uuid.UUID(value), UuidRepresentation.STANDARD)
+            except ValueError:
+                return value
+        if name in EPOCH_FIELDS[key] and isinstance(value, datetime):
+            return int(value.timestamp())
+        return value
+
+    def decode_value(self, key: str, name: str, value: Any) -> Any:
+        """The model form of a stored field value"""
+        if name in UUID_FIELDS[key]:
+            if isinstance(value, Binary) and value.subtype == 4:
+                return str(value.as_uuid(UuidRepresentation.STANDARD))
+            if isinstance(value, uuid.UUID):
+                return str(value)
+        if name in EPOCH_FIELDS[key] and isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value)
+        return value
+
+    def encode(self, key: str, document: dict[str, Any]) -> dict[str, Any]:
+        """The compact form of a document in the model layout"""
+        return {
+            self.field(key, name): self.encode_value(key, name, value)
+            for name, value in document.items()
+        }
+
+    def decode(self, key: str, document: dict[str, Any]) -> dict[str, Any]:
+        """
+        The model layout of a stored document. Documents already in the model
+        layout are returned as they are.
+        """
+        names = {stored: name for name, stored in FIELD_NAMES[key].items()}
+        decoded = {name: value for name, value in document.items() if name not in names}
+        for stored, value in document.items():
+            if stored in names:
+                decoded[names[stored]] = self.decode_value(key, names[stored], value)
+        return decoded
+
+    def is_compact(self, key: str, document: dict[str, Any]) -> bool:
+        """Whether a stored document is in the compact layout"""
+        return self.field(key, MARKER_FIELDS[key]) in document
+
+    def query(self, key: str, query: Optional[dict[str, Any]]) -> dict[str, Any]:
+        """The compact form of a query written with model field names"""
+        translated: dict[str, Any] = {}
+        for name, condition in (query or {}).items():
+            if name in _LOGICAL_OPERATORS:
+                translated[name] = [self.query(key, clause) for clause in condition]
+            elif name.startswith("$"):
+                translated[name] = condition
+            else:
+                translated[self.field(key, name)] = self._condition(key, name, condition)
+        return translated
+
+    def update(self, key: str, update: dict[str, Any]) -> dict[str, Any]:
+        """The compact form of an update document"""
+        return {
+            operator: (
+                self.encode(key, fields) if operator in _UPDATE_OPERATORS else fields
+            )
+            for operator, fields in update.items()
+        }
+
+    def projection(self, key: str, projection: Any) -> Any:
+        """The compact form of a projection"""
+        if isinstance(projection, dict):
+            return {self.field(key, name): value for name, value in projection.items()}
+        if isinstance(projection, (list, tuple)):
+            return [self.field(key, name) for name in projection]
+        return projection
+
+    def sort(self, key: str, sort: Any) -> Any:
+        """The compact form of a sort specification"""
+        if isinstance(sort, str):
+            return self.field(key, sort)
+        if isinstance(sort, (list, tuple)):
+            return [(self.field(key, name), direction) for name, direction in sort]
+        return sort
+
+    def wrap(self, key: str, collection: Any) -> Any:
+        """Wrap the collection of a collection key, if the codec translates its documents"""
+        if key not in FIELD_NAMES:
+            return collection
+        return CodecCollection(collection, self, key)
+
+    def _condition(self, key: str, name: str, condition: Any) -> Any:
+        if isinstance(condition, dict) and condition and all(
+            operator.startswith("$") for operator in condition
+        ):
+            translated = {}
+            for operator, operand in condition.items():
+                if operator in _LIST_OPERATORS:
+                    translated[operator] = [
+                        self.encode_value(key, name, value) for value in operand
+                    ]
+                elif operator == "$not":
+                    translated[operator] = self._condition(key, name, operand)
+                elif operator == "$exists":
+                    translated[operator] = operand
+                else:
+                    translated[operator] = self.encode_value(key, name, operand)
+            return translated
+        return self.encode_value(key, name, condition)
+
+
+class CodecResult:
+    """The combined counts of a write to both layouts."""
+
+    def __init__(self, *results: Any):
+        self.matched_count = sum(getattr(result, "matched_count", 0) for result in results)
+        self.modified_count = sum(getattr(result, "modified_count", 0) for result in results)
+        self.deleted_count = sum(getattr(result, "deleted_count", 0) for result in results)
+        self.acknowledged = all(getattr(result, "acknowledged", True) for result in results)
+
+
+class CodecCursor:
+    """Cursor that decodes documents and translates sorts."""
+
+    def __init__(self, cursor: Any, codec: CompactCodec, key: str):
+        self.cursor = cursor
+        self.codec = codec
+        self.key = key
+
+    def sort(self, key_or_list: Any, direction: Optional[int] = None) -> "CodecCursor":
+        if direction is None:
+            self.cursor = self.cursor.sort(self.codec.sort(self.key, key_or_list))
+        else:
+            self.cursor = self.cursor.sort(self.codec.field(self.key, key_or_list), direction)
+        return self
+
+    def limit(self, limit: int) -> "CodecCursor":
+        self.cursor = self.cursor.limit(limit)
+        return self
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        for document in self.cursor:
+            yield self.codec.decode(self.key, document)
+
+
+class CodecCollection:
+    """
+    Collection storing its documents in the compact layout, accepting and
+    returning documents in the model layout.
+
+    Attributes:
+        collection (Collection): The wrapped collection.
+    """
+
+    def __init__(self, collection: Any, codec: CompactCodec, key: str):
+        self.collection = collection
+        self.codec = codec
+        self.key = key
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.collection, name)
+
+    def insert_one(self, document: dict[str, Any], *args: Any, **kwargs: Any) -> Any:
+        encoded = self.codec.encode(self.key, document)
+        try:
+            return self.collection.insert_one(encoded, *args, **kwargs)
+        finally:
+            if "_id" in encoded:
+                document.setdefault("_id", encoded["_id"])
+
+    def insert_many(self, documents: list[dict[str, Any]], *args: Any, **kwargs: Any) -> Any:
+        encoded = [self.codec.encode(self.key, document) for document in documents]
+        try:
+            return self.collection.insert_many(encoded, *args, **kwargs)
+        finally:
+            for document, encoded_document in zip(documents, encoded):
+                if "_id" in encoded_document:
+                    document.setdefault("_id", encoded_document["_id"])
+
+    def find_one(
+        self, filter: Optional[dict[str, Any]] = None, projection: Any = None, **kwargs: Any
+    ) -> Optional[dict[str, Any]]:
+        compact_kwargs = dict(kwargs)
+        if "sort" in kwargs:
+            compact_kwargs["sort"] = self.codec.sort(self.key, kwargs["sort"])
+        document = self.collection.find_one(
+            self._compact(filter), self.codec.projection(self.key, projection), **compact_kwargs
+        )
+        if document is None and self.codec.read_legacy:
+            document = self.collection.find_one(self._legacy(filter), projection, **kwargs)
+        return self.codec.decode(self.key, document) if document is not None else None
+
+    def find(
+        self, filter: Optional[dict[str, Any]] = None, projection: Any = None, *args: Any, **kwargs: Any
+    ) -> CodecCursor:
+        query = self._compact(filter)
+        if self.codec.read_legacy:
+            query = {"$or": [query, self._legacy(filter)]}
+        if isinstance(projection, dict) and any(value for value in projection.values()):
+            # Include both names of a projected field, as both layouts are read.
+            projection = {**projection, **self.codec.projection(self.key, projection)}
+        else:
+            projection = self.codec.projection(self.key, projection)
+        return CodecCursor(self.collection.find(query, projection, *args, **kwargs), self.codec, self.key)
+
+    def find_one_and_update(
+        self, filter: dict[str, Any], update: dict[str, Any], projection: Any = None, **kwargs: Any
+    ) -> Optional[dict[str, Any]]:
+        compact_kwargs = dict(kwargs)
+        if "sort" in kwargs:
+            compact_kwargs["sort"] = self.codec.sort(self.key, kwargs["sort"])
+        document = self.collection.find_one_and_update(
+            self._compact(filter),
+            self.codec.update(self.key, update),
+            self.codec.projection(self.key, projection),
+            **compact_kwargs,
+        )
+        if document is None and self.codec.read_legacy:
+            document = self.collection.find_one_and_update(
+                self._legacy(filter), update, projection, **kwargs
+            )
+        return self.codec.decode(self.key, document) if document is not None else None
+
+    def update_one(self, filter: dict[str, Any], update: dict[str, Any], *args: Any, **kwargs: Any) -> Any:
+        result = self.collection.update_one(
+            self._compact(filter), self.codec.update(self.key, update), *args, **kwargs
+        )
+        if result.matched_count == 0 and self.codec.read_legacy:
+            result = self.collection.update_one(self._legacy(filter), update, *args, **kwargs)
+        return result
+
+    def update_many(self, filter: dict[str, Any], update: dict[str, Any], *args: Any, **kwargs: Any) -> Any:
+        result = self.collection.update_many(
+            self._compact(filter), self.codec.update(self.key, update), *args, **kwargs
+        )
+        if not self.codec.read_legacy:
+            return result
+        return CodecResult(
+            result, self.collection.update_many(self._legacy(filter), update, *args, **kwargs)
+        )
+
+    def update_one_operations(
+        self, filter: dict[str, Any], update: dict[str, Any]
+    ) -> list[tuple[dict[str, Any], dict[str, Any]]]:
+        """
+        The filters and updates of `update_one` in both layouts, to send with one
+        `bulk_write` of the wrapped collection. The filters exclude each other, so
+        at most one of them matches a document.
+        """
+        operations = [(self._compact(filter), self.codec.update(self.key, update))]
+        if self.codec.read_legacy:
+            operations.append((self._legacy(filter), update))
+        return operations
+
+    def delete_one(self, filter: dict[str, Any], *args: Any, **kwargs: Any) -> Any:
+        result = self.collection.delete_one(self._compact(filter), *args, **kwargs)
+        if result.deleted_count == 0 and self.codec.read_legacy:
+            result = self.collection.delete_one(self._legacy(filter), *args, **kwargs)
+        return result
+
+    def delete_many(self, filter: dict[str, Any], *args: Any, **kwargs: Any) -> Any:
+        result = self.collection.delete_many(self._compact(filter), *args, **kwargs)
+        if not self.codec.read_legacy:
+            return result
+        return CodecResult(result, self.collection.delete_many(self._legacy(filter), *args, **kwargs))
+
+    def count_documents(self, filter: dict[str, Any], *args: Any, **kwargs: Any) -> int:
+        count = self.collection.count_documents(self._compact(filter), *args, **kwargs)
+        if self.codec.read_legacy:
+            count += self.collection.count_documents(self._legacy(filter), *args, **kwargs)
+        return count
+
+    def create_index(self, keys: Union[str, list[tuple[str, Any]]], **kwargs: Any) -> str:
+        """
+        Create an index on the compact fields. Unique indexes only cover compact
+        documents, so they can be created while documents are migrated.
+        """
+        fields = [(keys, 1)] if isinstance(keys, str) else list(keys)
+        compact = [(self.codec.field(self.key, name), direction) for name, direction in fields]
+        if "partialFilterExpression" in kwargs:
+            kwargs["partialFilterExpression"] = self.codec.query(
+                self.key, kwargs["partialFilterExpression"]
+            )
+        elif kwargs.get("unique"):
+            name = next(name for name, _ in compact if name != "tenant")
+            kwargs["partialFilterExpression"] = {name: {"$exists": True}}
+        return self.collection.create_index(compact, **kwargs)
+
+    def aggregate(self, pipeline: list[dict[str, Any]], *args: Any, **kwargs: Any) -> Any:
+        """
+        Run a pipeline written with model field names. Its leading `$match` is
+        translated, and the model field names are restored after it.
+        """
+        stages = list(pipeline)
+        match: list[dict[str, Any]] = []
+        if stages and "$match" in stages[0]:
+            query = stages.pop(0)["$match"]
+            compact = self._compact(query)
+            match = [{"$match": {"$or": [compact, self._legacy(query)]} if self.codec.read_legacy else compact}]
+        restore = {
+            name: {"$ifNull": [f"${stored}", f"${name}", "$$REMOVE"]}
+            for name, stored in FIELD_NAMES[self.key].items()
+        }
+        return self.collection.aggregate(match + [{"$set": restore}] + stages, *args, **kwargs)
+
+    def _compact(self, filter: Optional[dict[str, Any]]) -> dict[str, Any]:
+        query = self.codec.query(self.key, filter)
+        if self.codec.read_legacy:
+            marker = self.codec.field(self.key, MARKER_FIELDS[self.key])
+            condition = query.get(marker)
+            if condition is None:
+                query[marker] = {"$exists": True}
+            elif isinstance(condition, dict) and "$exists" not in condition:
+                query[marker] = {"$exists": True, **condition}
+        return query
+
+    def _legacy(self, filter: Optional[dict[str, Any]]) -> dict[str, Any]:
+        return {
+            **(filter or {}),
+            self.codec.field(self.key, MARKER_FIELDS[self.key]): {"$exists": False},
+        }
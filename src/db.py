@@ -1,25 +1,240 @@
 import os
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Optional, TypeVar, Union
 
-from pymongo.mongo_client import MongoClient
+from src.emails import normalize_email
 
-DATABASE_NAME = os.environ.get("DATABASE_NAME", "streamlit-magic-link")
-COLLECTION_NAME_USERS = os.environ.get("COLLECTION_NAME_USERS", "users")
-COLLECTION_NAME_MAGIC_LINKS = os.environ.get("COLLECTION_NAME_MAGIC_LINKS", "magic-links")
+if TYPE_CHECKING:
+    from pymongo.collection import Collection
+    from pymongo.mongo_client import MongoClient
 
+    from src.cache import UserCache
+    from src.codec import CompactCodec
 
-def get_user_collection(client: MongoClient):
+T = TypeVar("T")
+
+USERS = "users"
+MAGIC_LINKS = "magic_links"
+OUTBOX = "outbox"
+USER_EMAILS = "user_emails"
+SESSIONS = "sessions"
+EVENTS = "events"
+STATS = "stats"
+
+DEFAULT_DATABASE_NAME = "streamlit-magic-link"
+DEFAULT_COLLECTION_NAMES = {
+    USERS: "users",
+    MAGIC_LINKS: "magic-links",
+    OUTBOX: "mail-outbox",
+    USER_EMAILS: "user-emails",
+    SESSIONS: "sessions",
+    EVENTS: "auth-events",
+    STATS: "user-stats",
+}
+COLLECTION_NAME_ENV_VARS = {
+    USERS: "COLLECTION_NAME_USERS",
+    MAGIC_LINKS: "COLLECTION_NAME_MAGIC_LINKS",
+    OUTBOX: "COLLECTION_NAME_OUTBOX",
+    USER_EMAILS: "COLLECTION_NAME_USER_EMAILS",
+    SESSIONS: "COLLECTION_NAME_SESSIONS",
+    EVENTS: "COLLECTION_NAME_EVENTS",
+    STATS: "COLLECTION_NAME_STATS",
+}
+
+
+class CollectionRegistry:
+    """
+    Registry of collection handles bound to a MongoDB client.
+
+    Handles are created on first use and cached, so helpers do not call
+    `get_database`/`get_collection` on every call. Names and options are
+    resolved when the registry is created, which allows several apps with
+    different names to share one process.
+
+    Attributes:
+        client (MongoClient): The MongoDB client the handles are bound to.
+        database_name (str): The name of the database.
+        collection_names (dict): Mapping of collection key to collection name.
+        collection_options (dict): Mapping of collection key to keyword arguments
+            for `Database.get_collection`, e.g. `write_concern`, `read_concern`,
+            `read_preference` or `codec_options`.
+        tenant (str): Optional app discriminator. Every document and query is
+            scoped to it, so several apps can share the same collections.
+        sharded (bool): Whether to use the sharding-ready layout, in which
+            users are found by email through the `user_emails` collection.
+            See `src.sharding`.
+        user_cache (UserCache): Optional cache of users by id, used by `get_user_by_id`
+            and invalidated by updates and deletes. See `src.cache`.
+        email_normalizer (callable): Turns an email into the key users are looked
+            up by. Defaults to trimming and case-folding. See `src.emails`.
+        codec (CompactCodec): Optional codec storing users and magic links in a
+            compact layout. See `src.codec`.
+    """
+
+    def __init__(
+        self,
+        client: "MongoClient",
+        database_name: Optional[str] = None,
+        collection_names: Optional[dict[str, str]] = None,
+        collection_options: Optional[dict[str, dict[str, Any]]] = None,
+        tenant: Optional[str] = None,
+        sharded: bool = False,
+        user_cache: Optional["UserCache"] = None,
+        email_normalizer: Callable[[str], str] = normalize_email,
+        codec: Optional["CompactCodec"] = None,
+    ):
+        if codec is not None and sharded:
+            raise ValueError("The compact storage layout is not supported with the sharded layout.")
+        self.client = client
+        self.tenant = tenant
+        self.sharded = sharded
+        self.user_cache = user_cache
+        self.email_normalizer = email_normalizer
+        self.codec = codec
+        self.database_name = database_name or os.environ.get(
+            "DATABASE_NAME", DEFAULT_DATABASE_NAME
+        )
+        self.collection_names = {
+            key: os.environ.get(COLLECTION_NAME_ENV_VARS.get(key, ""), name)
+            for key, name in DEFAULT_COLLECTION_NAMES.items()
+        }
+        self.collection_names.update(collection_names or {})
+        self.collection_options = dict(collection_options or {})
+        self._collections: dict[str, "Collection"] = {}
+        self._resources: dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> "Collection":
+        """
+        Get the cached collection handle for a collection key.
+        """
+        collection = self._collections.get(key)
+        if collection is None:
+            with self._lock:
+                collection = self._collections.get(key)
+                if collection is None:
+                    database = self.client.get_database(self.database_name)
+                    collection = database.get_collection(
+                        self.collection_names[key],
+                        **self.collection_options.get(key, {}),
+                    )
+                    if self.codec is not None:
+                        collection = self.codec.wrap(key, collection)
+                    self._collections[key] = collection
+        return collection
+
+    def resource(self, name: str, factory: Callable[[], T]) -> T:
+        """
+        Get a per-process object shared by everything using this registry,
+        like a cache, creating it with `factory` on first use. A factory
+        binding the resource to a registry must use `base`, so the resource
+        does not keep a wrapper of the registry.
+        """
+        resource = self._resources.get(name)
+        if resource is None:
+            with self._lock:
+                resource = self._resources.get(name)
+                if resource is None:
+                    resource = factory()
+                    self._resources[name] = resource
+        return resource
+
+    @property
+    def base(self) -> "CollectionRegistry":
+        """
+        The registry itself. A wrapper of a registry, like the traced registry
+        of the debug panel, returns the registry it wraps.
+        """
+        return self
+
+    def cache_key(self, key: str, document_id: str) -> str:
+        """
+        The key of a document in a cache that may be shared by several apps on a host.
+        """
+        return "/".join(
+            [self.database_name, self.collection_names[key], self.tenant or "", document_id]
+        )
+
+    def scope(self, query: dict[str, Any]) -> dict[str, Any]:
+        """
+        Scope a query or document to the tenant of the registry.
+        """
+        if self.tenant is None:
+            return query
+        return {"tenant": self.tenant, **query}
+
+    @property
+    def users(self) -> "Collection":
+        """The users collection"""
+        return self.get(USERS)
+
+    @property
+    def magic_links(self) -> "Collection":
+        """The magic links collection"""
+        return self.get(MAGIC_LINKS)
+
+    @property
+    def outbox(self) -> "Collection":
+        """The mail outbox collection"""
+        return self.get(OUTBOX)
+
+    @property
+    def user_emails(self) -> "Collection":
+        """The email to user id lookup collection of the sharded layout"""
+        return self.get(USER_EMAILS)
+
+    @property
+    def sessions(self) -> "Collection":
+        """The sessions collection"""
+        return self.get(SESSIONS)
+
+    @property
+    def events(self) -> "Collection":
+        """The auth event log collection"""
+        return self.get(EVENTS)
+
+    @property
+    def stats(self) -> "Collection":
+        """The user statistics rollup collection"""
+        return self.get(STATS)
+
+
+ClientLike = Union["MongoClient", CollectionRegistry]
+
+# The attribute holding the default registry of a client. Keeping the registry on
+# the client, rather than in a module-level dict, lets both be garbage collected.
+_REGISTRY_ATTRIBUTE = "_magic_link_registry"
+_registries_lock = threading.Lock()
+
+
+def get_registry(client: ClientLike) -> CollectionRegistry:
+    """
+    Get the collection registry for a client.
+
+    A registry is returned as is. For a bare client, a default registry is
+    created once and reused for the lifetime of the client.
+    """
+    if isinstance(client, CollectionRegistry):
+        return client
+    registry = vars(client).get(_REGISTRY_ATTRIBUTE)
+    if registry is None:
+        with _registries_lock:
+            registry = vars(client).get(_REGISTRY_ATTRIBUTE)
+            if registry is None:
+                registry = CollectionRegistry(client)
+                setattr(client, _REGISTRY_ATTRIBUTE, registry)
+    return registry
+
+
+def get_user_collection(client: ClientLike) -> "Collection":
     """
     Get the user collection from the MongoDB client.
     """
-    database = client.get_database(DATABASE_NAME)
-    users = database.get_collection(COLLECTION_NAME_USERS)
-    return users
+    return get_registry(client).users
 
 
-def get_magic_link_collection(client: MongoClient):
+def get_magic_link_collection(client: ClientLike) -> "Collection":
     """
     Get the magic link collection from the MongoDB client.
     """
-    database = client.get_database(DATABASE_NAME)
-    magic_links = database.get_collection(COLLECTION_NAME_MAGIC_LINKS)
-    return magic_links
+    return get_registry(client).magic_links
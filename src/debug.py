@@ -0,0 +1,223 @@
+"""Opt-in debug panel showing where a rerun spent its time in StreamlitMagicLink.
+
+With `StreamlitMagicLink(..., debug=True)`, the collections, cookie
+controller, user cache and mail transport of the instance are wrapped to
+record every call with its duration. `magic_link.debug_panel()` then shows
+the calls of the current rerun, and a summary of the last reruns of the
+session. Without `debug`, nothing is wrapped, so there is no overhead.
+"""
+
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Iterator, NamedTuple, Optional
+
+from src.db import CollectionRegistry
+from src.transports import MailTransport
+
+if TYPE_CHECKING:
+    from pymongo.collection import Collection
+
+    from src.cache import UserCache
+    from src.magiclink import StreamlitMagicLink
+
+MONGO = "mongo"
+COOKIE = "cookie"
+CACHE = "cache"
+MAIL = "mail"
+
+HISTORY_KEY = "magic_link_debug_history"
+
+
+class DebugEvent(NamedTuple):
+    """A call recorded by a debug trace."""
+
+    kind: str
+    name: str
+    duration_ms: float
+    detail: str = ""
+
+
+class DebugTrace:
+    """
+    The calls of one rerun.
+
+    Attributes:
+        events (list): The recorded calls, in order.
+    """
+
+    def __init__(self) -> None:
+        self.events: list[DebugEvent] = []
+        self._started = time.perf_counter()
+
+    def record(self, kind: str, name: str, duration: float = 0.0, detail: str = "") -> None:
+        """Record a call that took `duration` seconds."""
+        self.events.append(DebugEvent(kind, name, duration * 1000, detail))
+
+    @contextmanager
+    def timed(self, kind: str, name: str, detail: str = "") -> Iterator[None]:
+        """Record the duration of the block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as error:
+            detail = f"{detail} failed: {error}".strip()
+            raise
+        finally:
+            self.record(kind, name, time.perf_counter() - started, detail)
+
+    def summary(self) -> dict[str, Any]:
+        """The number of calls and milliseconds per kind, and the time since the trace started."""
+        summary: dict[str, Any] = {"elapsed_ms": (time.perf_counter() - self._started) * 1000}
+        for kind in (MONGO, COOKIE, CACHE, MAIL):
+            events = [event for event in self.events if event.kind == kind]
+            summary[f"{kind}_calls"] = len(events)
+            summary[f"{kind}_ms"] = sum(event.duration_ms for event in events)
+        summary["cache_hits"] = sum(1 for event in self.events if event.detail == "hit")
+        summary["cache_misses"] = sum(1 for event in self.events if event.detail == "miss")
+        return summary
+
+
+class _TracedCollection:
+    """Collection that records the duration of every operation."""
+
+    def __init__(self, collection: "Collection", trace: DebugTrace):
+        self._collection = collection
+        self._trace = trace
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args: Any, **kwargs: Any) -> Any:
+            with self._trace.timed(MONGO, f"{self._collection.name}.{name}"):
+                result = attribute(*args, **kwargs)
+                # Cursors are lazy, fetch them so the duration includes the round trips.
+                return list(result) if name in ("find", "aggregate") else result
+
+        return call
+
+
+class _TracedUserCache:
+    """User cache that records hits and misses."""
+
+    def __init__(self, user_cache: "UserCache", trace: DebugTrace):
+        self._user_cache = user_cache
+        self._trace = trace
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._user_cache, name)
+
+    def get(self, key: str, min_version: Optional[int] = None) -> Any:
+        started = time.perf_counter()
+        user = self._user_cache.get(key, min_version)
+        self._trace.record(
+            CACHE, "user_cache.get", time.perf_counter() - started, "hit" if user else "miss"
+        )
+        return user
+
+
+class _TracedRegistry(CollectionRegistry):
+    """
+    Registry handing out traced collections, sharing the handles and resources
+    of `registry`. Resources are built from `registry`, so a process-wide
+    resource first used in a debug session does not record to its trace.
+    """
+
+    def __init__(self, registry: CollectionRegistry, trace: DebugTrace):
+        self.__dict__.update(registry.__dict__)
+        self._registry = registry
+        self._trace = trace
+        if registry.user_cache is not None:
+            self.user_cache = _TracedUserCache(registry.user_cache, trace)  # type: ignore[assignment]
+
+    @property
+    def base(self) -> CollectionRegistry:
+        return self._registry
+
+    def get(self, key: str) -> Any:
+        return _TracedCollection(super().get(key), self._trace)
+
+
+class _TracedCookieController:
+    """Cookie controller that records every call."""
+
+    def __init__(self, cookie_controller: Any, trace: DebugTrace):
+        self._cookie_controller = cookie_controller
+        self._trace = trace
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._cookie_controller, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args: Any, **kwargs: Any) -> Any:
+            with self._trace.timed(COOKIE, name, str(args[0]) if args else ""):
+                return attribute(*args, **kwargs)
+
+        return call
+
+
+class _TracedTransport(MailTransport):
+    """Mail transport that records the duration of every send."""
+
+    def __init__(self, transport: MailTransport, trace: DebugTrace):
+        self._transport = transport
+        self._trace = trace
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._transport, name)
+
+    def send(self, to_email: str, body: str, subject: str) -> None:
+        with self._trace.timed(MAIL, type(self._transport).__name__):
+            self._transport.send(to_email=to_email, body=body, subject=subject)
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+def instrument(magic_link: "StreamlitMagicLink") -> DebugTrace:
+    """
+    Wrap the collections, cookie controller, user cache and mail transport of
+    an instance, and return the trace they record to.
+    """
+    trace = DebugTrace()
+    # A copy of the service for this instance only, the shared service stays unwrapped.
+    magic_link.service = magic_link.service.replace(
+        collections=_TracedRegistry(magic_link.collections, trace),
+        mail_transport=_TracedTransport(magic_link.mail_transport, trace),
+    )
+    magic_link.cookie_controller = _TracedCookieController(  # type: ignore[assignment]
+        magic_link.cookie_controller, trace
+    )
+    return trace
+
+
+def render_debug_panel(trace: DebugTrace, history_size: int = 10) -> None:
+    """
+    Show the calls of the current rerun and the summaries of the last
+    `history_size` reruns of the session.
+    """
+    import streamlit as st
+
+    history = st.session_state.get(HISTORY_KEY)
+    if history is None or history.maxlen != history_size:
+        history = deque(history or [], maxlen=history_size)
+        st.session_state[HISTORY_KEY] = history
+    summary = trace.summary()
+    history.append(summary)
+
+    with st.expander(f"Auth debug: {summary['elapsed_ms']:.1f} ms", expanded=False):
+        metrics = [
+            ("Mongo", f"{summary['mongo_ms']:.1f} ms", f"{summary['mongo_calls']} calls"),
+            ("Cookies", f"{summary['cookie_ms']:.1f} ms", f"{summary['cookie_calls']} calls"),
+            ("Cache", f"{summary['cache_hits']} hits", f"{summary['cache_misses']} misses"),
+            ("Mail", f"{summary['mail_ms']:.1f} ms", f"{summary['mail_calls']} sends"),
+        ]
+        for column, (label, value, calls) in zip(st.columns(len(metrics)), metrics):
+            column.metric(label, value, calls, delta_color="off")
+        st.caption("This rerun")
+        st.dataframe([event._asdict() for event in trace.events], use_container_width=True)
+        st.caption(f"Last {len(history)} reruns")
+        st.dataframe(list(history), use_container_width=True)
@@ -0,0 +1,59 @@
+"""Normalized email keys.
+
+Users are looked up by `email_key`, a normalized form of their email, so
+`Alice@x.com` and ` alice@x.com` are the same user. The key is trimmed and
+case-folded. Provider-specific rules, like ignoring dots and `+tags` in
+Gmail addresses, are opt-in with an `EmailNormalizer` on the collection
+registry:
+
+    collections = CollectionRegistry(mongo_client, email_normalizer=GMAIL_RULES)
+
+Users stored before email keys were introduced get their key from
+`src.migrations.backfill_email_keys`, which also reports users whose keys collide.
+"""
+
+from typing import Iterable, Optional
+
+
+class EmailNormalizer:
+    """
+    Turns an email address into the key users are looked up by.
+
+    Attributes:
+        ignore_dots_domains (set): Domains whose local parts ignore dots.
+        plus_tag_domains (set): Domains whose local parts ignore everything after a `+`.
+        domain_aliases (dict): Domains that are the same mailbox as another domain.
+    """
+
+    def __init__(
+        self,
+        ignore_dots_domains: Iterable[str] = (),
+        plus_tag_domains: Iterable[str] = (),
+        domain_aliases: Optional[dict[str, str]] = None,
+    ):
+        self.ignore_dots_domains = {domain.casefold() for domain in ignore_dots_domains}
+        self.plus_tag_domains = {domain.casefold() for domain in plus_tag_domains}
+        self.domain_aliases = {
+            alias.casefold(): domain.casefold() for alias, domain in (domain_aliases or {}).items()
+        }
+
+    def __call__(self, email: str) -> str:
+        key = email.strip().casefold()
+        local, separator, domain = key.rpartition("@")
+        if not separator:
+            return key
+        domain = self.domain_aliases.get(domain, domain)
+        if domain in self.plus_tag_domains:
+            local = local.split("+", 1)[0]
+        if domain in self.ignore_dots_domains:
+            local = local.replace(".", "")
+        return f"{local}@{domain}"
+
+
+normalize_email = EmailNormalizer()
+
+GMAIL_RULES = EmailNormalizer(
+    ignore_dots_domains=["gmail.com"],
+    plus_tag_domains=["gmail.com"],
+    domain_aliases={"googlemail.com": "gmail.com"},
+)
@@ -0,0 +1,168 @@
+"""Write-behind audit log of auth events.
+
+Recording an event only appends it to an in-memory buffer. A background
+thread writes the buffer to the events collection in batches, so the audit
+log adds no database round trip to the sign in flows. The buffer is bounded:
+when the database cannot keep up, the oldest events are dropped and counted.
+The buffer is flushed when the process exits.
+
+Tokens are never stored or logged in clear, only their `hash_token` digest.
+"""
+
+import atexit
+import hashlib
+import logging
+import threading
+from collections import deque
+from datetime import timedelta
+from typing import Optional
+
+from src.db import ClientLike, get_registry
+from src.models import AuthEvent
+
+logger = logging.getLogger(__name__)
+
+LINK_ISSUED = "link_issued"
+LINK_REDEEMED = "link_redeemed"
+SIGNED_OUT = "signed_out"
+SIGNED_OUT_EVERYWHERE = "signed_out_everywhere"
+USER_DELETED = "user_deleted"
+
+
+def hash_token(token: str) -> str:
+    """
+    A short digest of a magic link token, to correlate log lines and events
+    without revealing the token.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+def ensure_event_indexes(client: ClientLike, retention: timedelta = timedelta(days=90)) -> None:
+    """
+    Create the indexes used to query events, and expire events after `retention`.
+    """
+    registry = get_registry(client)
+    tenant = [("tenant", 1)] if registry.tenant is not None else []
+    registry.events.create_index(tenant + [("user_id", 1), ("created_at", -1)])
+    registry.events.create_index(
+        [("created_at", 1)], expireAfterSeconds=int(retention.total_seconds())
+    )
+
+
+class EventLog:
+    """
+    Buffered writer of auth events.
+
+    Attributes:
+        batch_size (int): Maximum number of events written with one `insert_many`.
+            Reaching it wakes the writer before `flush_interval`.
+        flush_interval (float): Maximum seconds an event waits in the buffer.
+        max_buffered (int): Maximum number of buffered events.
+        dropped (int): Number of events dropped because the buffer was full or
+            the write failed.
+    """
+
+    def __init__(
+        self,
+        client: ClientLike,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        max_buffered: int = 10_000,
+    ):
+        self.collections = get_registry(client)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.dropped = 0
+        self._buffer: deque[AuthEvent] = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(
+        self,
+        event: str,
+        outcome: Optional[str] = None,
+        user_id: Optional[str] = None,
+        token: Optional[str] = None,
+    ) -> None:
+        """
+        Buffer an event. The token is stored as its `hash_token` digest.
+        """
+        entry = AuthEvent(
+            event=event,
+            outcome=outcome,
+            user_id=user_id,
+            token_hash=hash_token(token) if token else None,
+        )
+        with self._lock:
+            if len(self._buffer) >= self.max_buffered:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(entry)
+            buffered = len(self._buffer)
+            if self._thread is None and not self._stopped.is_set():
+                self._start()
+        if buffered >= self.batch_size:
+            self._wake.set()
+
+    def flush(self) -> int:
+        """
+        Write all buffered events.
+
+        Returns:
+            int: The number of events written.
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [
+                        self._buffer.popleft()
+                        for _ in range(min(self.batch_size, len(self._buffer)))
+                    ]
+                if not batch:
+                    return written
+                try:
+                    self.collections.events.insert_many(
+                        [self.collections.scope(event.model_dump()) for event in batch],
+                        ordered=False,
+                    )
+                except Exception as error:
+                    logger.error(f"Writing {len(batch)} auth events failed: {error}")
+                    with self._lock:
+                        self.dropped += len(batch)
+                    return written
+                written += len(batch)
+
+    def close(self) -> None:
+        """Stop the writer and flush the buffer."""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def _start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="auth-event-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+def get_event_log(client: ClientLike) -> EventLog:
+    """
+    Get the event log shared by the process for a client or registry.
+    """
+    registry = get_registry(client)
+    return registry.resource("events", lambda: EventLog(registry.base))
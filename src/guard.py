@@ -0,0 +1,142 @@
+"""Page guards for multipage apps.
+
+Constructing `StreamlitMagicLink` on every page reads the cookie and checks
+the user in the database. A `PageGuard` does that once, caches the signed
+in user in the session state, and serves page switches within `freshness`
+from the cache, without a cookie read or database query. Signing in, out,
+updating and deleting the user through `StreamlitMagicLink` drop the cache.
+
+    guard = PageGuard(mongo_client, base_url, login_page="login.py")
+
+    @guard.require(payed_user=True)
+    def billing_page() -> None:
+        st.write(f"Hello, {guard.user['email']}!")
+
+    st.navigation([st.Page("login.py"), st.Page(billing_page)]).run()
+
+Or as a context manager, which returns the user:
+
+    with guard.require(verified=True) as user:
+        st.write(f"Hello, {user['email']}!")
+"""
+
+import time
+from contextlib import ContextDecorator
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, NamedTuple, Optional, Union
+
+import streamlit as st
+from pymongo.mongo_client import MongoClient
+from streamlit.navigation.page import StreamlitPage
+
+from src.magiclink import AUTH_STATE_KEY, StreamlitMagicLink
+
+
+class AuthState(NamedTuple):
+    """The signed in user of a session, and when it was checked."""
+
+    user: Optional[dict[str, Any]]
+    checked_at: float
+
+
+class PageGuard:
+    """
+    Resolves the signed in user once per session and guards the pages of an app.
+
+    A guard holds no state of its own, so one guard can be shared by all
+    sessions, e.g. as a module level variable.
+
+    Attributes:
+        mongo_client (MongoClient): The MongoDB client used for database operations.
+        base_url (str): The base URL of the application, used for generating magic links.
+        freshness (timedelta): How long the cached user of a session is used before
+            it is checked again.
+        login_page: The page to switch to when nobody is signed in. Without it, the
+            page shows a message and stops.
+        options (dict): Keyword arguments for `StreamlitMagicLink`, like `collections`
+            or `event_log`.
+    """
+
+    def __init__(
+        self,
+        mongo_client: MongoClient,
+        base_url: str,
+        freshness: timedelta = timedelta(seconds=30),
+        login_page: Optional[Union[str, Path, StreamlitPage]] = None,
+        **options: Any,
+    ):
+        self.mongo_client = mongo_client
+        self.base_url = base_url
+        self.freshness = freshness
+        self.login_page = login_page
+        self.options = options
+
+    @property
+    def user(self) -> Optional[dict[str, Any]]:
+        """The signed in user of the session, from the cache if it is fresh"""
+        state = st.session_state.get(AUTH_STATE_KEY)
+        if (
+            isinstance(state, AuthState)
+            and not st.query_params.get("token")
+            and time.monotonic() - state.checked_at < self.freshness.total_seconds()
+        ):
+            return state.user
+        return self.refresh()
+
+    def refresh(self) -> Optional[dict[str, Any]]:
+        """
+        Check the signed in user, signing in with the magic link in the url if
+        there is one, and cache the result for the session.
+        """
+        magic_link = self.magic_link()
+        magic_link.sign_in()
+        user = magic_link.user
+        st.session_state[AUTH_STATE_KEY] = AuthState(user, time.monotonic())
+        return user
+
+    def magic_link(self) -> StreamlitMagicLink:
+        """A `StreamlitMagicLink` for signing in and out, or editing the user"""
+        return StreamlitMagicLink(self.mongo_client, self.base_url, **self.options)
+
+    def check(self, verified: bool = False, payed_user: bool = False) -> dict[str, Any]:
+        """
+        Get the signed in user, or stop the page if the user does not meet the requirements.
+
+        Switches to the login page, if there is one, when nobody is signed in.
+        """
+        user = self.user
+        if not user:
+            if self.login_page is not None:
+                st.switch_page(self.login_page)
+            st.info("Please sign in to see this page.")
+            st.stop()
+        if verified and not user.get("is_verified"):
+            st.warning("Please verify your email to see this page.")
+            st.stop()
+        if payed_user and not user.get("is_payed_user"):
+            st.warning("This page is only available to paying users.")
+            st.stop()
+        return user
+
+    def require(self, verified: bool = False, payed_user: bool = False) -> "_Requirement":
+        """
+        Guard a page, as a decorator of the page function or as a context manager.
+        See `check`.
+        """
+        return _Requirement(self, verified, payed_user)
+
+
+class _Requirement(ContextDecorator):
+    """Checks the requirements of a page before it runs."""
+
+    def __init__(self, guard: PageGuard, verified: bool, payed_user: bool):
+        self.guard = guard
+        self.verified = verified
+        self.payed_user = payed_user
+
+    def __enter__(self) -> dict[str, Any]:
+        return self.guard.check(verified=self.verified, payed_user=self.payed_user)
+
+    def __exit__(self, *exc: Any) -> None:
+        return None
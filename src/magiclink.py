@@ -1,35 +1,72 @@
 import logging
 import time
-from datetime import datetime
-from typing import Optional, cast
+import uuid
+from contextlib import AbstractContextManager, nullcontext
+from datetime import datetime, timedelta
+from typing import Any, Optional
 
 import streamlit as st
 from pymongo.mongo_client import MongoClient
 from streamlit_cookies_controller import CookieController
 
-from src.mail import send_email
-from src.models import MagicLink, User
-from src.utils import (
-    create_or_retrieve_user,
-    delete_user,
-    get_magic_link_by_token,
-    get_user_by_id,
-    insert_magic_link,
-    update_magic_link,
-    update_user,
-)
+from src.db import CollectionRegistry
+from src.breaker import CircuitOpenError
+from src.coalescer import InsertCoalescer
+from src.debug import DebugTrace, instrument, render_debug_panel
+from src.events import EventLog
+from src.models import User
+from src.recorder import TraceRecorder, annotate
+from src.service import MagicLinkService
+from src.transports import MailTransport
+from src.utils import VersionConflictError
 
 logger = logging.getLogger(__name__)
 
+# The signed in user cached for the session by `src.guard`, dropped whenever the cookie changes.
+AUTH_STATE_KEY = "magic_link_auth_state"
+# A random id of the session, to group the operations of a session in a trace and to recognize
+# the reruns of a sign in.
+TRACE_SESSION_KEY = "magic_link_trace_session"
+
 
 class StreamlitMagicLink:
     """
     StreamlitMagicLink is a class that provides methods for generating and verifying magic links for user authentication.
 
+    It is the per-session Streamlit adapter of a `MagicLinkService`, see `src.service`: it reads
+    the token from the query parameters, keeps the signed in user in a cookie and shows toasts,
+    while the service does the rest. Build the service once per process and pass it as `service`,
+    so constructing this class on every rerun only reads the cookie and checks the user.
+
     Attributes:
         mongo_client (MongoClient): The MongoDB client used for database operations.
         base_url (str): The base URL of the application, used for generating magic links.
         cookie_controller (CookieController): An optional controller for managing cookies. If not provided, a default instance is created.
+        collections (CollectionRegistry): An optional registry with the database and collection names and
+            options for this instance. If not provided, the default registry of `mongo_client` is used.
+        mail_transport (MailTransport): An optional transport used to send the magic links. If not provided,
+            the emails are sent with Mailjet.
+        use_outbox (bool): Whether to write magic link emails to the outbox collection instead of
+            sending them directly. The emails are then sent by a worker, see `src.outbox`.
+        use_transactions (bool): Whether to insert the magic link and its outbox job in one transaction.
+            Requires a replica set or sharded cluster.
+        outbox_fallback (bool): Whether to write the email to the outbox when the mail transport fails fast
+            because its circuit breaker is open. Without it, the user is asked to try again later.
+        reuse_window (timedelta): Repeated `authenticate` calls within this window reuse the user's outstanding
+            magic link instead of sending another email. Set to `None` to always send a new link.
+        event_log (EventLog): An optional audit log to which link issuance, redemption outcomes, sign-outs
+            and deletions are recorded, see `src.events`.
+        link_coalescer (InsertCoalescer): An optional writer that inserts the magic links of concurrent
+            `authenticate` calls with one `insert_many`, see `src.coalescer`.
+        recorder (TraceRecorder): An optional recorder to which the operations of this instance and the
+            helpers they call are written as an anonymized trace, see `src.recorder`.
+        legacy_sessions_until (datetime): Until when users signed in before sessions were introduced
+            get a session instead of being signed out, see `MagicLinkService`.
+        service (MagicLinkService): An optional service shared by the sessions of the process. When given,
+            the options above except `cookie_controller` are taken from the service.
+        debug (bool): Whether to record the database, cookie, cache and mail calls of this instance for
+            `debug_panel`, see `src.debug`. Off by default, as it wraps these objects.
+        debug_history (int): The number of reruns summarized by `debug_panel`.
     Methods:
         user:
             Returns the current user stored in the cookie.
@@ -41,6 +78,10 @@ class StreamlitMagicLink:
             Signs in a user by validating the magic link token from the query parameters.
         sign_out() -> None:
             Signs out the current user by removing their cookie and rerunning the Streamlit app.
+        sign_out_everywhere() -> None:
+            Signs out the current user in all browsers by revoking all their sessions.
+        debug_panel() -> None:
+            Shows the calls of the current rerun when `debug` is enabled.
     """
 
     def __init__(
@@ -48,27 +89,75 @@ class StreamlitMagicLink:
         mongo_client: MongoClient,
         base_url: str,
         cookie_controller: Optional[CookieController] = None,
+        collections: Optional[CollectionRegistry] = None,
+        mail_transport: Optional[MailTransport] = None,
+        use_outbox: bool = False,
+        use_transactions: bool = False,
+        outbox_fallback: bool = False,
+        reuse_window: Optional[timedelta] = timedelta(minutes=1),
+        event_log: Optional[EventLog] = None,
+        link_coalescer: Optional[InsertCoalescer] = None,
+        recorder: Optional[TraceRecorder] = None,
+        legacy_sessions_until: Optional[datetime] = None,
+        service: Optional[MagicLinkService] = None,
+        debug: bool = False,
+        debug_history: int = 10,
     ):
         """
         Initializes the MagicLinkAuth class
         """
         self.mongo_client = mongo_client
-        self.base_url = base_url
+        self.service = service or MagicLinkService(
+            collections or mongo_client,
+            base_url,
+            mail_transport=mail_transport,
+            use_outbox=use_outbox,
+            use_transactions=use_transactions,
+            outbox_fallback=outbox_fallback,
+            reuse_window=reuse_window,
+            event_log=event_log,
+            link_coalescer=link_coalescer,
+            recorder=recorder,
+            legacy_sessions_until=legacy_sessions_until,
+        )
+        self.base_url = self.service.base_url
         if cookie_controller:
             self.cookie_controller = cookie_controller
         else:
             self.cookie_controller = CookieController()
+        self.debug_history = debug_history
+        self.debug_trace: Optional[DebugTrace] = instrument(self) if debug else None
 
-        self._sync_user()
+        with self._operation("rerun"):
+            self._sync_user()
+            annotate(outcome="signed_in" if self.user else "anonymous")
 
     @property
     def user(self):
         """Returns the current user"""
         return self.cookie_controller.get("user")
 
+    @property
+    def collections(self) -> CollectionRegistry:
+        """The collection registry of the service"""
+        return self.service.collections
+
+    @property
+    def mail_transport(self) -> MailTransport:
+        """The mail transport of the service"""
+        return self.service.mail_transport
+
     def authenticate(self, email: str) -> None:
         """Authenticates the user by generating a magic link and sending it to the user's email."""
-        self._send_magic_link(email)
+        try:
+            with self._operation("authenticate", email=email):
+                self.service.request_link(email)
+        except CircuitOpenError:
+            st.toast(
+                "Sign-in emails are temporarily unavailable. Please try again later.",
+                icon=":material/error:",
+            )
+            return
         st.toast(
             f"A magic link has been sent to {email}. Please check your inbox.",
             icon=":material/check:",
@@ -79,38 +168,71 @@ class StreamlitMagicLink:
         token = st.query_params.get("token")
         if token:
             logging.info("Trying to sign in")
-            user = self._handle_magic_link(token)
-            if not user:
+            with self._operation("sign_in", token=token):
+                signed_in = self.service.sign_in(token, session=self._session_key())
+            if not signed_in:
                 st.query_params.clear()
                 st.toast("Invalid or expired magic link.", icon=":material/error:")
             else:
-                self._set_user(user)
+                self._set_user(signed_in.user, signed_in.session_id)
                 st.query_params.clear()
                 st.toast("You are now signed in.", icon=":material/check:")
 
     def sign_out(self) -> None:
         """Signs out the current user"""
-        self._remove_user()
+        with self._operation("sign_out"):
+            self.service.sign_out(self.user["id"] if self.user else None, self._session_id)
+            self._remove_user()
         st.rerun()
         st.toast("You are now signed out.", icon=":material/check:")
 
+    def sign_out_everywhere(self) -> None:
+        """Signs out the current user in all browsers"""
+        if not self.user:
+            return
+        with self._operation("sign_out_everywhere"):
+            self.service.sign_out_everywhere(self.user["id"])
+            self._remove_user()
+        st.rerun()
+        st.toast("You are now signed out everywhere.", icon=":material/check:")
+
+    def debug_panel(self) -> None:
+        """Shows the calls of the current rerun, if debugging is enabled"""
+        if self.debug_trace is not None:
+            render_debug_panel(self.debug_trace, self.debug_history)
+
     def update_user(self, **kwargs) -> None:
         """Updates the current user"""
         if not self.user:
             return None
 
-        updated_user = update_user(self.mongo_client, User(**{**self.user, **kwargs}))
+        version = self.user.get("version")
+        try:
+            with self._operation("update_user", user_id=self.user["id"], fields=sorted(kwargs)):
+                updated_user = self.service.update_user(
+                    self.user["id"],
+                    expected_version=version if isinstance(version, int) else None,
+                    **kwargs,
+                )
+        except VersionConflictError:
+            self._sync_user()
+            st.toast(
+                "Your profile was changed elsewhere. Please review it and try again.",
+                icon=":material/error:",
+            )
+            return
         if updated_user:
             self._set_user(updated_user)
 
         st.toast("User updated successfully!", icon=":material/check:")
 
     def delete_user(self) -> None:
-        """Deletes the current user"""
+        """Deletes the current user with their magic links, sessions and events"""
         if not self.user:
             return
-        delete_user(self.mongo_client, User(**self.user))
-        self._remove_user()
+        with self._operation("delete_user"):
+            self.service.delete_user(self.user["id"])
+            self._remove_user()
         st.rerun()
         st.toast("User deleted successfully!", icon=":material/check:")
 
@@ -120,88 +242,47 @@ class StreamlitMagicLink:
         This is useful for example when a backend process updates the user
         in the database.
 
-        We remove the user from the cookie if the user is not found in the database.
-        This is useful for example when the user is deleted from the database or if
-        something went wrong.
+        We remove the user from the cookie if the user is not found in the database,
+        or if their session was revoked, see `MagicLinkService.sync`. The cookie is
+        only written when the user changed.
         """
-        if not self.user:
+        result = self.service.sync(self.user)
+        if not result.changed:
             return None
-        user = get_user_by_id(self.mongo_client, self.user["id"])
-        if not user:
+        if result.user is None:
             self._remove_user()
             return None
-        self._set_user(user)
+        self._set_user(result.user, result.session_id)
 
-    def _set_user(self, user: User) -> None:
-        """Sets the current user in the cookie"""
-        self.cookie_controller.set("user", user.model_dump())
+    @property
+    def _session_id(self) -> Optional[str]:
+        """The id of the server-side session stored in the cookie"""
+        session_id = self.user.get("session_id") if self.user else None
+        return session_id if isinstance(session_id, str) else None
+
+    def _set_user(self, user: User, session_id: Optional[str] = None) -> None:
+        """Sets the current user and their session id in the cookie"""
+        self.cookie_controller.set(
+            "user",
+            {**user.model_dump(mode="json"), "session_id": session_id or self._session_id},
+        )
+        st.session_state.pop(AUTH_STATE_KEY, None)
 
     def _remove_user(self) -> None:
         """Removes the current user from the cookie
-        
+
         We are adding a sleep here to ensure that the cookie is removed
         before the next rerun of the Streamlit app."""
         self.cookie_controller.remove("user")
+        st.session_state.pop(AUTH_STATE_KEY, None)
         time.sleep(1)
-    
-    def _handle_magic_link(self, magic_link_id: str) -> Optional[User]:
-        """
-        Validate a magic link by its ID, and return the user if valid.
-        """
-        magic_link = get_magic_link_by_token(self.mongo_client, magic_link_id)
-
-        if not self._validate_magic_link(magic_link, magic_link_id):
-            return None
-
-        magic_link = cast(MagicLink, magic_link)
 
-        user = get_user_by_id(self.mongo_client, magic_link.user_id)
-        if not user:
-            logging.warning(f"User with id {magic_link.user_id} not found.")
-            return None
-
-        magic_link.is_used = True
-        update_magic_link(self.mongo_client, magic_link)
-
-        user.is_verified = True
-        update_user(self.mongo_client, user)
-        return user
-
-    @staticmethod
-    @st.cache_resource(ttl=1)
-    def _validate_magic_link(
-        _magic_link: Optional[MagicLink], magic_link_id: str
-    ) -> bool:
-        """Validate a magic link
-
-        We are caching this function to handle Streamlit's rerun behavior.
-        If we would not cache this function, a magic link would be validated
-        multiple times, which would lead to an invalid login for the user.
+    def _operation(self, op: str, **identifiers: Any) -> AbstractContextManager[Any]:
+        """Records an operation of the session to the trace, if there is a recorder"""
+        if self.service.recorder is None:
+            return nullcontext()
+        return self.service.recorder.operation(op, session=self._session_key(), **identifiers)
 
-        NOTE: `_magic_link` is assigned an underscore to avoid caching over the pydantic
-        model, which is not possible.
-        """
-        if not _magic_link:
-            logging.warning(f"Magic link with id {magic_link_id} not found.")
-            return False
-        if _magic_link.is_used:
-            logging.warning(f"Magic link with id {magic_link_id} is already used.")
-            return False
-        if _magic_link.expiration_time < datetime.now():
-            logging.warning(f"Magic link with id {magic_link_id} is expired.")
-            return False
-        return True
-
-    def _send_magic_link(self, email: str) -> None:
-        """
-        Send a magic link to the user.
-        """
-        user = create_or_retrieve_user(self.mongo_client, email)
-        magic_link = insert_magic_link(self.mongo_client, user.id)
-        
-        send_email(
-            to_email=email,
-            body=f"Click the link to sign in: {self.base_url}?token={magic_link.token}",
-            subject="Your Magic Link",
-        )
-        logging.info(f"Magic link sent to {email}: {self.base_url}?token={magic_link.token}")
+    def _session_key(self) -> str:
+        """A random id of the Streamlit session, kept in the session state"""
+        return st.session_state.setdefault(TRACE_SESSION_KEY, uuid.uuid4().hex)
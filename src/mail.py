@@ -1,18 +1,50 @@
 import logging
 import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, Union
 
 import requests
 
-logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
+MAILJET_SEND_URL = "https://api.mailjet.com/v3.1/send"
+DEFAULT_TIMEOUT = (3.05, 10.0)
+DEFAULT_DEADLINE = 15.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
 
-def send_email(to_email: str, body: str, subject:str) -> None:
+
+def send_email(
+    to_email: str,
+    body: str,
+    subject: str,
+    timeout: Union[float, tuple[float, float]] = DEFAULT_TIMEOUT,
+    max_retries: int = 2,
+    backoff: float = 0.5,
+    max_backoff: float = 5.0,
+    deadline: Optional[float] = DEFAULT_DEADLINE,
+) -> None:
     """
     Send an email using Mailjet via HTTP API and requests.
 
+    Connection errors, timeouts and 429/5xx responses are retried with
+    jittered exponential backoff. A `Retry-After` header is respected, but
+    when it asks for more than `max_backoff` seconds the error is raised
+    instead. All attempts and delays together take at most `deadline`
+    seconds: the timeouts of an attempt are cut to the time left, and no
+    retry is made that would start after the deadline. A sign-in therefore
+    never waits longer than `deadline` for a hung provider.
+
     Args:
         to_email (str): Recipient's email.
         body (str): The plain text body of the email.
+        subject (str): The subject of the email.
+        timeout (float | tuple): The connect and read timeout in seconds.
+        max_retries (int): The number of retries after the first attempt.
+        backoff (float): The base delay in seconds, doubled on every retry.
+        max_backoff (float): The maximum delay in seconds between attempts.
+        deadline (float): The maximum seconds of all attempts together, or None for no limit.
     """
     api_key, api_secret = _set_mailjet_api_auth()
 
@@ -24,13 +56,89 @@ def send_email(to_email: str, body: str, subject:str) -> None:
     with requests.Session() as session:
         session.auth = (api_key, api_secret)
         session.headers.update({"Content-Type": "application/json"})
-        response = session.post(
-            "https://api.mailjet.com/v3.1/send",
-            json=_create_email_payload(from_email, to_email, body, subject),
-        )
-    
-    response.raise_for_status() 
-    logging.info(f"Response: {response.status_code} - {response.text}")
+        payload = _create_email_payload(from_email, to_email, body, subject)
+        started = time.monotonic()
+        for attempt in range(max_retries + 1):
+            attempt_timeout = _bounded_timeout(timeout, started, deadline)
+            try:
+                response = session.post(MAILJET_SEND_URL, json=payload, timeout=attempt_timeout)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                delay = _backoff_delay(attempt, backoff, max_backoff)
+                if attempt == max_retries or _past_deadline(started, delay, deadline):
+                    raise
+                logger.warning(f"Sending email failed ({error}), retrying in {delay:.2f}s.")
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt == max_retries:
+                    break
+                retry_after = _retry_after(response)
+                if retry_after is not None and retry_after > max_backoff:
+                    break
+                delay = retry_after if retry_after is not None else _backoff_delay(attempt, backoff, max_backoff)
+                if _past_deadline(started, delay, deadline):
+                    break
+                logger.warning(
+                    f"Sending email failed with status {response.status_code}, retrying in {delay:.2f}s."
+                )
+            time.sleep(delay)
+
+    response.raise_for_status()
+    logger.info(f"Response: {response.status_code} - {response.text}")
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Check whether a send error is caused by the provider rather than the request.
+
+    Rejected requests, like 4xx responses other than 429, are not transient.
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.HTTPError))
+
+def _backoff_delay(attempt: int, backoff: float, max_backoff: float) -> float:
+    """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(backoff * 2**attempt, max_backoff))
+
+
+def _past_deadline(started: float, delay: float, deadline: Optional[float]) -> bool:
+    """
+    Check whether a retry after `delay` seconds would start after the deadline.
+    """
+    return deadline is not None and time.monotonic() - started + delay >= deadline
+
+
+def _bounded_timeout(
+    timeout: Union[float, tuple[float, float]], started: float, deadline: Optional[float]
+) -> Union[float, tuple[float, float]]:
+    """
+    Cut the timeouts of an attempt to the time left before the deadline.
+    """
+    if deadline is None:
+        return timeout
+    left = max(deadline - (time.monotonic() - started), 0.01)
+    if isinstance(timeout, tuple):
+        return (min(timeout[0], left), min(timeout[1], left))
+    return min(timeout, left)
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    """
+    Get the delay in seconds requested by a `Retry-After` header, if any.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
 
 def _set_mailjet_api_auth() -> tuple[str, str]:
     """
@@ -75,6 +183,7 @@ def _create_email_payload(from_email: str, to_email: str, body: str, subject: st
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     send_email(
         to_email="ivo.lindsen@gmail.com",
         body="This is a test email from Python App2.",
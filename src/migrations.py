@@ -0,0 +1,369 @@
+"""One-off migrations of stored documents.
+
+Run them once after upgrading, e.g.
+
+    python -m src.migrations email-keys
+    python -m src.migrations compact --drop-legacy-indexes
+"""
+
+import argparse
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Any, Optional, cast
+
+from pydantic import BaseModel, Field
+from pymongo import UpdateOne
+
+from src.codec import FIELD_NAMES, MARKER_FIELDS, CodecCollection, CompactCodec
+from src.db import MAGIC_LINKS, USERS, ClientLike, CollectionRegistry, get_registry
+from src.utils import ensure_indexes
+
+logger = logging.getLogger(__name__)
+
+
+class EmailKeyReport(BaseModel):
+    """Class for the result of the email key backfill"""
+    updated: int = 0
+    duplicates: dict[str, list[str]] = Field(default_factory=dict)
+
+
+def backfill_email_keys(
+    client: ClientLike, batch_size: int = 1_000, rekey: bool = False
+) -> EmailKeyReport:
+    """
+    Set the normalized email key of users stored without one, in batches.
+
+    A user whose key is already taken, by a user with that key or by an
+    earlier user of the run, gets no key and can still be found by its exact
+    email. These users are reported as duplicate clusters: the key, and the
+    ids of the users sharing it, the one owning the key first. Merge or
+    delete the duplicates and run the backfill again.
+
+    In the sharded layout, the email lookups are moved to the keys as well.
+
+    Args:
+        client: The MongoDB client or collection registry.
+        batch_size (int): Number of users whose keys are checked for
+            duplicates with one query.
+        rekey (bool): Whether to recompute the keys of all users, e.g. after
+            changing the normalization rules of the registry.
+
+    Returns:
+        EmailKeyReport: The number of updated users and the duplicate clusters.
+    """
+    registry = get_registry(client)
+    report = EmailKeyReport()
+    clusters: dict[str, list[str]] = defaultdict(list)
+    query: dict[str, Any] = {} if rekey else {"email_key": {"$exists": False}}
+    cursor = registry.users.find(
+        registry.scope(query), {"_id": 1, "id": 1, "email": 1, "email_key": 1}
+    ).sort("_id", 1)
+
+    batch: list[dict[str, Any]] = []
+    for user in cursor:
+        batch.append(user)
+        if len(batch) == batch_size:
+            report.updated += _backfill_batch(registry, batch, clusters)
+            batch = []
+    if batch:
+        report.updated += _backfill_batch(registry, batch, clusters)
+
+    report.duplicates = {key: ids for key, ids in clusters.items() if len(ids) > 1}
+    logger.info(
+        f"Backfilled {report.updated} email keys, "
+        f"found {len(report.duplicates)} duplicate clusters."
+    )
+    return report
+
+
+def _backfill_batch(
+    registry: CollectionRegistry,
+    batch: list[dict[str, Any]],
+    clusters: dict[str, list[str]],
+) -> int:
+    """
+    Set the keys of a batch of users, skipping and recording the duplicates.
+
+    Returns:
+        int: The number of updated users.
+    """
+    keys = {user["_id"]: registry.email_normalizer(user["email"]) for user in batch}
+    owners = {
+        owner["email_key"]: owner["id"]
+        for owner in registry.users.find(
+            registry.scope({"email_key": {"$in": list(set(keys.values()))}}),
+            {"_id": 0, "id": 1, "email_key": 1},
+        )
+    }
+    if registry.sharded:
+        # Lookups from before email keys hold the exact email, which may be the key of another user.
+        for lookup in registry.user_emails.find(
+            registry.scope({"email": {"$in": list(set(keys.values()))}}),
+            {"_id": 0, "email": 1, "user_id": 1},
+        ):
+            owners.setdefault(lookup["email"], lookup["user_id"])
+
+    unset: list[tuple[dict[str, Any], dict[str, Any]]] = []
+    updates: list[tuple[dict[str, Any], dict[str, Any]]] = []
+    for user in batch:
+        key = keys[user["_id"]]
+        previous_key = user.get("email_key")
+        owner = owners.setdefault(key, user["id"])
+        if not clusters[key]:
+            clusters[key].append(owner)
+        if owner != user["id"]:
+            clusters[key].append(user["id"])
+            if previous_key is not None:
+                unset.append(({"_id": user["_id"]}, {"$unset": {"email_key": ""}}))
+            continue
+        if previous_key == key:
+            continue
+        if registry.sharded and key != (previous_key or user["email"]):
+            stored = [email for email in (previous_key, user["email"]) if email is not None]
+            registry.user_emails.insert_one(registry.scope({"email": key, "user_id": user["id"]}))
+            registry.user_emails.delete_many(
+                registry.scope({"email": {"$in": stored}, "user_id": user["id"]})
+            )
+        updates.append(({"_id": user["_id"]}, {"$set": {"email_key": key}}))
+    # The removed keys were read with the batch, so every unset modifies its user.
+    return _bulk_update(registry, unset + updates) - len(unset)
+
+
+def _bulk_update(
+    registry: CollectionRegistry, updates: list[tuple[dict[str, Any], dict[str, Any]]]
+) -> int:
+    """
+    Apply `update_one` updates to users with one unordered `bulk_write`, in
+    both layouts if the registry has a `CompactCodec`.
+
+    Returns:
+        int: The number of modified users.
+    """
+    if not updates:
+        return 0
+    collection: Any = registry.users
+    if registry.codec is not None:
+        codec_collection = cast(CodecCollection, collection)
+        updates = [
+            operation
+            for filter, update in updates
+            for operation in codec_collection.update_one_operations(filter, update)
+        ]
+        collection = codec_collection.collection
+    requests = [UpdateOne(filter, update) for filter, update in updates]
+    return collection.bulk_write(requests, ordered=False).modified_count
+
+
+class CollectionSize(BaseModel):
+    """Class for the document and index sizes of a collection, in bytes"""
+    count: int = 0
+    size: int = 0
+    avg_document_size: float = 0.0
+    index_size: int = 0
+    index_sizes: dict[str, int] = Field(default_factory=dict)
+
+
+class CompactMigrationReport(BaseModel):
+    """Class for the result of the migration to the compact layout"""
+    migrated: dict[str, int] = Field(default_factory=dict)
+    skipped: dict[str, int] = Field(default_factory=dict)
+    before: dict[str, CollectionSize] = Field(default_factory=dict)
+    after: dict[str, CollectionSize] = Field(default_factory=dict)
+
+    def table(self) -> list[str]:
+        """The sizes before and after the migration, as the lines of a table"""
+        pair = f"{'before':>7} {'after':>7}"
+        lines = [
+            f"{'collection':<12} {'documents':>10} {'avg size B':>15} {'data MB':>15} {'index MB':>15}",
+            f"{'':<12} {'':>10} {pair} {pair} {pair}",
+        ]
+        for key, before in self.before.items():
+            after = self.after[key]
+            lines.append(
+                f"{key:<12} {after.count:>10} "
+                f"{before.avg_document_size:>7.0f} {after.avg_document_size:>7.0f} "
+                f"{before.size / 2**20:>7.1f} {after.size / 2**20:>7.1f} "
+                f"{before.index_size / 2**20:>7.1f} {after.index_size / 2**20:>7.1f}"
+            )
+        return lines
+
+
+def collection_sizes(client: ClientLike) -> dict[str, CollectionSize]:
+    """
+    Get the document and index sizes of the users and magic links collections
+    from the server, by collection key.
+    """
+    registry = get_registry(client)
+    database = registry.client.get_database(registry.database_name)
+    sizes = {}
+    for key in (USERS, MAGIC_LINKS):
+        stats = database.command({"collStats": registry.collection_names[key]})
+        sizes[key] = CollectionSize(
+            count=stats.get("count", 0),
+            size=stats.get("size", 0),
+            avg_document_size=stats.get("avgObjSize", 0.0),
+            index_size=stats.get("totalIndexSize", 0),
+            index_sizes=dict(stats.get("indexSizes", {})),
+        )
+    return sizes
+
+
+def migrate_to_compact(
+    client: ClientLike,
+    batch_size: int = 1_000,
+    pause: float = 0.0,
+    drop_legacy_indexes: bool = False,
+) -> CompactMigrationReport:
+    """
+    Convert the users and magic links to the compact layout of the registry's
+    `CompactCodec`, in batches, while the app keeps running.
+
+    The unique indexes of the previous layout are recreated to only cover
+    documents that were not converted yet, and the indexes of the compact
+    layout are created. A document changed while it is converted is skipped;
+    run the migration again to convert it. With `drop_legacy_indexes`, the
+    indexes of the previous layout are dropped afterwards. Run
+    `ensure_stats_indexes` again if you use `src.stats`.
+
+    Args:
+        client: A collection registry with a `CompactCodec`.
+        batch_size (int): Number of documents read with one query.
+        pause (float): Seconds to wait between batches, to limit the load.
+        drop_legacy_indexes (bool): Whether to drop the indexes of the previous layout.
+
+    Returns:
+        CompactMigrationReport: The converted and skipped documents per collection
+        key, and the sizes before and after.
+
+    Raises:
+        ValueError: If the registry has no `CompactCodec`.
+    """
+    registry = get_registry(client)
+    codec = registry.codec
+    if codec is None:
+        raise ValueError("Set a CompactCodec on the collection registry to migrate to it.")
+    report = CompactMigrationReport(before=collection_sizes(registry))
+    for key in (USERS, MAGIC_LINKS):
+        _relax_legacy_unique_indexes(registry, key)
+    ensure_indexes(registry)
+    for key in (USERS, MAGIC_LINKS):
+        report.migrated[key], report.skipped[key] = _migrate_collection(
+            registry, codec, key, batch_size, pause
+        )
+        if drop_legacy_indexes:
+            _drop_legacy_indexes(registry, key)
+    report.after = collection_sizes(registry)
+    logger.info(f"Converted {report.migrated} documents, skipped {report.skipped}.")
+    return report
+
+
+def _raw_collection(registry: CollectionRegistry, key: str) -> Any:
+    """The collection without the codec"""
+    return registry.get(key).collection
+
+
+def _legacy_fields(key: str, index: dict[str, Any]) -> list[str]:
+    return [field for field, _ in index["key"] if field in FIELD_NAMES[key]]
+
+
+def _relax_legacy_unique_indexes(registry: CollectionRegistry, key: str) -> None:
+    """
+    Recreate the unique indexes of the previous layout as partial indexes, so
+    converted documents, which lack the indexed fields, do not collide.
+    """
+    collection = _raw_collection(registry, key)
+    for name, index in collection.index_information().items():
+        fields = _legacy_fields(key, index)
+        if not fields or not index.get("unique") or "partialFilterExpression" in index:
+            continue
+        collection.drop_index(name)
+        collection.create_index(
+            index["key"],
+            name=name,
+            unique=True,
+            partialFilterExpression={fields[0]: {"$exists": True}},
+        )
+
+
+def _drop_legacy_indexes(registry: CollectionRegistry, key: str) -> None:
+    collection = _raw_collection(registry, key)
+    for name, index in collection.index_information().items():
+        if _legacy_fields(key, index):
+            collection.drop_index(name)
+
+
+def _migrate_collection(
+    registry: CollectionRegistry, codec: CompactCodec, key: str, batch_size: int, pause: float
+) -> tuple[int, int]:
+    """
+    Convert the documents of a collection in batches of increasing `_id`.
+
+    Returns:
+        tuple: The number of converted and of skipped documents.
+    """
+    collection = _raw_collection(registry, key)
+    legacy: dict[str, Any] = {codec.field(key, MARKER_FIELDS[key]): {"$exists": False}}
+    migrated = skipped = 0
+    while True:
+        batch = list(
+            collection.find(registry.scope(legacy)).sort("_id", 1).limit(batch_size)
+        )
+        if not batch:
+            return migrated, skipped
+        for document in batch:
+            fields = codec.decode(key, {name: value for name, value in document.items() if name != "_id"})
+            # Only replace the document if it was not changed since it was read.
+            result = collection.replace_one(
+                dict(document), {"_id": document["_id"], **codec.encode(key, fields)}
+            )
+            migrated += result.modified_count
+            skipped += 1 - result.matched_count
+        legacy["_id"] = {"$gt": batch[-1]["_id"]}
+        if pause:
+            time.sleep(pause)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    """
+    Run a migration with the MongoDB settings from the environment.
+    """
+    from pymongo.mongo_client import MongoClient
+    from pymongo.server_api import ServerApi
+
+    parser = argparse.ArgumentParser(description="Run a one-off migration.")
+    subparsers = parser.add_subparsers(dest="migration", required=True)
+    email_keys = subparsers.add_parser("email-keys", help="Backfill normalized email keys.")
+    email_keys.add_argument("--batch-size", type=int, default=1_000, help="Users checked per query.")
+    email_keys.add_argument("--rekey", action="store_true", help="Recompute all keys.")
+    compact = subparsers.add_parser("compact", help="Convert to the compact storage layout.")
+    compact.add_argument("--batch-size", type=int, default=1_000, help="Documents per query.")
+    compact.add_argument("--pause", type=float, default=0.0, help="Seconds between batches.")
+    compact.add_argument("--drop-legacy-indexes", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    mongodb_password = os.environ["MONGODB_PASSWORD"]
+    mongodb_username = os.environ["MONGODB_USERNAME"]
+    mongodb_host = os.environ["MONGODB_HOST"]
+    uri = f"mongodb+srv://{mongodb_username}:{mongodb_password}@{mongodb_host}/?retryWrites=true&w=majority"
+    client: MongoClient = MongoClient(uri, server_api=ServerApi("1"))
+
+    if args.migration == "compact":
+        migration = migrate_to_compact(
+            CollectionRegistry(client, codec=CompactCodec()),
+            batch_size=args.batch_size,
+            pause=args.pause,
+            drop_legacy_indexes=args.drop_legacy_indexes,
+        )
+        for line in migration.table():
+            print(line)
+        return
+    report = backfill_email_keys(client, batch_size=args.batch_size, rekey=args.rekey)
+    for key, user_ids in report.duplicates.items():
+        print(f"{key}: {', '.join(user_ids)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,43 @@
 import uuid
-from typing import Optional
+from typing import Any, Optional, TypeVar
 from datetime import datetime, timedelta
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
+M = TypeVar("M", bound="TrackedModel")
 
-class User(BaseModel):
+
+class TrackedModel(BaseModel):
+    """Base class for models that track which fields changed since they were loaded or saved"""
+    _saved: Optional[dict[str, Any]] = PrivateAttr(default=None)
+
+    @classmethod
+    def from_document(cls: type[M], document: dict[str, Any]) -> M:
+        """Creates a model from a stored document, with no changed fields"""
+        model = cls(**document)
+        model.mark_saved()
+        return model
+
+    @property
+    def is_saved(self) -> bool:
+        """Whether the model was loaded or saved, so its version is the stored one"""
+        return self._saved is not None
+
+    def mark_saved(self) -> None:
+        """Marks the current field values as stored"""
+        self._saved = self.model_dump()
+
+    def changed_fields(self) -> dict[str, Any]:
+        """The fields that changed since the model was loaded or saved. All fields for a new model."""
+        current = self.model_dump()
+        if self._saved is None:
+            return current
+        return {
+            name: value
+            for name, value in current.items()
+            if name not in self._saved or self._saved[name] != value
+        }
+
+class User(TrackedModel):
     """Class for User model"""
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     email: str
@@ -12,10 +45,74 @@ class User(BaseModel):
     is_verified: Optional[bool] = False
     is_payed_user: Optional[bool] = False
     additional_data: Optional[str] = None
+    created_at: Optional[datetime] = None
+    version: int = 0
 
-class MagicLink(BaseModel):
+class MagicLink(TrackedModel):
     """Class for Magic Link model"""
     token: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     is_used: bool = False
     expiration_time: datetime = Field(default_factory=lambda: datetime.now() + timedelta(minutes=15))
+    created_at: datetime = Field(default_factory=datetime.now)
+    used_at: Optional[datetime] = None
+    version: int = 0
+
+# How long a session stays valid after signing in.
+SESSION_LIFETIME = timedelta(days=30)
+
+class AuthSession(BaseModel):
+    """Class for a server-side session of a signed in user"""
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    created_at: datetime = Field(default_factory=datetime.now)
+    expires_at: datetime = Field(default_factory=lambda: datetime.now() + SESSION_LIFETIME)
+    revoked_at: Optional[datetime] = None
+
+class AuthEvent(BaseModel):
+    """Class for an entry of the auth event log"""
+    event: str
+    outcome: Optional[str] = None
+    user_id: Optional[str] = None
+    token_hash: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.now)
+
+class Email(BaseModel):
+    """Class for Email model"""
+    to_email: str
+    subject: str
+    body: str
+
+class OutboxJob(BaseModel):
+    """Class for a queued email in the mail outbox"""
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    to_email: str
+    subject: str
+    body: str
+    user_id: Optional[str] = None
+    status: str = "pending"
+    attempts: int = 0
+    available_at: datetime = Field(default_factory=datetime.now)
+    lease_owner: Optional[str] = None
+    last_error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.now)
+    completed_at: Optional[datetime] = None
+
+class DashboardStats(BaseModel):
+    """Class for the user statistics of an admin dashboard, read from the stats rollup"""
+    total_users: int = 0
+    verified_users: int = 0
+    paying_users: int = 0
+    signups_per_day: dict[str, int] = Field(default_factory=dict)
+    links_issued_per_day: dict[str, int] = Field(default_factory=dict)
+    redemptions_per_day: dict[str, int] = Field(default_factory=dict)
+    updated_at: Optional[datetime] = None
+
+class PurgeReport(BaseModel):
+    """Class for the number of documents removed by a user purge"""
+    users: int = 0
+    magic_links: int = 0
+    sessions: int = 0
+    events: int = 0
+    user_emails: int = 0
+    outbox: int = 0
@@ -0,0 +1,221 @@
+"""Durable mail outbox.
+
+Instead of calling the mail provider while handling a Streamlit request,
+the email is written to the outbox collection. Workers started with
+`python -m src.outbox` claim jobs in batches, send them and mark them done.
+A claimed job is leased: its `available_at` is moved past the lease, so a
+job of a crashed worker becomes available again once the lease expires.
+Delivery is therefore at least once.
+"""
+
+import logging
+import os
+import random
+import signal
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+from pymongo import ASCENDING, ReturnDocument
+
+from src.db import ClientLike, get_registry
+from src.models import OutboxJob
+from src.transports import MailTransport, get_default_transport
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+def ensure_outbox_indexes(client: ClientLike, retention: timedelta = timedelta(days=7)) -> None:
+    """
+    Create the indexes used to claim jobs and to purge the jobs of a user, and
+    expire completed jobs after `retention`.
+    """
+    registry = get_registry(client)
+    tenant = [("tenant", ASCENDING)] if registry.tenant is not None else []
+    outbox = registry.outbox
+    outbox.create_index(tenant + [("status", ASCENDING), ("available_at", ASCENDING)])
+    outbox.create_index([("id", ASCENDING)], unique=True)
+    outbox.create_index([("user_id", ASCENDING)], sparse=True)
+    outbox.create_index([("to_email", ASCENDING)])
+    outbox.create_index(
+        [("completed_at", ASCENDING)],
+        expireAfterSeconds=int(retention.total_seconds()),
+    )
+
+
+def enqueue_email(
+    client: ClientLike,
+    to_email: str,
+    body: str,
+    subject: str,
+    session: Optional[Any] = None,
+    user_id: Optional[str] = None,
+) -> OutboxJob:
+    """
+    Write an email to the outbox collection, scoped to the tenant of the
+    registry. Pass the `user_id` of the recipient, so the job is purged with
+    the user, see `src.purge`.
+    """
+    registry = get_registry(client)
+    job = OutboxJob(to_email=to_email, body=body, subject=subject, user_id=user_id)
+    registry.outbox.insert_one(registry.scope(job.model_dump()), session=session)
+    return job
+
+
+class OutboxWorker:
+    """
+    Worker that sends the emails in the outbox.
+
+    Several workers can run against the same collection, each job is claimed
+    by one worker at a time. A worker with a tenant only claims the jobs of
+    its tenant, a worker with a bare client claims the jobs of all tenants.
+
+    Attributes:
+        client (ClientLike): The MongoDB client or collection registry.
+        transport (MailTransport): The transport used to send the emails.
+        batch_size (int): Maximum number of jobs claimed at once.
+        lease (timedelta): How long a claimed job is reserved for this worker.
+        max_attempts (int): Number of attempts before a job is marked as failed.
+        backoff (timedelta): Base delay between attempts, doubled on every attempt.
+        max_backoff (timedelta): Upper bound of the delay between attempts.
+    """
+
+    def __init__(
+        self,
+        client: ClientLike,
+        transport: Optional[MailTransport] = None,
+        batch_size: int = 20,
+        lease: timedelta = timedelta(minutes=2),
+        max_attempts: int = 5,
+        backoff: timedelta = timedelta(seconds=10),
+        max_backoff: timedelta = timedelta(minutes=30),
+    ):
+        self.collections = get_registry(client)
+        self.transport = transport or get_default_transport()
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.worker_id = str(uuid.uuid4())
+        self._stopped = threading.Event()
+
+    def claim_batch(self) -> list[OutboxJob]:
+        """
+        Claim up to `batch_size` jobs that are due.
+        """
+        jobs = []
+        for _ in range(self.batch_size):
+            now = datetime.now()
+            document = self.collections.outbox.find_one_and_update(
+                self.collections.scope({"status": PENDING, "available_at": {"$lte": now}}),
+                {
+                    "$set": {
+                        "available_at": now + self.lease,
+                        "lease_owner": self.worker_id,
+                    },
+                    "$inc": {"attempts": 1},
+                },
+                sort=[("available_at", ASCENDING)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if not document:
+                break
+            jobs.append(OutboxJob(**document))
+        return jobs
+
+    def process_batch(self) -> int:
+        """
+        Claim and send a batch of jobs.
+
+        Returns:
+            int: The number of claimed jobs.
+        """
+        jobs = self.claim_batch()
+        for job in jobs:
+            try:
+                self.transport.send(to_email=job.to_email, body=job.body, subject=job.subject)
+            except Exception as error:
+                self._mark_failed_attempt(job, error)
+            else:
+                self._mark_done(job)
+        return len(jobs)
+
+    def run_forever(self, poll_interval: float = 1.0) -> None:
+        """
+        Process batches until `stop` is called, sleeping when the outbox is empty.
+        """
+        logger.info(f"Outbox worker {self.worker_id} started.")
+        while not self._stopped.is_set():
+            if self.process_batch() < self.batch_size:
+                self._stopped.wait(poll_interval)
+        logger.info(f"Outbox worker {self.worker_id} stopped.")
+
+    def stop(self) -> None:
+        """Stop the worker after the current batch."""
+        self._stopped.set()
+
+    def _mark_done(self, job: OutboxJob) -> None:
+        result = self.collections.outbox.update_one(
+            {"id": job.id, "lease_owner": self.worker_id},
+            {"$set": {"status": DONE, "completed_at": datetime.now(), "lease_owner": None}},
+        )
+        if result.matched_count == 0:
+            logger.warning(f"Lease of outbox job {job.id} expired before it was sent.")
+
+    def _mark_failed_attempt(self, job: OutboxJob, error: Exception) -> None:
+        if job.attempts >= self.max_attempts:
+            logger.error(f"Outbox job {job.id} failed after {job.attempts} attempts: {error}")
+            update: dict[str, Any] = {
+                "status": FAILED,
+                "completed_at": datetime.now(),
+                "lease_owner": None,
+                "last_error": str(error),
+            }
+        else:
+            logger.warning(f"Outbox job {job.id} failed, attempt {job.attempts}: {error}")
+            update = {
+                "available_at": datetime.now() + self._backoff(job.attempts),
+                "lease_owner": None,
+                "last_error": str(error),
+            }
+        self.collections.outbox.update_one(
+            {"id": job.id, "lease_owner": self.worker_id}, {"$set": update}
+        )
+
+    def _backoff(self, attempts: int) -> timedelta:
+        """Exponential backoff with full jitter."""
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        return delay * random.random()
+
+
+def main() -> None:
+    """
+    Run an outbox worker with the MongoDB settings from the environment.
+    """
+    from pymongo.mongo_client import MongoClient
+    from pymongo.server_api import ServerApi
+
+    logging.basicConfig(level=logging.INFO)
+    mongodb_password = os.environ["MONGODB_PASSWORD"]
+    mongodb_username = os.environ["MONGODB_USERNAME"]
+    mongodb_host = os.environ["MONGODB_HOST"]
+    uri = f"mongodb+srv://{mongodb_username}:{mongodb_password}@{mongodb_host}/?retryWrites=true&w=majority"
+    client: MongoClient = MongoClient(uri, server_api=ServerApi("1"))
+
+    ensure_outbox_indexes(client)
+    worker = OutboxWorker(client)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    try:
+        worker.run_forever()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
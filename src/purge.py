@@ -0,0 +1,122 @@
+"""Cascading purge of users and everything stored about them.
+
+A purge deletes the magic links, sessions and auth events of the users, their
+queued emails in the outbox, which contain their email address and magic
+links, the email lookups of the sharded layout, and then the users themselves. Users
+are purged in batches with one `delete_many` per collection and batch, on
+the `user_id` indexes created by `ensure_indexes`, `ensure_session_indexes`
+`ensure_event_indexes` and `ensure_outbox_indexes`. The users are deleted last, so a purge that
+fails halfway can be repeated.
+"""
+
+import logging
+from typing import Any, Iterable, Iterator, Optional
+
+from src.db import USERS, ClientLike, CollectionRegistry, get_registry
+from src.models import PurgeReport
+
+logger = logging.getLogger(__name__)
+
+
+def purge_user(client: ClientLike, user_id: str, use_transaction: bool = False) -> PurgeReport:
+    """
+    Delete a user with all their magic links, sessions, events and queued emails.
+    """
+    return purge_users(client, user_ids=[user_id], use_transaction=use_transaction)
+
+
+def purge_users(
+    client: ClientLike,
+    user_ids: Optional[Iterable[str]] = None,
+    query: Optional[dict[str, Any]] = None,
+    batch_size: int = 1_000,
+    use_transaction: bool = False,
+) -> PurgeReport:
+    """
+    Delete users with all their magic links, sessions, events and queued emails.
+
+    Args:
+        client: The MongoDB client or collection registry.
+        user_ids: The ids of the users to purge.
+        query: A filter on the users collection selecting the users to purge,
+            e.g. `{"is_verified": False}`. Either `user_ids` or `query` is required.
+        batch_size (int): Number of users deleted per batch.
+        use_transaction (bool): Whether to delete every batch in a transaction.
+            Requires a replica set or sharded cluster.
+
+    Returns:
+        PurgeReport: The number of removed documents per collection.
+    """
+    if (user_ids is None) == (query is None):
+        raise ValueError("Pass either user_ids or query.")
+    registry = get_registry(client)
+    report = PurgeReport()
+    if user_ids is not None:
+        batches = _batches(iter(user_ids), batch_size)
+    else:
+        cursor = registry.users.find(registry.scope(query or {}), {"_id": 0, "id": 1})
+        # Materialize the ids, as deleting while iterating the cursor could skip users.
+        batches = _batches(iter([user["id"] for user in cursor]), batch_size)
+    for batch in batches:
+        if use_transaction:
+            with registry.client.start_session() as session:
+                session.with_transaction(
+                    lambda transaction: _purge_batch(registry, batch, report, transaction)
+                )
+        else:
+            _purge_batch(registry, batch, report)
+    logger.info(f"Purged {report.users} users: {report.model_dump()}")
+    return report
+
+
+def _purge_batch(
+    registry: CollectionRegistry,
+    user_ids: list[str],
+    report: PurgeReport,
+    session: Optional[Any] = None,
+) -> None:
+    """
+    Delete a batch of users and their related documents, adding the counts to `report`.
+
+    The counts are only added once all deletes succeeded, so a retried
+    transaction does not count twice.
+    """
+    by_user = registry.scope({"user_id": {"$in": user_ids}})
+    counts = PurgeReport()
+    counts.magic_links = registry.magic_links.delete_many(by_user, session=session).deleted_count
+    counts.sessions = registry.sessions.delete_many(by_user, session=session).deleted_count
+    counts.events = registry.events.delete_many(by_user, session=session).deleted_count
+    users = registry.scope({"id": {"$in": user_ids}})
+    emails = {
+        email
+        for user in registry.users.find(users, {"_id": 0, "email": 1}, session=session)
+        for email in (user["email"], registry.email_normalizer(user["email"]))
+    }
+    # Jobs queued before they carried a user id are matched by recipient.
+    counts.outbox = registry.outbox.delete_many(
+        registry.scope(
+            {"$or": [{"user_id": {"$in": user_ids}}, {"to_email": {"$in": list(emails)}}]}
+        ),
+        session=session,
+    ).deleted_count
+    if registry.sharded:
+        counts.user_emails = registry.user_emails.delete_many(
+            registry.scope({"email": {"$in": list(emails)}}), session=session
+        ).deleted_count
+    counts.users = registry.users.delete_many(users, session=session).deleted_count
+    if registry.user_cache is not None:
+        for user_id in user_ids:
+            registry.user_cache.invalidate(registry.cache_key(USERS, user_id))
+    for field, count in counts.model_dump().items():
+        setattr(report, field, getattr(report, field) + count)
+
+
+def _batches(user_ids: Iterator[str], batch_size: int) -> Iterator[list[str]]:
+    batch: list[str] = []
+    for user_id in user_ids:
+        batch.append(user_id)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
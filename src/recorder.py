@@ -0,0 +1,204 @@
+"""Opt-in recorder of auth traffic, for replaying it with `benchmarks.replay`.
+
+With `StreamlitMagicLink(..., recorder=TraceRecorder("auth-trace.jsonl"))`,
+every rerun, sign in, magic link request, profile update, sign out and
+deletion is appended to a JSON lines trace, with the `src.utils` helpers it
+calls nested below it. An entry holds the operation, when it started, its
+duration, its outcome, and the session, email, user id and token as keyed
+hashes. The hashes are keyed with a random salt per recorder, so a trace
+cannot be matched against known emails, and never contains tokens or
+emails in clear.
+
+The helpers are also recorded when called within `recorder.recording()`:
+
+    with recorder.recording():
+        get_user_by_id(mongo_client, user_id)
+
+Without a recorder, a helper call costs one context variable lookup more.
+"""
+
+import atexit
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import IO, Any, Callable, Iterator, Optional, TypeVar, cast
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+IDENTIFIERS = ("session", "email", "user_id", "token")
+
+
+class TraceEntry(BaseModel):
+    """Class for a recorded operation"""
+    op: str
+    at: float
+    duration_ms: float = 0.0
+    outcome: str = "ok"
+    error: Optional[str] = None
+    depth: int = 0
+    session: Optional[str] = None
+    email: Optional[str] = None
+    user_id: Optional[str] = None
+    token: Optional[str] = None
+    fields: Optional[list[str]] = None
+
+
+# The recorder of the running operation, and its entry, if there is one.
+_current: ContextVar[Optional[tuple["TraceRecorder", Optional[TraceEntry]]]] = ContextVar(
+    "trace_recorder", default=None
+)
+
+
+class TraceRecorder:
+    """
+    Writer of an anonymized trace of auth operations.
+
+    Attributes:
+        path (str): The JSON lines file the entries are appended to. Without it, the
+            entries are kept in `entries`, e.g. for a replay.
+        entries (list[TraceEntry]): The recorded entries, when there is no path.
+        written (int): Number of recorded entries.
+    """
+
+    def __init__(self, path: Optional[str] = None, salt: Optional[bytes] = None):
+        self.path = path
+        self.entries: list[TraceEntry] = []
+        self.written = 0
+        self._salt = salt or os.urandom(16)
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._file: Optional[IO[str]] = None
+        if path:
+            self._file = open(path, "a", encoding="utf-8")
+            atexit.register(self.close)
+
+    def anonymize(self, value: Optional[str]) -> Optional[str]:
+        """The keyed hash of an identifier, the same for the same value within a trace"""
+        if value is None:
+            return None
+        return hashlib.blake2b(value.encode(), key=self._salt, digest_size=8).hexdigest()
+
+    @contextmanager
+    def recording(self) -> Iterator[None]:
+        """Record the `src.utils` helpers called in the block."""
+        reset = _current.set((self, None))
+        try:
+            yield
+        finally:
+            _current.reset(reset)
+
+    @contextmanager
+    def operation(self, op: str, **identifiers: Any) -> Iterator[TraceEntry]:
+        """
+        Record an operation with the duration of the block, nested below the
+        running operation if there is one.
+
+        Args:
+            op (str): The name of the operation.
+            identifiers: The `session`, `email`, `user_id` or `token` of the operation,
+                which are hashed, or the names of the updated `fields`.
+        """
+        parent = _current.get()
+        parent_entry = parent[1] if parent is not None else None
+        entry = TraceEntry(
+            op=op,
+            at=time.monotonic() - self._started,
+            depth=parent_entry.depth + 1 if parent_entry is not None else 0,
+            session=parent_entry.session if parent_entry is not None else None,
+        )
+        self._annotate(entry, identifiers)
+        reset = _current.set((self, entry))
+        started = time.perf_counter()
+        try:
+            yield entry
+        except Exception as error:
+            entry.outcome = "error"
+            entry.error = type(error).__name__
+            raise
+        finally:
+            entry.duration_ms = (time.perf_counter() - started) * 1000
+            _current.reset(reset)
+            self._write(entry)
+
+    def close(self) -> None:
+        """Flush and close the trace file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _annotate(self, entry: TraceEntry, values: dict[str, Any]) -> None:
+        for name, value in values.items():
+            if value is None:
+                continue
+            if name in IDENTIFIERS:
+                value = self.anonymize(str(value))
+            setattr(entry, name, value)
+
+    def _write(self, entry: TraceEntry) -> None:
+        with self._lock:
+            self.written += 1
+            if self.path is None:
+                self.entries.append(entry)
+            elif self._file is not None:
+                self._file.write(entry.model_dump_json(exclude_none=True) + "\n")
+
+
+def annotate(**values: Any) -> None:
+    """
+    Set the outcome or identifiers of the running operation, if it is recorded.
+    Values that are `None` are ignored, identifiers are hashed.
+    """
+    current = _current.get()
+    if current is not None and current[1] is not None:
+        current[0]._annotate(current[1], values)
+
+
+def traced(function: F) -> F:
+    """
+    Record the calls of a helper while a recorder is active, with its
+    `email`, `user_id` and `token` argument. A helper returning `None` has
+    the outcome `none`.
+    """
+    signature = inspect.signature(function)
+    identifiers = [name for name in ("email", "user_id", "token") if name in signature.parameters]
+
+    @functools.wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        current = _current.get()
+        if current is None:
+            return function(*args, **kwargs)
+        arguments = signature.bind_partial(*args, **kwargs).arguments
+        values = {name: arguments.get(name) for name in identifiers}
+        with current[0].operation(function.__name__, **values) as entry:
+            result = function(*args, **kwargs)
+            if result is None:
+                entry.outcome = "none"
+            return result
+
+    return cast(F, wrapper)
+
+
+def load_trace(path: str) -> list[TraceEntry]:
+    """Read the entries of a trace file, skipping lines that are not valid entries."""
+    entries = []
+    with open(path, encoding="utf-8") as file:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                entries.append(TraceEntry.model_validate(json.loads(line)))
+            except ValueError as error:
+                logger.warning(f"Skipping line {number} of {path}: {error}")
+    return entries
@@ -0,0 +1,321 @@
+"""Delivery of emails through several mail providers.
+
+A `DeliveryRouter` is a `MailTransport` over several transports. It keeps
+the latency and outcome of the recent sends of every provider, sends
+through the healthiest one, the one with the fewest errors and then the
+lowest median latency, and fails over to the next one when a send fails.
+
+With `hedge_percentile`, a send that takes longer than that latency
+percentile of its provider is sent again through the next provider, and
+the first copy to be accepted wins. To keep users from getting two emails:
+
+- Both copies are sent with `send_idempotent` and the same idempotency key,
+  so transports that support it mark them as one message (`SMTPTransport`
+  sets the same `Message-ID`).
+- A hedge that has not started yet when the first copy is accepted is not
+  sent.
+- An email accepted by any provider is not sent again within
+  `dedup_window`, e.g. when a caller retries after a timeout.
+- At most a `hedge_budget` fraction of the sends is hedged.
+
+    router = DeliveryRouter(
+        {"mailjet": MailjetTransport(), "smtp": SMTPTransport("smtp.internal")},
+        hedge_percentile=95,
+    )
+    magic_link = StreamlitMagicLink(mongo_client, base_url, mail_transport=router)
+"""
+
+import hashlib
+import logging
+import statistics
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Mapping, Optional
+
+from src.transports import MailTransport
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderStats:
+    """
+    Rolling latency and outcome of the recent sends of a provider.
+
+    Attributes:
+        window (float): Seconds a send is kept in the statistics, so a provider
+            that failed recovers once its errors are older.
+        max_samples (int): Maximum number of sends kept.
+    """
+
+    def __init__(self, window: float = 60.0, max_samples: int = 200):
+        self.window = window
+        self.max_samples = max_samples
+        self._samples: deque[tuple[float, float, bool]] = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, ok: bool) -> None:
+        """Add the latency in seconds and the outcome of a send."""
+        with self._lock:
+            self._samples.append((time.monotonic(), latency, ok))
+
+    def error_rate(self) -> float:
+        """The fraction of the recent sends that failed"""
+        samples = self._recent()
+        if not samples:
+            return 0.0
+        return sum(1 for _, _, ok in samples if not ok) / len(samples)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """The latency percentile in seconds of the recent successful sends, if there are any"""
+        latencies = sorted(latency for _, latency, ok in self._recent() if ok)
+        if not latencies:
+            return None
+        if len(latencies) == 1:
+            return latencies[0]
+        cut = min(max(round(percentile), 1), 99)
+        return statistics.quantiles(latencies, n=100, method="inclusive")[cut - 1]
+
+    def __len__(self) -> int:
+        return len(self._recent())
+
+    def snapshot(self) -> dict[str, Any]:
+        """
+        Get the number of recent sends, the error rate and the latency percentiles
+        in milliseconds, for monitoring.
+        """
+        p50 = self.percentile(50)
+        p95 = self.percentile(95)
+        return {
+            "samples": len(self),
+            "error_rate": self.error_rate(),
+            "p50_ms": p50 * 1000 if p50 is not None else None,
+            "p95_ms": p95 * 1000 if p95 is not None else None,
+        }
+
+    def _recent(self) -> list[tuple[float, float, bool]]:
+        expired = time.monotonic() - self.window
+        with self._lock:
+            while self._samples and self._samples[0][0] < expired:
+                self._samples.popleft()
+            return list(self._samples)
+
+
+def idempotency_key(to_email: str, body: str, subject: str) -> str:
+    """
+    Get the idempotency key of an email: the same email gets the same key.
+    Magic link emails contain their token, so every link has its own key.
+    """
+    content = "\0".join((to_email, subject, body)).encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+class DeliveryRouter(MailTransport):
+    """
+    Mail transport sending through the healthiest of several providers, with
+    failover and optional hedged sends.
+
+    Attributes:
+        providers (dict[str, MailTransport]): The transports by provider name. On
+            equal health, the first one is preferred.
+        stats (dict[str, ProviderStats]): The rolling statistics by provider name.
+        hedge_percentile (float): Latency percentile of a provider after which a send
+            is hedged through the next provider. Without it, sends are not hedged.
+        min_samples (int): Number of recent successful sends of a provider needed before
+            its sends are hedged.
+        hedge_budget (float): Maximum fraction of the sends that are hedged.
+        dedup_window (float): Seconds an accepted email is not sent again.
+        sends (int): Number of sends.
+        hedges (int): Number of hedged copies sent.
+        failovers (int): Number of sends retried through another provider after an error.
+        deduplicated (int): Number of sends and hedges skipped because the email was accepted.
+    """
+
+    def __init__(
+        self,
+        providers: Mapping[str, MailTransport],
+        window: float = 60.0,
+        hedge_percentile: Optional[float] = None,
+        min_samples: int = 20,
+        hedge_budget: float = 0.1,
+        dedup_window: float = 600.0,
+        max_workers: int = 32,
+    ):
+        if not providers:
+            raise ValueError("A delivery router needs at least one provider.")
+        self.providers = dict(providers)
+        self.stats = {name: ProviderStats(window=window) for name in self.providers}
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.hedge_budget = hedge_budget
+        self.dedup_window = dedup_window
+        self.max_workers = max_workers
+        self.sends = 0
+        self.hedges = 0
+        self.failovers = 0
+        self.deduplicated = 0
+        self._delivered: OrderedDict[str, float] = OrderedDict()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def send(self, to_email: str, body: str, subject: str) -> None:
+        self.send_idempotent(to_email, body, subject, idempotency_key(to_email, body, subject))
+
+    def send_idempotent(self, to_email: str, body: str, subject: str, idempotency_key: str) -> None:
+        """
+        Send an email through the healthiest provider, failing over to the others.
+
+        Raises:
+            Exception: The error of the last provider, if all providers failed.
+        """
+        with self._lock:
+            self.sends += 1
+        if self._is_delivered(idempotency_key):
+            logger.info("The email was already accepted by a provider, not sending it again.")
+            return
+        providers = self.ranked()
+        if self.hedge_percentile is None:
+            self._send_sequentially(providers, to_email, body, subject, idempotency_key)
+        else:
+            self._send_hedged(providers, to_email, body, subject, idempotency_key)
+
+    def ranked(self) -> list[str]:
+        """The provider names from the healthiest: fewest errors, then lowest median latency"""
+
+        def health(item: tuple[int, str]) -> tuple[float, float, int]:
+            index, name = item
+            stats = self.stats[name]
+            return (stats.error_rate(), stats.percentile(50) or 0.0, index)
+
+        return [name for _, name in sorted(enumerate(self.providers), key=health)]
+
+    def snapshot(self) -> dict[str, Any]:
+        """
+        Get the counters of the router and the statistics of every provider, for monitoring.
+        """
+        with self._lock:
+            counters = {
+                "sends": self.sends,
+                "hedges": self.hedges,
+                "failovers": self.failovers,
+                "deduplicated": self.deduplicated,
+            }
+        return {
+            **counters,
+            "providers": {name: self.stats[name].snapshot() for name in self.ranked()},
+        }
+
+    def close(self) -> None:
+        """Wait for the running sends and close all providers."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for transport in self.providers.values():
+            transport.close()
+
+    def _send_sequentially(
+        self, providers: list[str], to_email: str, body: str, subject: str, key: str
+    ) -> None:
+        for number, name in enumerate(providers):
+            if number:
+                with self._lock:
+                    self.failovers += 1
+            try:
+                self._attempt(name, to_email, body, subject, key)
+                return
+            except Exception as error:
+                if number == len(providers) - 1:
+                    raise
+                logger.warning(f"Sending through {name} failed ({error!r}), failing over.")
+
+    def _send_hedged(
+        self, providers: list[str], to_email: str, body: str, subject: str, key: str
+    ) -> None:
+        remaining = deque(providers)
+        pending: dict[Future, str] = {}
+        last_error: Optional[BaseException] = None
+        hedged = False
+
+        def launch() -> None:
+            name = remaining.popleft()
+            pending[self._submit(name, to_email, body, subject, key)] = name
+
+        launch()
+        while pending:
+            timeout = None
+            if not hedged and remaining:
+                timeout = self._hedge_delay(next(iter(pending.values())))
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                if self._take_hedge():
+                    logger.info(f"Sending through {pending[next(iter(pending))]} is slow, hedging.")
+                    launch()
+                continue
+            for future in done:
+                name = pending.pop(future)
+                error = future.exception()
+                if error is None:
+                    return
+                last_error = error
+                logger.warning(f"Sending through {name} failed ({error!r}).")
+            if not pending and remaining:
+                with self._lock:
+                    self.failovers += 1
+                launch()
+        assert last_error is not None
+        raise last_error
+
+    def _submit(self, name: str, to_email: str, body: str, subject: str, key: str) -> Future:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="delivery-router"
+                )
+            executor = self._executor
+        return executor.submit(self._attempt, name, to_email, body, subject, key)
+
+    def _attempt(self, name: str, to_email: str, body: str, subject: str, key: str) -> None:
+        """Send through one provider, unless another copy was accepted already."""
+        if self._is_delivered(key):
+            return
+        started = time.perf_counter()
+        try:
+            self.providers[name].send_idempotent(to_email, body, subject, key)
+        except Exception:
+            self.stats[name].record(time.perf_counter() - started, ok=False)
+            raise
+        self.stats[name].record(time.perf_counter() - started, ok=True)
+        self._mark_delivered(key)
+
+    def _hedge_delay(self, name: str) -> Optional[float]:
+        """Seconds after which a send through a provider is hedged, if it has enough samples"""
+        assert self.hedge_percentile is not None
+        stats = self.stats[name]
+        if len(stats) < self.min_samples:
+            return None
+        return stats.percentile(self.hedge_percentile)
+
+    def _take_hedge(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.hedge_budget * self.sends:
+                return False
+            self.hedges += 1
+            return True
+
+    def _is_delivered(self, key: str) -> bool:
+        with self._lock:
+            delivered = key in self._delivered
+            if delivered:
+                self.deduplicated += 1
+            return delivered
+
+    def _mark_delivered(self, key: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._delivered[key] = now
+            self._delivered.move_to_end(key)
+            while self._delivered and next(iter(self._delivered.values())) < now - self.dedup_window:
+                self._delivered.popitem(last=False)
@@ -0,0 +1,468 @@
+"""The magic link flows, independent of Streamlit.
+
+A `MagicLinkService` issues and redeems magic links, keeps signed in users
+in sync with the database, and updates, signs out and deletes them. It
+holds no per-session state: the caller passes what it stored for the user,
+e.g. in a cookie, and stores what the service returns. One service is
+built per process and shared by all sessions and threads, so it can run
+in a FastAPI endpoint or a worker as well:
+
+    service = MagicLinkService(mongo_client, base_url)
+
+    @app.post("/login")
+    def login(email: str) -> None:
+        service.request_link(email)
+
+    @app.get("/redeem")
+    def redeem(token: str) -> dict:
+        signed_in = service.sign_in(token)
+        ...
+
+`StreamlitMagicLink` is the per-session adapter for Streamlit apps. The
+service keeps its caches in the collection registry, so services built for
+the same registry share them.
+"""
+
+import copy
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Any, NamedTuple, Optional, cast
+
+from src.breaker import CircuitOpenError
+from src.db import ClientLike, get_registry
+from src.events import (
+    LINK_ISSUED,
+    LINK_REDEEMED,
+    SIGNED_OUT,
+    SIGNED_OUT_EVERYWHERE,
+    USER_DELETED,
+    EventLog,
+    hash_token,
+)
+from src.models import MagicLink, User
+from src.outbox import enqueue_email
+from src.purge import purge_user
+from src.recorder import TraceRecorder, annotate
+from src.sessions import (
+    create_session,
+    has_sessions,
+    is_session_active,
+    revoke_session,
+    revoke_user_sessions,
+)
+from src.tokens import get_negative_token_cache, is_well_formed_token
+from src.transports import MailTransport, get_default_transport
+from src.utils import (
+    create_or_retrieve_user,
+    get_active_magic_link,
+    get_magic_link_by_token,
+    get_user_by_id,
+    get_user_fields,
+    insert_magic_link,
+    invalidate_magic_links,
+    redeem_magic_link,
+    update_magic_link,
+    update_user_fields,
+)
+
+if TYPE_CHECKING:
+    from pymongo.client_session import ClientSession
+
+    from src.coalescer import InsertCoalescer
+
+logger = logging.getLogger(__name__)
+
+# Fields of a stored user that apps authorize with, like `src.guard`, so they
+# are checked against the database on every sync, whatever the stored version.
+CHECKED_FIELDS = ("email", "is_verified", "is_payed_user")
+
+
+class SignIn(NamedTuple):
+    """A user signed in with a magic link, and their new session."""
+
+    user: User
+    session_id: str
+
+
+class SyncResult(NamedTuple):
+    """
+    The stored user of a session checked against the database.
+
+    When `changed` is set, the caller stores `user` and `session_id`, or
+    forgets the user when `user` is `None`.
+    """
+
+    user: Optional[User]
+    session_id: Optional[str]
+    changed: bool
+
+
+class _SignInCache:
+    """Sign ins by session and token, reused for the reruns of the session for a few seconds."""
+
+    def __init__(self, max_size: int = 10_000):
+        self.max_size = max_size
+        self._sign_ins: dict[tuple[str, str], tuple[float, SignIn]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, session: str, token: str) -> Optional[SignIn]:
+        with self._lock:
+            cached = self._sign_ins.get((session, token))
+        if cached is None or cached[0] <= time.monotonic():
+            return None
+        return cached[1]
+
+    def set(self, session: str, token: str, sign_in: SignIn, ttl: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if len(self._sign_ins) >= self.max_size:
+                self._sign_ins = {
+                    key: value for key, value in self._sign_ins.items() if value[0] > now
+                }
+            self._sign_ins[(session, token)] = (now + ttl, sign_in)
+
+
+class MagicLinkService:
+    """
+    Thread-safe magic link flows over shared storage, cache and mail resources.
+
+    Attributes:
+        collections (CollectionRegistry): The registry with the database and collection names and
+            options, and the per-process caches.
+        base_url (str): The base URL of the application, used for generating magic links.
+        mail_transport (MailTransport): The transport used to send the magic links. Defaults to
+            Mailjet.
+        use_outbox (bool): Whether to write magic link emails to the outbox collection instead of
+            sending them directly. The emails are then sent by a worker, see `src.outbox`.
+        use_transactions (bool): Whether to insert the magic link and its outbox job in one transaction.
+            Requires a replica set or sharded cluster.
+        outbox_fallback (bool): Whether to write the email to the outbox when the mail transport fails fast
+            because its circuit breaker is open.
+        reuse_window (timedelta): Repeated requests within this window reuse the user's outstanding
+            magic link instead of sending another email. `None` always sends a new link.
+        event_log (EventLog): An optional audit log, see `src.events`.
+        link_coalescer (InsertCoalescer): An optional writer batching the magic link inserts of
+            concurrent requests, see `src.coalescer`.
+        recorder (TraceRecorder): An optional recorder of the operations, see `src.recorder`.
+        rerun_ttl (float): Seconds a sign in is reused for the reruns of the same session with the
+            same token, see `sign_in`. The sign ins are shared by the services of a registry.
+        legacy_sessions_until (datetime): Until when users stored before sessions were introduced,
+            without a session id, get a session instead of being signed out. Only users that never
+            had a session are upgraded. `None` signs them out.
+    """
+
+    def __init__(
+        self,
+        client: ClientLike,
+        base_url: str,
+        mail_transport: Optional[MailTransport] = None,
+        use_outbox: bool = False,
+        use_transactions: bool = False,
+        outbox_fallback: bool = False,
+        reuse_window: Optional[timedelta] = timedelta(minutes=1),
+        event_log: Optional[EventLog] = None,
+        link_coalescer: Optional["InsertCoalescer"] = None,
+        recorder: Optional[TraceRecorder] = None,
+        rerun_ttl: float = 1.0,
+        legacy_sessions_until: Optional[datetime] = None,
+    ):
+        self.collections = get_registry(client)
+        self.base_url = base_url
+        self.mail_transport = mail_transport or get_default_transport()
+        self.use_outbox = use_outbox
+        self.use_transactions = use_transactions
+        self.outbox_fallback = outbox_fallback
+        self.reuse_window = reuse_window
+        self.event_log = event_log
+        self.link_coalescer = link_coalescer
+        self.recorder = recorder
+        self.rerun_ttl = rerun_ttl
+        self.legacy_sessions_until = legacy_sessions_until
+        self._sign_ins = self.collections.resource("magic_link_sign_ins", _SignInCache)
+
+    def replace(self, **changes: Any) -> "MagicLinkService":
+        """
+        A copy of the service with some attributes replaced, e.g. wrapped
+        collections, sharing the caches of this service.
+        """
+        service = copy.copy(self)
+        for name, value in changes.items():
+            if not hasattr(self, name):
+                raise AttributeError(f"MagicLinkService has no attribute {name!r}")
+            setattr(service, name, value)
+        return service
+
+    def request_link(self, email: str) -> str:
+        """
+        Send a magic link to a user, creating the user if needed.
+
+        Returns:
+            str: The outcome: `sent`, `queued` or `reused`.
+
+        Raises:
+            CircuitOpenError: If the mail transport is unavailable and there is no outbox fallback.
+        """
+        user = create_or_retrieve_user(self.collections, email)
+        if self.reuse_window and get_active_magic_link(
+            self.collections, user.id, issued_after=datetime.now() - self.reuse_window
+        ):
+            logger.info("An outstanding magic link was sent recently, not sending another one.")
+            self._record(LINK_ISSUED, outcome="reused", user_id=user.id)
+            return "reused"
+        outcome = "sent"
+        if self.use_outbox:
+            magic_link = self._enqueue_magic_link(user.id, email)
+            outcome = "queued"
+        else:
+            magic_link = insert_magic_link(self.collections, user.id, coalescer=self.link_coalescer)
+            try:
+                self.mail_transport.send(
+                    to_email=email,
+                    body=self.magic_link_body(magic_link),
+                    subject="Your Magic Link",
+                )
+            except CircuitOpenError:
+                if not self.outbox_fallback:
+                    self._discard_magic_link(magic_link)
+                    self._record(LINK_ISSUED, outcome="unavailable", user_id=user.id, token=magic_link.token)
+                    raise
+                logger.warning("Mail transport is unavailable, writing the magic link email to the outbox.")
+                enqueue_email(
+                    self.collections,
+                    to_email=email,
+                    body=self.magic_link_body(magic_link),
+                    subject="Your Magic Link",
+                    user_id=user.id,
+                )
+                outcome = "queued"
+            except Exception:
+                self._discard_magic_link(magic_link)
+                self._record(LINK_ISSUED, outcome="failed", user_id=user.id, token=magic_link.token)
+                raise
+        logging.info(f"Magic link {hash_token(magic_link.token)} sent to {email}.")
+        self._record(LINK_ISSUED, outcome=outcome, user_id=user.id, token=magic_link.token)
+        return outcome
+
+    def redeem(self, token: str) -> Optional[User]:
+        """
+        Validate a magic link by its token and mark it as used, and return the
+        user if it was valid.
+
+        The link is marked as used with a single write that only matches an
+        unused and unexpired link, so of concurrent redemptions only one
+        succeeds. Malformed tokens and tokens that were recently not found are
+        rejected without a database query.
+        """
+        if not is_well_formed_token(token):
+            logging.debug("Ignoring a malformed magic link token.")
+            annotate(outcome="malformed")
+            return None
+        unknown_tokens = get_negative_token_cache(self.collections)
+        if token in unknown_tokens:
+            annotate(outcome="not_found")
+            return None
+        magic_link = get_magic_link_by_token(self.collections, token)
+        if magic_link is None:
+            unknown_tokens.add(token)
+
+        if not self.validate(magic_link, token):
+            self._record(
+                LINK_REDEEMED,
+                outcome=self.magic_link_outcome(magic_link),
+                user_id=magic_link.user_id if magic_link else None,
+                token=token,
+            )
+            return None
+
+        magic_link = cast(MagicLink, magic_link)
+
+        user = get_user_by_id(self.collections, magic_link.user_id)
+        if not user:
+            logging.warning(f"User with id {magic_link.user_id} not found.")
+            self._record(LINK_REDEEMED, outcome="user_not_found", user_id=magic_link.user_id, token=token)
+            return None
+
+        if redeem_magic_link(self.collections, token) is None:
+            logging.warning(f"Magic link {hash_token(token)} was redeemed concurrently.")
+            self._record(LINK_REDEEMED, outcome="used", user_id=user.id, token=token)
+            return None
+        invalidate_magic_links(self.collections, user.id, except_token=token)
+
+        if not user.is_verified:
+            user = update_user_fields(self.collections, user.id, is_verified=True) or user
+        self._record(LINK_REDEEMED, outcome="valid", user_id=user.id, token=token)
+        return user
+
+    def sign_in(self, token: str, session: Optional[str] = None) -> Optional[SignIn]:
+        """
+        Redeem a magic link and start a session for its user.
+
+        Streamlit may rerun the script while a link is redeemed, and the rerun
+        opens the same link again. Pass a `session` id, e.g. a random id kept
+        in the session state, and its reruns within `rerun_ttl` seconds get the
+        same sign in instead of an invalid link. Other sessions can never
+        redeem the link again.
+
+        Returns:
+            SignIn: The user and the id of the new session, or `None` if the link is not valid.
+        """
+        if session is not None:
+            cached = self._sign_ins.get(session, token)
+            if cached is not None:
+                annotate(outcome="rerun")
+                return cached
+        user = self.redeem(token)
+        if not user:
+            return None
+        signed_in = SignIn(user, create_session(self.collections, user.id).id)
+        if session is not None:
+            self._sign_ins.set(session, token, signed_in, self.rerun_ttl)
+        return signed_in
+
+    def sync(self, stored_user: Optional[dict[str, Any]]) -> SyncResult:
+        """
+        Check a stored user, with their `id`, `version` and `session_id`, against the database.
+
+        The user is dropped if they were not found, or if their session does
+        not exist, belongs to another user, expired or was revoked, see
+        `src.sessions.is_session_active`, which usually needs no database
+        access. Users stored before sessions were introduced get a session
+        here until `legacy_sessions_until`, if they never had one.
+
+        Only the version and the `CHECKED_FIELDS` of the user are read first.
+        If they match the stored ones, the user is not loaded and nothing
+        changes. A stored user edited by the client, e.g. in a cookie, is
+        therefore corrected on the next sync.
+        """
+        if not stored_user:
+            return SyncResult(None, None, changed=False)
+        user_id = stored_user["id"]
+        session_id = stored_user.get("session_id")
+        session_id = session_id if isinstance(session_id, str) else None
+        if session_id:
+            if not is_session_active(self.collections, session_id, user_id):
+                return SyncResult(None, None, changed=True)
+        elif not self._may_upgrade_legacy_user(user_id):
+            return SyncResult(None, None, changed=True)
+        current = get_user_fields(self.collections, user_id, *CHECKED_FIELDS)
+        if current is None:
+            return SyncResult(None, None, changed=True)
+        version = current["version"]
+        if session_id and all(stored_user.get(name) == value for name, value in current.items()):
+            return SyncResult(None, session_id, changed=False)
+        user = get_user_by_id(self.collections, user_id, min_version=version)
+        if not user:
+            return SyncResult(None, None, changed=True)
+        if not session_id:
+            session_id = create_session(self.collections, user.id).id
+        return SyncResult(user, session_id, changed=True)
+
+    def update_user(
+        self, user_id: str, expected_version: Optional[int] = None, **fields: Any
+    ) -> Optional[User]:
+        """
+        Update fields of a user.
+
+        Raises:
+            VersionConflictError: If the user was changed since `expected_version`.
+        """
+        return update_user_fields(
+            self.collections, user_id, expected_version=expected_version, **fields
+        )
+
+    def sign_out(self, user_id: Optional[str], session_id: Optional[str] = None) -> None:
+        """Revoke a session of a user"""
+        if session_id:
+            revoke_session(self.collections, session_id)
+        self._record(SIGNED_OUT, user_id=user_id)
+
+    def sign_out_everywhere(self, user_id: str) -> None:
+        """Revoke all sessions of a user"""
+        revoke_user_sessions(self.collections, user_id)
+        self._record(SIGNED_OUT_EVERYWHERE, user_id=user_id)
+
+    def delete_user(self, user_id: str) -> None:
+        """Delete a user with their magic links, sessions and events"""
+        purge_user(self.collections, user_id)
+        self._record(USER_DELETED, user_id=user_id)
+
+    def validate(self, magic_link: Optional[MagicLink], token: str) -> bool:
+        """Validate a loaded magic link, logging why it is not valid."""
+        outcome = self.magic_link_outcome(magic_link)
+        if outcome == "not_found":
+            logging.warning(f"Magic link {hash_token(token)} not found.")
+        elif outcome == "used":
+            logging.warning(f"Magic link {hash_token(token)} is already used.")
+        elif outcome == "expired":
+            logging.warning(f"Magic link {hash_token(token)} is expired.")
+        return outcome == "valid"
+
+    @staticmethod
+    def magic_link_outcome(magic_link: Optional[MagicLink]) -> str:
+        """The redemption outcome of a magic link: valid, not_found, used or expired"""
+        if not magic_link:
+            return "not_found"
+        if magic_link.is_used:
+            return "used"
+        if magic_link.expiration_time < datetime.now():
+            return "expired"
+        return "valid"
+
+    def magic_link_body(self, magic_link: MagicLink) -> str:
+        """The body of the magic link email"""
+        return f"Click the link to sign in: {self.base_url}?token={magic_link.token}"
+
+    def _enqueue_magic_link(self, user_id: str, email: str) -> MagicLink:
+        """
+        Insert a magic link and write its email to the outbox.
+
+        With `use_transactions`, both writes are committed atomically, so a
+        magic link never exists without its email.
+        """
+
+        def issue(session: Optional["ClientSession"] = None) -> MagicLink:
+            magic_link = insert_magic_link(self.collections, user_id, session=session)
+            enqueue_email(
+                self.collections,
+                to_email=email,
+                body=self.magic_link_body(magic_link),
+                subject="Your Magic Link",
+                session=session,
+                user_id=user_id,
+            )
+            return magic_link
+
+        if not self.use_transactions:
+            return issue()
+        with self.collections.client.start_session() as session:
+            return session.with_transaction(issue)
+
+    def _may_upgrade_legacy_user(self, user_id: str) -> bool:
+        """
+        Whether a stored user without a session id gets a session: only before
+        `legacy_sessions_until`, and only if the user never had a session, so
+        dropping the session id from a cookie does not undo a sign out.
+        """
+        if self.legacy_sessions_until is None or datetime.now() >= self.legacy_sessions_until:
+            return False
+        return not has_sessions(self.collections, user_id)
+
+    def _discard_magic_link(self, magic_link: MagicLink) -> None:
+        """Marks a magic link whose email could not be sent as used, so it is not reused."""
+        magic_link.is_used = True
+        update_magic_link(self.collections, magic_link)
+
+    def _record(
+        self,
+        event: str,
+        outcome: Optional[str] = None,
+        user_id: Optional[str] = None,
+        token: Optional[str] = None,
+    ) -> None:
+        """Records an event to the audit log, if there is one, and its outcome to the trace"""
+        annotate(outcome=outcome, user_id=user_id, token=token)
+        if self.event_log is not None:
+            self.event_log.record(event, outcome=outcome, user_id=user_id, token=token)
+
@@ -0,0 +1,262 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+from src.db import ClientLike, get_registry
+from src.models import SESSION_LIFETIME, AuthSession
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_session_indexes(client: ClientLike) -> None:
+    """
+    Create the indexes used to look up and revoke sessions, and the TTL index
+    deleting sessions once they expired.
+    """
+    registry = get_registry(client)
+    tenant = [("tenant", 1)] if registry.tenant is not None else []
+    registry.sessions.create_index(tenant + [("id", 1)], unique=True)
+    registry.sessions.create_index(tenant + [("user_id", 1)])
+    registry.sessions.create_index([("revoked_at", 1)], sparse=True)
+    registry.sessions.create_index([("expires_at", 1)], expireAfterSeconds=0)
+
+
+def create_session(client: ClientLike, user_id: str) -> AuthSession:
+    """
+    Create a session for a signed in user.
+    """
+    registry = get_registry(client)
+    session = AuthSession(user_id=user_id)
+    registry.sessions.insert_one(registry.scope(session.model_dump()))
+    return session
+
+
+def get_session(client: ClientLike, session_id: str) -> Optional[AuthSession]:
+    """
+    Get a session by id. A session stored without an expiry expires
+    `SESSION_LIFETIME` after it was created.
+    """
+    registry = get_registry(client)
+    document = registry.sessions.find_one(registry.scope({"id": session_id}), {"_id": 0})
+    if document is None:
+        return None
+    document.setdefault("expires_at", document["created_at"] + SESSION_LIFETIME)
+    return AuthSession(**document)
+
+
+def has_sessions(client: ClientLike, user_id: str) -> bool:
+    """
+    Check whether a user has any stored session, revoked or not.
+    """
+    registry = get_registry(client)
+    return registry.sessions.find_one(registry.scope({"user_id": user_id}), {"_id": 1}) is not None
+
+
+def is_session_active(client: ClientLike, session_id: str, user_id: str) -> bool:
+    """
+    Check that a session exists, belongs to a user, is not expired and is not revoked.
+
+    Revocations are checked with the per-process revocation filter, and
+    sessions found active are kept in a per-process cache, so checking a
+    session on a rerun usually costs no database access. A revoked session is
+    seen as revoked once the filter picked up its revocation, at most
+    `RevocationFilter.refresh_interval` seconds later.
+    """
+    registry = get_registry(client)
+    if get_revocation_filter(registry).is_revoked(session_id):
+        return False
+    active_sessions = get_active_session_cache(registry)
+    session = active_sessions.get(session_id)
+    if session is None:
+        session = get_session(registry, session_id)
+        if session is None or session.revoked_at is not None:
+            return False
+        active_sessions.set(session)
+    return session.user_id == user_id and session.expires_at > datetime.now()
+
+
+def revoke_session(client: ClientLike, session_id: str) -> bool:
+    """
+    Revoke a single session.
+
+    Returns:
+        bool: Whether the session was found and not revoked yet.
+    """
+    registry = get_registry(client)
+    result = registry.sessions.update_one(
+        registry.scope({"id": session_id, "revoked_at": None}),
+        {"$set": {"revoked_at": datetime.now()}},
+    )
+    get_revocation_filter(registry).add(session_id)
+    return result.modified_count > 0
+
+
+def revoke_user_sessions(client: ClientLike, user_id: str) -> int:
+    """
+    Revoke all sessions of a user, signing them out everywhere.
+
+    Returns:
+        int: The number of revoked sessions.
+    """
+    registry = get_registry(client)
+    query = registry.scope({"user_id": user_id, "revoked_at": None})
+    sessions = list(registry.sessions.find(query, {"id": 1, "expires_at": 1}))
+    result = registry.sessions.update_many(
+        registry.scope({"id": {"$in": [session["id"] for session in sessions]}}),
+        {"$set": {"revoked_at": datetime.now()}},
+    )
+    revocations = get_revocation_filter(registry)
+    for session in sessions:
+        revocations.add(session["id"], session.get("expires_at"))
+    return result.modified_count
+
+
+class ActiveSessionCache:
+    """
+    Per-process cache of the sessions found active, by id.
+
+    A cached session is only used after checking the revocation filter, which
+    keeps every revocation until its session expired, so a session revoked
+    after it was cached is still seen as revoked.
+
+    Attributes:
+        ttl (float): Seconds a session is cached.
+        max_size (int): Maximum number of cached sessions, the oldest are dropped first.
+    """
+
+    def __init__(self, ttl: float = 300.0, max_size: int = 10_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._sessions: OrderedDict[str, tuple[float, AuthSession]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[AuthSession]:
+        """Get a cached session, if it is cached and not stale."""
+        with self._lock:
+            cached = self._sessions.get(session_id)
+            if cached is None:
+                return None
+            if cached[0] <= time.monotonic():
+                del self._sessions[session_id]
+                return None
+            return cached[1]
+
+    def set(self, session: AuthSession) -> None:
+        """Cache an active session."""
+        with self._lock:
+            self._sessions.pop(session.id, None)
+            self._sessions[session.id] = (time.monotonic() + self.ttl, session)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+def get_active_session_cache(client: ClientLike) -> ActiveSessionCache:
+    """
+    Get the cache of active sessions shared by the process for a client or registry.
+    """
+    registry = get_registry(client)
+    return registry.resource("active_sessions", ActiveSessionCache)
+
+
+class RevocationFilter:
+    """
+    Per-process set of revoked session ids.
+
+    The set is refreshed at most every `refresh_interval` seconds by reading
+    only the sessions revoked since the previous refresh, so checking a
+    session on a rerun usually costs no database access. Revocations from
+    other processes are picked up within `refresh_interval`. A revocation is
+    only kept until its session expires, as an expired session is not
+    accepted anyway.
+
+    Attributes:
+        refresh_interval (float): Seconds between refreshes.
+        overlap (timedelta): How far back each refresh looks before the last
+            seen revocation, to pick up revocations committed out of order.
+    """
+
+    def __init__(
+        self,
+        client: ClientLike,
+        refresh_interval: float = 5.0,
+        overlap: timedelta = timedelta(minutes=1),
+    ):
+        self.collections = get_registry(client)
+        self.refresh_interval = refresh_interval
+        self.overlap = overlap
+        self._revoked: dict[str, datetime] = {}
+        self._watermark: Optional[datetime] = None
+        self._refreshed_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def is_revoked(self, session_id: str) -> bool:
+        """
+        Check whether a session is revoked, refreshing the set when it is stale.
+        """
+        if self._is_stale():
+            self.refresh(blocking=self._refreshed_at is None)
+        return session_id in self._revoked
+
+    def add(self, session_id: str, expires_at: Optional[datetime] = None) -> None:
+        """
+        Mark a session revoked by this process. Without `expires_at`, the
+        revocation is kept for the longest a session can still be valid.
+        """
+        self._revoked[session_id] = expires_at or datetime.now() + SESSION_LIFETIME
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    def refresh(self, blocking: bool = True) -> None:
+        """
+        Read the sessions revoked since the last refresh, and forget the
+        revocations of expired sessions.
+
+        Without `blocking`, the refresh is skipped while another thread is
+        refreshing, and the check uses the current set.
+        """
+        if not self._lock.acquire(blocking=blocking):
+            return
+        try:
+            now = datetime.now()
+            query: dict[str, Any] = {"revoked_at": {"$ne": None}, "expires_at": {"$gt": now}}
+            if self._watermark is not None:
+                query = {"revoked_at": {"$gte": self._watermark - self.overlap}}
+            documents = self.collections.sessions.find(
+                self.collections.scope(query),
+                {"id": 1, "created_at": 1, "expires_at": 1, "revoked_at": 1},
+            )
+            for document in documents:
+                expires_at = document.get("expires_at") or document["created_at"] + SESSION_LIFETIME
+                if expires_at > now:
+                    self._revoked[document["id"]] = expires_at
+                if self._watermark is None or document["revoked_at"] > self._watermark:
+                    self._watermark = document["revoked_at"]
+            if self._watermark is None:
+                self._watermark = now
+            for session_id, expires_at in list(self._revoked.items()):
+                if expires_at <= now:
+                    self._revoked.pop(session_id, None)
+            self._refreshed_at = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def _is_stale(self) -> bool:
+        return (
+            self._refreshed_at is None
+            or time.monotonic() - self._refreshed_at >= self.refresh_interval
+        )
+
+
+def get_revocation_filter(client: ClientLike) -> RevocationFilter:
+    """
+    Get the revocation filter shared by the process for a client or registry.
+    """
+    registry = get_registry(client)
+    return registry.resource("revocations", lambda: RevocationFilter(registry.base))
@@ -0,0 +1,64 @@
+"""Sharding-ready layout of the collections.
+
+Users are sharded on a hashed `id`, magic links on a hashed `token` and the
+email lookup collection on a hashed `email`. With a tenant configured on the
+registry, the tenant is the first field of every shard key, so the data of
+one app stays together and every query carries the full shard key.
+
+Use `CollectionRegistry(client, tenant=..., sharded=True)` so the helpers in
+`src.utils` only issue queries that target a single shard, and run
+`shard_collections` once to shard the collections.
+"""
+
+from typing import Any, Union
+
+from src.db import MAGIC_LINKS, USER_EMAILS, USERS, ClientLike, get_registry
+
+SHARD_KEYS: dict[str, list[tuple[str, Union[int, str]]]] = {
+    USERS: [("id", "hashed")],
+    MAGIC_LINKS: [("token", "hashed")],
+    USER_EMAILS: [("email", "hashed")],
+}
+
+
+def shard_key(client: ClientLike, key: str) -> dict[str, Union[int, str]]:
+    """
+    Get the shard key of a collection, prefixed with the tenant if the registry has one.
+    """
+    registry = get_registry(client)
+    fields = list(SHARD_KEYS[key])
+    if registry.tenant is not None:
+        fields.insert(0, ("tenant", 1))
+    return dict(fields)
+
+
+def shard_collections(client: ClientLike) -> None:
+    """
+    Shard the users, magic links and email lookup collections.
+
+    Compound shard keys with a hashed field, used with a tenant, require
+    MongoDB 4.4 or newer.
+    """
+    registry = get_registry(client)
+    admin = registry.client.get_database("admin")
+    admin.command("enableSharding", registry.database_name)
+    for key in SHARD_KEYS:
+        admin.command(
+            "shardCollection",
+            f"{registry.database_name}.{registry.collection_names[key]}",
+            key=shard_key(registry, key),
+        )
+
+
+def is_targeted(query: dict[str, Any], key: dict[str, Any]) -> bool:
+    """
+    Check whether a query can be routed to a single shard, because it has an
+    equality condition on every field of the shard key.
+    """
+    for field in key:
+        if field not in query:
+            return False
+        value = query[field]
+        if isinstance(value, dict) and set(value) != {"$eq"}:
+            return False
+    return True
@@ -0,0 +1,214 @@
+"""Precomputed user statistics for admin dashboards.
+
+Aggregation pipelines group the users and magic links and `$merge` the
+result into the stats collection:
+
+- users: the number of users per `is_verified`/`is_payed_user` combination
+- signups: the number of users created per day and flag combination
+- links_issued: the number of magic links issued per day
+- redemptions: the number of magic links redeemed per day
+
+The user totals are recomputed on every refresh. The daily counts are only
+recomputed for the last `days` days, so a scheduled refresh does not scan
+the whole history. The daily sign ups are grouped by the current flags of
+the users, which are not updated for days outside of the refreshed window.
+
+Refresh on demand with `refresh_stats`, or on a schedule with
+`python -m src.stats`. Dashboards read the rollup with `get_dashboard_stats`,
+which reads a bounded number of documents however many users there are.
+"""
+
+import argparse
+import logging
+import os
+import signal
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+from src import db
+from src.db import ClientLike, CollectionRegistry, get_registry
+from src.models import DashboardStats
+
+logger = logging.getLogger(__name__)
+
+USERS = "users"
+SIGNUPS = "signups"
+LINKS_ISSUED = "links_issued"
+REDEMPTIONS = "redemptions"
+
+DAY_FORMAT = "%Y-%m-%d"
+
+
+def ensure_stats_indexes(client: ClientLike) -> None:
+    """
+    Create the indexes used to read the rollup, and by the refresh to find daily counts.
+    """
+    registry = get_registry(client)
+    tenant = [("tenant", 1)] if registry.tenant is not None else []
+    registry.stats.create_index(tenant + [("kind", 1), ("day", 1)])
+    registry.users.create_index(tenant + [("created_at", 1)])
+    registry.magic_links.create_index(tenant + [("created_at", 1)])
+    registry.magic_links.create_index(tenant + [("used_at", 1)], sparse=True)
+
+
+def rollup_pipelines(
+    client: ClientLike, since: Optional[datetime], refreshed_at: datetime
+) -> list[tuple[str, str, list[dict[str, Any]]]]:
+    """
+    The rollup pipelines, as (kind, collection key, pipeline) tuples.
+
+    Daily counts are computed for documents from `since` on, or for all
+    documents if `since` is None. Every rollup document gets `refreshed_at`
+    as `updated_at`.
+    """
+    registry = get_registry(client)
+    flags = {
+        "is_verified": {"$ifNull": ["$is_verified", False]},
+        "is_payed_user": {"$ifNull": ["$is_payed_user", False]},
+    }
+    rollups: list[tuple[str, str, Optional[tuple[str, Optional[datetime]]], dict[str, Any]]] = [
+        (USERS, db.USERS, None, flags),
+        (SIGNUPS, db.USERS, ("created_at", since), flags),
+        (LINKS_ISSUED, db.MAGIC_LINKS, ("created_at", since), {}),
+        (REDEMPTIONS, db.MAGIC_LINKS, ("used_at", since), {}),
+    ]
+    return [
+        (kind, key, _rollup(registry, kind, day_field, group, refreshed_at))
+        for kind, key, day_field, group in rollups
+    ]
+
+
+def refresh_stats(client: ClientLike, days: Optional[int] = 2) -> None:
+    """
+    Recompute the user totals and the daily counts of the last `days` days.
+
+    Pass `days=None` to recompute all days, e.g. for the first run.
+    """
+    registry = get_registry(client)
+    refreshed_at = datetime.now()
+    since = None
+    if days is not None:
+        since = (refreshed_at - timedelta(days=days - 1)).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+    for kind, key, pipeline in rollup_pipelines(registry, since, refreshed_at):
+        registry.get(key).aggregate(pipeline)
+        # Remove groups that no longer have any documents, like a flag combination without users.
+        stale: dict[str, Any] = {"kind": kind, "updated_at": {"$lt": refreshed_at}}
+        if kind != USERS and since is not None:
+            stale["day"] = {"$gte": since.strftime(DAY_FORMAT)}
+        registry.stats.delete_many(registry.scope(stale))
+    logger.info(f"Refreshed user statistics in {(datetime.now() - refreshed_at).total_seconds():.2f}s.")
+
+
+def get_dashboard_stats(client: ClientLike, days: int = 30) -> DashboardStats:
+    """
+    Read the user totals and the daily counts of the last `days` days from the rollup.
+    """
+    registry = get_registry(client)
+    first_day = (datetime.now() - timedelta(days=days - 1)).strftime(DAY_FORMAT)
+    documents = registry.stats.find(
+        registry.scope(
+            {
+                "$or": [
+                    {"kind": USERS},
+                    {
+                        "kind": {"$in": [SIGNUPS, LINKS_ISSUED, REDEMPTIONS]},
+                        "day": {"$gte": first_day},
+                    },
+                ]
+            }
+        ),
+        {"_id": 0},
+    )
+    stats = DashboardStats()
+    per_day = {
+        SIGNUPS: stats.signups_per_day,
+        LINKS_ISSUED: stats.links_issued_per_day,
+        REDEMPTIONS: stats.redemptions_per_day,
+    }
+    for document in documents:
+        count = document["count"]
+        if document["kind"] == USERS:
+            stats.total_users += count
+            stats.verified_users += count if document["is_verified"] else 0
+            stats.paying_users += count if document["is_payed_user"] else 0
+        else:
+            day = per_day[document["kind"]]
+            day[document["day"]] = day.get(document["day"], 0) + count
+        if stats.updated_at is None or document["updated_at"] < stats.updated_at:
+            stats.updated_at = document["updated_at"]
+    return stats
+
+
+def _rollup(
+    registry: CollectionRegistry,
+    kind: str,
+    day_field: Optional[tuple[str, Optional[datetime]]],
+    group: dict[str, Any],
+    refreshed_at: datetime,
+) -> list[dict[str, Any]]:
+    """
+    A pipeline counting documents per `group` (and per day of `day_field`),
+    merged into the stats collection.
+    """
+    match: dict[str, Any] = {}
+    key: dict[str, Any] = {"kind": kind, **group}
+    if registry.tenant is not None:
+        key["tenant"] = registry.tenant
+    if day_field is not None:
+        field, since = day_field
+        match[field] = {"$gte": since} if since is not None else {"$ne": None}
+        key["day"] = {"$dateToString": {"format": DAY_FORMAT, "date": f"${field}"}}
+    return [
+        {"$match": registry.scope(match)},
+        {"$group": {"_id": key, "count": {"$sum": 1}}},
+        {"$set": {**{name: f"$_id.{name}" for name in key}, "updated_at": refreshed_at}},
+        {
+            "$merge": {
+                "into": registry.collection_names[db.STATS],
+                "on": "_id",
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    """
+    Refresh the user statistics with the MongoDB settings from the environment,
+    once or every `--interval` seconds.
+    """
+    from pymongo.mongo_client import MongoClient
+    from pymongo.server_api import ServerApi
+
+    parser = argparse.ArgumentParser(description="Refresh the user statistics rollup.")
+    parser.add_argument("--days", type=int, default=2, help="Number of days to recompute.")
+    parser.add_argument("--all", action="store_true", help="Recompute all days.")
+    parser.add_argument("--interval", type=float, default=None, help="Refresh every N seconds.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    mongodb_password = os.environ["MONGODB_PASSWORD"]
+    mongodb_username = os.environ["MONGODB_USERNAME"]
+    mongodb_host = os.environ["MONGODB_HOST"]
+    uri = f"mongodb+srv://{mongodb_username}:{mongodb_password}@{mongodb_host}/?retryWrites=true&w=majority"
+    client: MongoClient = MongoClient(uri, server_api=ServerApi("1"))
+
+    ensure_stats_indexes(client)
+    refresh_stats(client, days=None if args.all else args.days)
+    if args.interval is None:
+        return
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    try:
+        while not stopped.wait(args.interval):
+            refresh_stats(client, days=args.days)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Cheap checks of magic link tokens before they reach the database.
+
+Tokens are UUID4 strings, so anything else in `?token=` (link scanners,
+typos, brute force attempts) is rejected by `is_well_formed_token` without
+a query. Well-formed tokens that were not found are remembered for a while
+in a `NegativeTokenCache`, so repeating them does not cost another query
+or log line either.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from src.db import ClientLike, get_registry
+
+TOKEN_LENGTH = 36
+TOKEN_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}")
+
+
+def is_well_formed_token(token: Optional[str]) -> bool:
+    """
+    Check whether a token can be a magic link token, without the database.
+    """
+    return (
+        isinstance(token, str)
+        and len(token) == TOKEN_LENGTH
+        and TOKEN_PATTERN.fullmatch(token) is not None
+    )
+
+
+class NegativeTokenCache:
+    """
+    Bounded set of recently seen unknown tokens, which expire after `ttl` seconds.
+
+    When the cache is full, the least recently added token is evicted.
+
+    Attributes:
+        max_size (int): Maximum number of cached tokens.
+        ttl (float): Seconds a token is remembered.
+    """
+
+    def __init__(self, max_size: int = 10_000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expires_at: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, token: str) -> None:
+        """Remember an unknown token."""
+        now = time.monotonic()
+        with self._lock:
+            self._expires_at.pop(token, None)
+            self._expires_at[token] = now + self.ttl
+            self._evict(now)
+
+    def __contains__(self, token: str) -> bool:
+        with self._lock:
+            expires_at = self._expires_at.get(token)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self._expires_at[token]
+                return False
+            return True
+
+    def __len__(self) -> int:
+        return len(self._expires_at)
+
+    def _evict(self, now: float) -> None:
+        # Tokens are ordered by expiry, as they all have the same ttl.
+        while self._expires_at:
+            token, expires_at = next(iter(self._expires_at.items()))
+            if expires_at > now and len(self._expires_at) <= self.max_size:
+                break
+            del self._expires_at[token]
+
+
+def get_negative_token_cache(client: ClientLike) -> NegativeTokenCache:
+    """
+    Get the negative token cache shared by the process for a client or registry.
+    """
+    registry = get_registry(client)
+    return registry.resource("unknown_tokens", NegativeTokenCache)
@@ -0,0 +1,337 @@
+import json
+import logging
+import os
+import queue
+import random
+import smtplib
+import threading
+import time
+from abc import ABC, abstractmethod
+from email.message import EmailMessage
+from typing import Callable, Iterable, Optional, Union
+
+from src.breaker import CircuitBreaker
+from src.models import Email
+
+logger = logging.getLogger(__name__)
+
+
+class MailTransport(ABC):
+    """
+    Interface for sending emails.
+
+    Implementations must be thread-safe, a single transport is shared by all
+    Streamlit sessions of a process.
+    """
+
+    @abstractmethod
+    def send(self, to_email: str, body: str, subject: str) -> None:
+        """Send a single email."""
+
+    def send_many(self, emails: Iterable[Email]) -> None:
+        """Send several emails. Transports that can batch override this."""
+        for email in emails:
+            self.send(to_email=email.to_email, body=email.body, subject=email.subject)
+
+    def send_idempotent(self, to_email: str, body: str, subject: str, idempotency_key: str) -> None:
+        """
+        Send an email that may be sent more than once, e.g. as a hedged copy through
+        another transport. Transports that can mark the copies of an email as one
+        message override this, by default the email is sent with `send`.
+        """
+        self.send(to_email=to_email, body=body, subject=subject)
+
+    def close(self) -> None:
+        """Release any resources held by the transport."""
+
+
+class MailjetTransport(MailTransport):
+    """
+    Send emails with Mailjet via the HTTP API, see `src.mail.send_email`.
+
+    Sends go through a circuit breaker. When Mailjet keeps failing, sends
+    fail fast with `CircuitOpenError` instead of waiting for the timeouts.
+
+    Attributes:
+        timeout (float | tuple): The connect and read timeout in seconds.
+        max_retries (int): The number of retries of a failed request.
+        deadline (float): The maximum seconds of a send with all its retries.
+        breaker (CircuitBreaker): The circuit breaker, exposed for monitoring.
+    """
+
+    def __init__(
+        self,
+        timeout: Optional[Union[float, tuple[float, float]]] = None,
+        max_retries: int = 2,
+        breaker: Optional[CircuitBreaker] = None,
+        deadline: Optional[float] = None,
+    ):
+        from src.mail import DEFAULT_DEADLINE, DEFAULT_TIMEOUT, is_transient_error
+
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self.max_retries = max_retries
+        self.deadline = deadline or DEFAULT_DEADLINE
+        self.breaker = breaker or CircuitBreaker("mailjet", is_failure=is_transient_error)
+
+    def send(self, to_email: str, body: str, subject: str) -> None:
+        from src.mail import send_email
+
+        self.breaker.call(
+            send_email,
+            to_email=to_email,
+            body=body,
+            subject=subject,
+            timeout=self.timeout,
+            max_retries=self.max_retries,
+            deadline=self.deadline,
+        )
+
+
+class _PooledConnection:
+    """An open SMTP connection and its usage counters."""
+
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPTransport(MailTransport):
+    """
+    Send emails through an SMTP relay with a pool of persistent connections.
+
+    Connections are reused across sends, and `send_many` sends all messages
+    over one session instead of connecting per message. A connection is
+    closed after `max_messages_per_connection` messages, and checked with
+    `NOOP` before reuse when it was idle for longer than `max_idle_seconds`.
+
+    Attributes:
+        host (str): The SMTP host.
+        port (int): The SMTP port.
+        username (str): Optional username to log in with.
+        password (str): Optional password to log in with.
+        from_email (str): The sender address. Defaults to the `FROM_EMAIL` environment variable.
+        starttls (bool): Whether to upgrade the connection with STARTTLS.
+        use_ssl (bool): Whether to connect with implicit TLS (SMTPS).
+        timeout (float): Socket timeout in seconds.
+        pool_size (int): Maximum number of open connections.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int = 587,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        from_email: Optional[str] = None,
+        starttls: bool = True,
+        use_ssl: bool = False,
+        timeout: float = 10.0,
+        pool_size: int = 4,
+        max_messages_per_connection: int = 100,
+        max_idle_seconds: float = 30.0,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.from_email = from_email or os.environ.get("FROM_EMAIL")
+        if not self.from_email:
+            raise ValueError("FROM_EMAIL environment variable not set.")
+        self.starttls = starttls and not use_ssl
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.max_messages_per_connection = max_messages_per_connection
+        self.max_idle_seconds = max_idle_seconds
+        self._idle: queue.LifoQueue[_PooledConnection] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def send(self, to_email: str, body: str, subject: str) -> None:
+        self.send_many([Email(to_email=to_email, body=body, subject=subject)])
+
+    def send_idempotent(self, to_email: str, body: str, subject: str, idempotency_key: str) -> None:
+        """
+        Send an email with a `Message-ID` derived from the idempotency key, so mail
+        systems that drop messages with a known id keep one of the copies.
+        """
+        self._send_messages([Email(to_email=to_email, body=body, subject=subject)], idempotency_key)
+
+    def send_many(self, emails: Iterable[Email]) -> None:
+        self._send_messages(emails)
+
+    def _send_messages(self, emails: Iterable[Email], idempotency_key: Optional[str] = None) -> None:
+        with self._slots:
+            connection = self._acquire()
+            for email in emails:
+                connection = self._send_message(connection, email, idempotency_key)
+            self._release(connection)
+
+    def close(self) -> None:
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(connection)
+
+    def _send_message(
+        self, connection: _PooledConnection, email: Email, idempotency_key: Optional[str] = None
+    ) -> _PooledConnection:
+        """
+        Send a message, reconnecting once if the server dropped the connection.
+
+        Returns the connection to use for the next message. If the send
+        fails, the connection it was using is closed before the error is raised.
+        """
+        current: Optional[_PooledConnection] = connection
+        try:
+            if connection.messages_sent >= self.max_messages_per_connection:
+                self._discard(connection)
+                current = None
+                current = connection = self._connect()
+            message = self._create_message(email, idempotency_key)
+            try:
+                connection.smtp.send_message(message)
+            except smtplib.SMTPServerDisconnected:
+                logger.info("SMTP connection was closed by the server, reconnecting.")
+                self._discard(connection)
+                current = None
+                current = connection = self._connect()
+                connection.smtp.send_message(message)
+        except BaseException:
+            if current is not None:
+                self._discard(current)
+            raise
+        connection.messages_sent += 1
+        connection.last_used = time.monotonic()
+        return connection
+
+    def _acquire(self) -> _PooledConnection:
+        """Take an idle connection from the pool, or open a new one."""
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - connection.last_used <= self.max_idle_seconds:
+                return connection
+            try:
+                if connection.smtp.noop()[0] == 250:
+                    return connection
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._discard(connection)
+
+    def _release(self, connection: _PooledConnection) -> None:
+        """Return a connection to the pool."""
+        if connection.messages_sent >= self.max_messages_per_connection:
+            self._discard(connection)
+        else:
+            self._idle.put(connection)
+
+    def _connect(self) -> _PooledConnection:
+        """Open and authenticate a new SMTP connection."""
+        smtp_class = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+        smtp = smtp_class(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self.username and self.password:
+            smtp.login(self.username, self.password)
+        return _PooledConnection(smtp)
+
+    @staticmethod
+    def _discard(connection: _PooledConnection) -> None:
+        """Close a connection, ignoring errors from an already broken one."""
+        try:
+            connection.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.smtp.close()
+
+    def _create_message(self, email: Email, idempotency_key: Optional[str] = None) -> EmailMessage:
+        message = EmailMessage()
+        message["From"] = self.from_email
+        message["To"] = email.to_email
+        message["Subject"] = email.subject
+        if idempotency_key is not None:
+            domain = str(self.from_email).rpartition("@")[2] or "localhost"
+            message["Message-ID"] = f"<{idempotency_key}@{domain}>"
+        message.set_content(email.body)
+        return message
+
+
+class MemoryTransport(MailTransport):
+    """
+    Keep sent emails in memory, for tests and benchmarks.
+
+    Attributes:
+        sent (list[Email]): The emails sent through the transport.
+        path (str): Optional path of a JSON lines file every email is appended to.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.sent: list[Email] = []
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, to_email: str, body: str, subject: str) -> None:
+        email = Email(to_email=to_email, body=body, subject=subject)
+        with self._lock:
+            self.sent.append(email)
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(email.model_dump()) + "\n")
+
+
+class FakeTransport(MemoryTransport):
+    """
+    Memory transport with a simulated provider latency and failures, for tests
+    and benchmarks of `DeliveryRouter`.
+
+    Attributes:
+        latency (float | Callable): Seconds every send takes, or a function returning them.
+        error (Exception): Optional error raised by the sends after the latency.
+        error_rate (float): Fraction of the sends that raise `error`, at random.
+        idempotency_keys (list[str]): The idempotency keys of the emails sent with
+            `send_idempotent`, in order.
+    """
+
+    def __init__(
+        self,
+        latency: Union[float, Callable[[], float]] = 0.0,
+        error: Optional[Exception] = None,
+        error_rate: float = 1.0,
+        path: Optional[str] = None,
+        seed: Optional[int] = None,
+    ):
+        super().__init__(path=path)
+        self.latency = latency
+        self.error = error
+        self.error_rate = error_rate
+        self.idempotency_keys: list[str] = []
+        self._random = random.Random(seed)
+
+    def send(self, to_email: str, body: str, subject: str) -> None:
+        time.sleep(self.latency() if callable(self.latency) else self.latency)
+        with self._lock:
+            failed = self.error is not None and self._random.random() < self.error_rate
+        if failed and self.error is not None:
+            raise self.error
+        super().send(to_email=to_email, body=body, subject=subject)
+
+    def send_idempotent(self, to_email: str, body: str, subject: str, idempotency_key: str) -> None:
+        self.send(to_email=to_email, body=body, subject=subject)
+        with self._lock:
+            self.idempotency_keys.append(idempotency_key)
+
+
+_default_transport: Optional[MailTransport] = None
+
+
+def get_default_transport() -> MailTransport:
+    """
+    Get the process-wide default transport, which sends with Mailjet.
+    """
+    global _default_transport
+    if _default_transport is None:
+        _default_transport = MailjetTransport()
+    return _default_transport
@@ -1,121 +1,527 @@
 import logging
-from typing import Optional
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Optional
 
-from pymongo.mongo_client import MongoClient
-
-from src.db import (
-    get_magic_link_collection,
-    get_user_collection,
-)
+from src.db import USERS, ClientLike, CollectionRegistry, get_registry
+from src.events import hash_token
 from src.models import MagicLink, User
+from src.recorder import traced
+
+if TYPE_CHECKING:
+    from src.coalescer import InsertCoalescer
 
 logger = logging.getLogger(__name__)
 
+# `ReturnDocument.AFTER`, without importing pymongo.
+RETURN_AFTER = True
+# The code of `DuplicateKeyError`, without importing pymongo.
+DUPLICATE_KEY = 11000
+
+
+class VersionConflictError(Exception):
+    """Raised when a document was changed by someone else since it was read."""
+
+    def __init__(self, kind: str, key: str, expected_version: int):
+        super().__init__(
+            f"{kind} {key} was changed concurrently, expected version {expected_version}."
+        )
+        self.expected_version = expected_version
+
+
+def _version_query(expected_version: int) -> Any:
+    """Match a version, treating documents from before versioning as version 0."""
+    if expected_version == 0:
+        return {"$in": [0, None]}
+    return expected_version
 
-def insert_user(client: MongoClient, user: User) -> User:
+
+def ensure_indexes(client: ClientLike) -> None:
+    """
+    Create the indexes used by the lookups in this module.
+    """
+    registry = get_registry(client)
+    tenant = [("tenant", 1)] if registry.tenant is not None else []
+
+    registry.users.create_index(tenant + [("id", 1)], unique=True)
+    registry.users.create_index(tenant + [("email", 1)])
+    if not registry.sharded:
+        # Users stored before email keys have none, until `backfill_email_keys` ran.
+        registry.users.create_index(
+            tenant + [("email_key", 1)],
+            unique=True,
+            partialFilterExpression={"email_key": {"$exists": True}},
+        )
+    else:
+        registry.user_emails.create_index(tenant + [("email", 1)], unique=True)
+
+    registry.magic_links.create_index(tenant + [("token", 1)], unique=True)
+    registry.magic_links.create_index(
+        tenant + [("user_id", 1), ("is_used", 1), ("created_at", -1)]
+    )
+
+
+@traced
+def insert_user(client: ClientLike, user: User) -> User:
     """
     Insert a user into the MongoDB collection.
+
+    Raises:
+        DuplicateKeyError: If a user with the same email was inserted concurrently.
     """
-    users = get_user_collection(client)
-    if users.find_one({"$or": [{"id": user.id}, {"email": user.email}]}):
+    registry = get_registry(client)
+    email_key = registry.email_normalizer(user.email)
+    if registry.sharded:
+        exists = registry.users.find_one(registry.scope({"id": user.id})) or (
+            _find_email_lookup(registry, email_key, user.email)
+        )
+    else:
+        exists = registry.users.find_one(
+            registry.scope({"$or": [{"id": user.id}, *_email_query(email_key, user.email)]})
+        )
+    if exists:
         logger.warning(f"User with id {user.id} or email {user.email} already exists.")
     else:
-        users.insert_one(user.model_dump())
+        user.created_at = user.created_at or datetime.now()
+        registry.users.insert_one(registry.scope({**user.model_dump(), "email_key": email_key}))
+        if registry.sharded:
+            try:
+                registry.user_emails.insert_one(
+                    registry.scope({"email": email_key, "user_id": user.id})
+                )
+            except Exception:
+                # The email was taken concurrently, do not leave a user without a lookup.
+                registry.users.delete_one(registry.scope({"id": user.id}))
+                raise
+        user.mark_saved()
     return user
 
 
-def get_user_by_id(client: MongoClient, user_id: str) -> Optional[User]:
+@traced
+def get_user_by_id(
+    client: ClientLike, user_id: str, min_version: Optional[int] = None
+) -> Optional[User]:
     """
     Get a user from the MongoDB collection.
+
+    With a user cache on the registry, the user is read from the cache first.
+    A cached user older than `min_version` is read from the collection.
     """
-    users = get_user_collection(client)
-    user = users.find_one({"id": user_id})
+    registry = get_registry(client)
+    if registry.user_cache is not None:
+        cached_user = registry.user_cache.get(registry.cache_key(USERS, user_id), min_version)
+        if cached_user is not None:
+            return cached_user
+    user = registry.users.find_one(registry.scope({"id": user_id}))
     if not user:
         logger.warning(f"User with id {user_id} not found.")
         return None
-    return User(**user)
+    loaded_user = User.from_document(user)
+    if registry.user_cache is not None:
+        registry.user_cache.set(registry.cache_key(USERS, user_id), loaded_user)
+    return loaded_user
+
+
+@traced
+def get_user_version(client: ClientLike, user_id: str) -> Optional[int]:
+    """
+    Get only the version of a user, to check whether a copy is still current.
+
+    Returns:
+        int: The stored version, or None if the user was not found.
+    """
+    registry = get_registry(client)
+    user = registry.users.find_one(registry.scope({"id": user_id}), {"_id": 0, "version": 1})
+    if user is None:
+        return None
+    return user.get("version", 0)
 
 
-def get_user_by_email(client: MongoClient, email: str) -> Optional[User]:
+@traced
+def get_user_fields(client: ClientLike, user_id: str, *fields: str) -> Optional[dict[str, Any]]:
+    """
+    Get only some fields and the version of a user, to check a copy of them
+    without loading the user. Fields that are not stored have their default.
+
+    Returns:
+        dict: The fields and the version, or None if the user was not found.
+    """
+    registry = get_registry(client)
+    projection = {"_id": 0, "version": 1, **{name: 1 for name in fields}}
+    user = registry.users.find_one(registry.scope({"id": user_id}), projection)
+    if user is None:
+        return None
+    return {
+        name: user.get(name, User.model_fields[name].default) for name in ("version", *fields)
+    }
+
+
+@traced
+def get_user_by_email(client: ClientLike, email: str) -> Optional[User]:
     """
     Get a user from the MongoDB collection by email.
+
+    Users are matched by their normalized email key, see `src.emails`, or by
+    their exact email if they were stored before email keys. In the sharded
+    layout the user id is looked up by email first, so both queries target
+    a single shard.
     """
-    users = get_user_collection(client)
-    user = users.find_one({"email": email})
+    registry = get_registry(client)
+    email_key = registry.email_normalizer(email)
+    if registry.sharded:
+        lookup = _find_email_lookup(registry, email_key, email)
+        user = (
+            registry.users.find_one(registry.scope({"id": lookup["user_id"]}))
+            if lookup
+            else None
+        )
+    else:
+        user = registry.users.find_one(registry.scope({"$or": _email_query(email_key, email)}))
     if not user:
         logger.warning(f"User with email {email} not found.")
         return None
-    return User(**user)
+    return User.from_document(user)
 
 
-def update_user(client: MongoClient, user: User) -> Optional[User]:
+@traced
+def update_user(client: ClientLike, user: User) -> Optional[User]:
     """
     Update a user in the MongoDB collection.
+
+    Only the fields changed since the user was loaded or saved are written,
+    see `update_user_fields`. A user that was not loaded is written in full.
+    A loaded user is only written if it still has the stored version.
+
+    Raises:
+        VersionConflictError: If the user was changed since it was loaded.
     """
-    users = get_user_collection(client)
-    result = users.update_one({"id": user.id}, {"$set": user.model_dump()})
-    if result.matched_count == 0:
-        logger.warning(f"User with id {user.id} not found.")
+    changes = {
+        name: value
+        for name, value in user.changed_fields().items()
+        if name not in ("id", "version")
+    }
+    if not changes:
+        return get_user_by_id(client, user.id)
+    updated_user = update_user_fields(
+        client,
+        user.id,
+        expected_version=user.version if user.is_saved else None,
+        **changes,
+    )
+    if updated_user:
+        user.version = updated_user.version
+        user.mark_saved()
+    return updated_user
+
+
+@traced
+def update_user_fields(
+    client: ClientLike,
+    user_id: str,
+    expected_version: Optional[int] = None,
+    **changes: Any,
+) -> Optional[User]:
+    """
+    Set only the given fields of a user, in a single write, and increment its version.
+
+    Fields that are not passed keep their stored value, so concurrent updates
+    of other fields are not overwritten. With `expected_version`, the write
+    only happens if the stored user still has that version.
+
+    Returns:
+        User: The updated user, or None if the user was not found.
+
+    Raises:
+        VersionConflictError: If the user does not have `expected_version`.
+        DuplicateKeyError: If the new email is taken by another user.
+    """
+    unknown = set(changes) - (set(User.model_fields) - {"id", "version"})
+    if unknown:
+        raise ValueError(f"Cannot update user fields: {', '.join(sorted(unknown))}")
+    registry = get_registry(client)
+    query = registry.scope({"id": user_id})
+    if expected_version is not None:
+        query["version"] = _version_query(expected_version)
+    fields = dict(changes)
+    if "email" in changes:
+        fields["email_key"] = registry.email_normalizer(changes["email"])
+    update = {"$set": fields, "$inc": {"version": 1}}
+    if registry.sharded and "email" in changes:
+        user = _update_user_email(registry, user_id, query, update, changes["email"])
+    else:
+        user = registry.users.find_one_and_update(query, update, return_document=RETURN_AFTER)
+    if registry.user_cache is not None:
+        registry.user_cache.invalidate(registry.cache_key(USERS, user_id))
+    if not user:
+        if expected_version is not None and get_user_version(client, user_id) is not None:
+            raise VersionConflictError("User", user_id, expected_version)
+        logger.warning(f"User with id {user_id} not found.")
         return None
-    return get_user_by_id(client, user.id)
+    return User.from_document(user)
 
 
-def delete_user(client: MongoClient, user: User) -> Optional[User]:
+@traced
+def delete_user(client: ClientLike, user: User) -> Optional[User]:
     """
     Delete a user from the MongoDB collection.
     """
-    users = get_user_collection(client)
-    result = users.delete_one({"id": user.id})
+    registry = get_registry(client)
+    result = registry.users.delete_one(registry.scope({"id": user.id}))
+    if registry.user_cache is not None:
+        registry.user_cache.invalidate(registry.cache_key(USERS, user.id))
     if result.deleted_count == 0:
         logger.warning(f"User with id {user.id} not found.")
         return None
+    if registry.sharded:
+        _delete_email_lookup(registry, user.id, user.email)
     return user
 
 
-def create_or_retrieve_user(client, email: str) -> User:
+@traced
+def create_or_retrieve_user(client: ClientLike, email: str) -> User:
     """
     Create a new user or retrieve an existing one from the MongoDB collection.
+
+    When two requests create the same user at once, the unique email key
+    index rejects the second insert, and the user of the first is returned.
     """
     user = get_user_by_email(client, email)
     if user:
         return user
-    return insert_user(client, User(email=email))
+    try:
+        return insert_user(client, User(email=email))
+    except Exception as error:
+        if getattr(error, "code", None) != DUPLICATE_KEY:
+            raise
+        logger.info(f"User with email {email} was created concurrently.")
+        user = get_user_by_email(client, email)
+        if user is None:
+            raise
+        return user
 
 
-def insert_magic_link(client: MongoClient, user_id: str) -> MagicLink:
+@traced
+def insert_magic_link(
+    client: ClientLike,
+    user_id: str,
+    session: Optional[Any] = None,
+    coalescer: Optional["InsertCoalescer"] = None,
+) -> MagicLink:
     """
     Insert a magic link into the MongoDB collection.
-    """
-    magic_links = get_magic_link_collection(client)
 
+    With a `coalescer`, the magic link is inserted with the concurrent inserts
+    of other threads in one `insert_many`, see `src.coalescer`. Inserts in a
+    transaction `session` are never batched.
+    """
+    registry = get_registry(client)
     magic_link = MagicLink(user_id=user_id)
-    magic_links.insert_one(magic_link.model_dump())
+    document = registry.scope(magic_link.model_dump())
+    if coalescer is not None and session is None:
+        coalescer.insert(document)
+    else:
+        registry.magic_links.insert_one(document, session=session)
+    magic_link.mark_saved()
     return magic_link
 
 
-def get_magic_link_by_token(client: MongoClient, token: str) -> Optional[MagicLink]:
+@traced
+def get_active_magic_link(
+    client: ClientLike, user_id: str, issued_after: datetime
+) -> Optional[MagicLink]:
+    """
+    Get the most recent unused and unexpired magic link of a user, issued after `issued_after`.
+
+    NOTE: magic links are sharded by token, so in the sharded layout this
+    query is broadcast to all shards. It only runs when a link is requested.
+    """
+    registry = get_registry(client)
+    magic_link = registry.magic_links.find_one(
+        registry.scope(
+            {
+                "user_id": user_id,
+                "is_used": False,
+                "created_at": {"$gte": issued_after},
+                "expiration_time": {"$gt": datetime.now()},
+            }
+        ),
+        sort=[("created_at", -1)],
+    )
+    if not magic_link:
+        return None
+    return MagicLink.from_document(magic_link)
+
+
+@traced
+def invalidate_magic_links(
+    client: ClientLike, user_id: str, except_token: Optional[str] = None
+) -> int:
+    """
+    Mark all unused magic links of a user as used, except the one with `except_token`.
+
+    NOTE: magic links are sharded by token, so in the sharded layout this
+    update is broadcast to all shards. It only runs when a link is redeemed.
+
+    Returns:
+        int: The number of invalidated magic links.
+    """
+    registry = get_registry(client)
+    query: dict[str, Any] = {"user_id": user_id, "is_used": False}
+    if except_token:
+        query["token"] = {"$ne": except_token}
+    result = registry.magic_links.update_many(
+        registry.scope(query), {"$set": {"is_used": True}, "$inc": {"version": 1}}
+    )
+    return result.modified_count
+
+
+@traced
+def get_magic_link_by_token(client: ClientLike, token: str) -> Optional[MagicLink]:
     """
     Get a magic link from the MongoDB collection by token.
     """
-    magic_links = get_magic_link_collection(client)
-    magic_link = magic_links.find_one({"token": token})
+    registry = get_registry(client)
+    magic_link = registry.magic_links.find_one(registry.scope({"token": token}))
     if not magic_link:
-        logger.warning(f"Magic link with token {token} not found.")
+        logger.warning(f"Magic link {hash_token(token)} not found.")
+        return None
+    return MagicLink.from_document(magic_link)
+
+
+@traced
+def redeem_magic_link(client: ClientLike, token: str) -> Optional[MagicLink]:
+    """
+    Mark a magic link as used, in a single write that only matches an unused
+    and unexpired link, so a link can be redeemed only once.
+
+    Returns:
+        MagicLink: The redeemed magic link, or None if it was not found, used or expired.
+    """
+    registry = get_registry(client)
+    now = datetime.now()
+    document = registry.magic_links.find_one_and_update(
+        registry.scope({"token": token, "is_used": False, "expiration_time": {"$gt": now}}),
+        {"$set": {"is_used": True, "used_at": now}, "$inc": {"version": 1}},
+        return_document=RETURN_AFTER,
+    )
+    if not document:
         return None
-    return MagicLink(**magic_link)
+    return MagicLink.from_document(document)
 
 
+@traced
 def update_magic_link(
-    client: MongoClient, magic_link: MagicLink
+    client: ClientLike, magic_link: MagicLink
 ) -> Optional[MagicLink]:
     """
     Update a magic link in the MongoDB collection.
+
+    Only the fields changed since the magic link was loaded or saved are written,
+    and a loaded magic link only if it still has the stored version. Two
+    sessions redeeming the same link at once can therefore not both succeed.
+
+    Raises:
+        VersionConflictError: If the magic link was changed since it was loaded.
     """
-    magic_links = get_magic_link_collection(client)
-    result = magic_links.update_one(
-        {"token": magic_link.token}, {"$set": magic_link.model_dump()}
-    )
-    if result.matched_count == 0:
-        logger.warning(f"Magic link with token {magic_link.token} not found.")
+    registry = get_registry(client)
+    changes = {
+        name: value
+        for name, value in magic_link.changed_fields().items()
+        if name not in ("token", "version")
+    }
+    query = registry.scope({"token": magic_link.token})
+    if not changes:
+        document = registry.magic_links.find_one(query)
+    else:
+        if magic_link.is_saved:
+            query["version"] = _version_query(magic_link.version)
+        document = registry.magic_links.find_one_and_update(
+            query, {"$set": changes, "$inc": {"version": 1}}, return_document=RETURN_AFTER
+        )
+        if not document and magic_link.is_saved and registry.magic_links.find_one(
+            registry.scope({"token": magic_link.token}), {"_id": 1}
+        ):
+            raise VersionConflictError(
+                "Magic link", hash_token(magic_link.token), magic_link.version
+            )
+    if not document:
+        logger.warning(f"Magic link {hash_token(magic_link.token)} not found.")
         return None
-    return get_magic_link_by_token(client, magic_link.token)
+    updated_magic_link = MagicLink.from_document(document)
+    magic_link.version = updated_magic_link.version
+    magic_link.mark_saved()
+    return updated_magic_link
+
+
+def _update_user_email(
+    registry: CollectionRegistry,
+    user_id: str,
+    query: dict[str, Any],
+    update: dict[str, Any],
+    email: str,
+) -> Optional[dict[str, Any]]:
+    """
+    Update a user whose email may change in the sharded layout, and move its email lookup.
+
+    The lookup of the new email is inserted before the user is updated, so an
+    email taken by another user raises a `DuplicateKeyError` and leaves the
+    user and the lookups unchanged. The update only matches the email that was
+    read, and is retried if the email changed in between.
+
+    Returns:
+        dict: The updated user document, or None if `query` matched no user.
+    """
+    email_key = registry.email_normalizer(email)
+    while True:
+        previous = registry.users.find_one(query, {"email": 1})
+        if previous is None:
+            return None
+        old_email = previous["email"]
+        moved = registry.email_normalizer(old_email) != email_key
+        if moved:
+            registry.user_emails.insert_one(registry.scope({"email": email_key, "user_id": user_id}))
+        user = registry.users.find_one_and_update(
+            {**query, "email": old_email}, update, return_document=RETURN_AFTER
+        )
+        if user is None:
+            if moved:
+                _delete_email_lookup(registry, user_id, email)
+            continue
+        if moved:
+            _delete_email_lookup(registry, user_id, old_email)
+        elif old_email != email:
+            # Same key, but the lookup may be stored by exact email from before email keys.
+            _delete_email_lookup(registry, user_id, old_email)
+            registry.user_emails.insert_one(registry.scope({"email": email_key, "user_id": user_id}))
+        return user
+
+
+def _email_query(email_key: str, email: str) -> list[dict[str, Any]]:
+    """
+    The `$or` clauses matching a user by email key, or by exact email if it has no key yet.
+    """
+    return [{"email_key": email_key}, {"email": email, "email_key": {"$exists": False}}]
+
+
+def _find_email_lookup(
+    registry: CollectionRegistry, email_key: str, email: str
+) -> Optional[dict[str, Any]]:
+    """
+    Find the email lookup of the sharded layout by key, or by exact email if it
+    was stored before email keys. Both queries target a single shard.
+    """
+    lookup = registry.user_emails.find_one(registry.scope({"email": email_key}))
+    if lookup is None and email != email_key:
+        lookup = registry.user_emails.find_one(registry.scope({"email": email}))
+    return lookup
+
+
+def _delete_email_lookup(registry: CollectionRegistry, user_id: str, email: str) -> None:
+    """
+    Delete the email lookup of a user, stored by key or by exact email.
+    """
+    email_key = registry.email_normalizer(email)
+    result = registry.user_emails.delete_one(
+        registry.scope({"email": email_key, "user_id": user_id})
+    )
+    if result.deleted_count == 0 and email != email_key:
+        registry.user_emails.delete_one(registry.scope({"email": email, "user_id": user_id}))
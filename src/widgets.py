@@ -0,0 +1,96 @@
+"""Ready-made login, sign out and profile widgets.
+
+The widgets are Streamlit fragments: submitting the email or saving the
+profile only reruns the widget, not the whole app. Signing out and deleting
+the account change who is signed in, so they still rerun the whole app.
+
+    magic_link = StreamlitMagicLink(mongo_client, base_url)
+    magic_link.sign_in()
+
+    if magic_link.user:
+        sign_out_widget(magic_link)
+        profile_widget(magic_link)
+    else:
+        login_widget(magic_link)
+"""
+
+from collections.abc import Sequence
+from typing import Any
+
+import streamlit as st
+
+from src.magiclink import StreamlitMagicLink
+
+# The user fields the profile form can edit, by label. Checkboxes are used for boolean fields.
+FIELD_LABELS = {
+    "email": "Email",
+    "name": "Name",
+    "is_payed_user": "Is payed user",
+    "additional_data": "Additional data",
+}
+BOOLEAN_FIELDS = {"is_payed_user"}
+# The fields users may edit on their own. The email needs its own verified flow, and
+# `is_payed_user` authorizes paid pages, see `src.guard`.
+PROFILE_FIELDS = ("name", "additional_data")
+
+
+def _login_form(magic_link: StreamlitMagicLink, key: str = "magic_link_login") -> None:
+    """An email form that sends a magic link"""
+    with st.form(key, border=True):
+        email = st.text_input("Email", placeholder="Enter your email")
+        if st.form_submit_button("Login or Sign up") and email:
+            magic_link.authenticate(email.strip())
+
+
+def _sign_out_button(
+    magic_link: StreamlitMagicLink, everywhere: bool = False, key: str = "magic_link_sign_out"
+) -> None:
+    """A greeting with a sign out button"""
+    if not magic_link.user:
+        return
+    with st.container(border=True):
+        st.text(f"Hello, {magic_link.user['email']}!")
+        if st.button("Sign out", key=key):
+            magic_link.sign_out()
+        if everywhere and st.button("Sign out everywhere", key=f"{key}_everywhere"):
+            magic_link.sign_out_everywhere()
+
+
+def _profile_form(
+    magic_link: StreamlitMagicLink,
+    allow_delete: bool = True,
+    key: str = "magic_link_profile",
+    fields: Sequence[str] = PROFILE_FIELDS,
+) -> None:
+    """
+    A form to edit the profile of the current user, and to delete the account.
+
+    Only `fields` can be edited. Adding `email` or `is_payed_user` lets users
+    change their email without verifying it, or unlock paid pages, so only do
+    it in admin tools.
+    """
+    user = magic_link.user
+    if not user:
+        return
+    current: dict[str, Any] = {
+        field: bool(user.get(field)) if field in BOOLEAN_FIELDS else user.get(field) or ""
+        for field in fields
+    }
+    with st.form(key, border=True):
+        edited = {
+            field: st.checkbox(FIELD_LABELS[field], value=current[field])
+            if field in BOOLEAN_FIELDS
+            else st.text_input(FIELD_LABELS[field], current[field])
+            for field in fields
+        }
+        if st.form_submit_button("Update user"):
+            changes = {field: value for field, value in edited.items() if value != current[field]}
+            if changes:
+                magic_link.update_user(**changes)
+    if allow_delete and st.button("Delete user", type="primary", key=f"{key}_delete"):
+        magic_link.delete_user()
+
+
+login_widget = st.fragment(_login_form)
+sign_out_widget = st.fragment(_sign_out_button)
+profile_widget = st.fragment(_profile_form)
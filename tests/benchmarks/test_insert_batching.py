@@ -0,0 +1,12 @@
+from benchmarks.insert_batching import compare
+
+
+def test_compare() -> None:
+    """Test a small comparison of per-call and coalesced inserts."""
+    report = compare(threads=4, inserts=5, latency=0.0, commit_cost=0.0, max_wait=0.001)
+
+    assert set(report) == {"per_call", "coalesced"}
+    assert report["per_call"]["inserts"] == report["coalesced"]["inserts"] == 20
+    assert report["per_call"]["batches"] == 20
+    assert report["coalesced"]["batches"] <= 20
+    assert all(stats["inserts_per_s"] > 0 for stats in report.values())
@@ -0,0 +1,55 @@
+from benchmarks.load_test import FakeCookieController, LoadReport, run_load_test
+
+
+def test_run_load_test() -> None:
+    """Test a small load test run."""
+    report = run_load_test(sessions=4, iterations=20, seed=1)
+
+    summary = report.summary()
+    assert summary["flows_per_s"] > 0
+    assert sum(flow["count"] for flow in summary["flows"].values()) == 4 * 20
+    assert all(flow["errors"] == 0 for flow in summary["flows"].values())
+    assert set(summary["flows"]) <= {"rerun", "sign_in", "update", "sign_out"}
+    assert len(report.redemptions) >= 4
+
+
+def test_run_load_test_with_contention() -> None:
+    """Test that links opened by two sessions are counted per token."""
+    report = run_load_test(
+        sessions=2, iterations=5, mix={"sign_in": 1.0}, contention=1.0, seed=1
+    )
+
+    assert report.redemptions
+    assert report.summary()["double_redemptions"] == report.double_redemptions
+
+
+def test_run_load_test_redeems_links_once() -> None:
+    """Test that a link opened by several sessions at once signs in only one of them."""
+    report = run_load_test(
+        sessions=8, iterations=10, mix={"sign_in": 1.0}, contention=1.0, seed=1
+    )
+
+    assert report.redemptions
+    assert report.double_redemptions == 0
+
+
+def test_load_report_percentiles() -> None:
+    """Test the percentiles of the load report."""
+    report = LoadReport()
+    for milliseconds in range(1, 101):
+        report.record("rerun", milliseconds / 1000)
+    report.elapsed = 2.0
+
+    summary = report.summary()
+    assert summary["flows_per_s"] == 50
+    assert round(summary["flows"]["rerun"]["p50_ms"]) == 50
+    assert round(summary["flows"]["rerun"]["p99_ms"]) == 99
+
+
+def test_fake_cookie_controller() -> None:
+    """Test the fake cookie controller."""
+    cookies = FakeCookieController()
+    cookies.set("user", {"id": "12345"})
+    assert cookies.get("user") == {"id": "12345"}
+    cookies.remove("user")
+    assert cookies.get("user") is None
@@ -0,0 +1,67 @@
+import json
+
+from benchmarks.replay import compare, main, replay, summarize
+from src.recorder import TraceEntry
+from src.transports import FakeTransport
+
+
+def _trace() -> list[TraceEntry]:
+    """A recorded trace: a link requested in one session and opened in another."""
+    return [
+        TraceEntry(op="rerun", at=0.00, duration_ms=2, session="a", outcome="anonymous"),
+        TraceEntry(op="authenticate", at=0.01, duration_ms=30, session="a", email="e1", token="t1", outcome="sent"),
+        TraceEntry(op="insert_magic_link", at=0.02, duration_ms=3, session="a", depth=1),
+        TraceEntry(op="rerun", at=0.05, duration_ms=2, session="b", outcome="anonymous"),
+        TraceEntry(op="sign_in", at=0.06, duration_ms=9, session="b", token="t1", outcome="valid"),
+        TraceEntry(op="rerun", at=0.07, duration_ms=2, session="b", outcome="signed_in"),
+        TraceEntry(op="update_user", at=0.08, duration_ms=4, session="b", fields=["name"]),
+        TraceEntry(op="sign_out", at=0.09, duration_ms=5, session="b"),
+        TraceEntry(op="rerun", at=0.05, duration_ms=2, session="c", outcome="anonymous"),
+        TraceEntry(op="sign_in", at=0.06, duration_ms=1, session="c", token="t9", outcome="not_found"),
+        TraceEntry(op="sign_in", at=0.07, duration_ms=1, session="c", token="t8", outcome="malformed"),
+    ]
+
+
+def test_replay() -> None:
+    """Test that a replay reproduces the operations and outcomes of the trace."""
+    transport = FakeTransport()
+    entries = replay(_trace(), speedup=10, mail_transport=transport)
+
+    top = sorted((entry for entry in entries if entry.depth == 0), key=lambda entry: entry.at)
+    outcomes = {(entry.op, entry.outcome) for entry in top}
+    assert [email.to_email for email in transport.sent] == ["e1@replay.test"]
+    assert {("authenticate", "sent"), ("sign_in", "valid"), ("sign_in", "not_found")} <= outcomes
+    assert ("sign_in", "malformed") in outcomes
+    assert {"update_user", "sign_out"} <= {entry.op for entry in top}
+    assert len([entry for entry in top if entry.op == "rerun"]) == 4
+    assert not [entry for entry in entries if entry.outcome == "error"]
+
+
+def test_summarize_and_compare() -> None:
+    """Test the summary of a trace and the comparison of two summaries."""
+    baseline = summarize(_trace())
+    assert baseline["operations"] == 10
+    assert baseline["ops"]["rerun"]["count"] == 4
+    assert baseline["ops"]["insert_magic_link"]["p50_ms"] == 3
+
+    faster = summarize(
+        [entry.model_copy(update={"duration_ms": entry.duration_ms / 2}) for entry in _trace()]
+    )
+    comparison = compare(baseline, faster)
+    assert comparison["ops"]["authenticate"]["p50_change_pct"] == -50
+    assert comparison["throughput_ratio"] > 1
+
+
+def test_main(tmp_path, capsys) -> None:
+    """Test replaying a trace file and comparing with a saved summary."""
+    trace = tmp_path / "trace.jsonl"
+    trace.write_text("".join(entry.model_dump_json() + "\n" for entry in _trace()))
+    saved = tmp_path / "summary.json"
+
+    main([str(trace), "--speedup", "10", "--save", str(saved)])
+    assert "operations" in capsys.readouterr().out
+    main([str(trace), "--speedup", "10", "--baseline", str(saved), "--json"])
+
+    comparison = json.loads(capsys.readouterr().out)
+    assert "sign_in" in comparison["ops"]
+    assert json.loads(saved.read_text())["operations"] == 10
@@ -0,0 +1,90 @@
+from unittest.mock import patch
+
+import pytest
+
+from src.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+def _fail() -> None:
+    raise RuntimeError("provider down")
+
+
+def test_circuit_breaker_passes_calls() -> None:
+    """Test that a closed circuit passes calls and results through."""
+    breaker = CircuitBreaker("test")
+
+    assert breaker.call(lambda value: value * 2, 21) == 42
+    assert breaker.state == CLOSED
+
+
+def test_circuit_breaker_opens_after_failures() -> None:
+    """Test that the circuit opens after consecutive failures and fails fast."""
+    breaker = CircuitBreaker("test", failure_threshold=2)
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            breaker.call(_fail)
+
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError, match="Circuit for test is open."):
+        breaker.call(lambda: None)
+    assert breaker.snapshot()["rejected_calls"] == 1
+    assert breaker.snapshot()["last_error"] == "RuntimeError('provider down')"
+
+
+def test_circuit_breaker_success_resets_failures() -> None:
+    """Test that a success resets the consecutive failures."""
+    breaker = CircuitBreaker("test", failure_threshold=2)
+
+    with pytest.raises(RuntimeError):
+        breaker.call(_fail)
+    breaker.call(lambda: None)
+    with pytest.raises(RuntimeError):
+        breaker.call(_fail)
+
+    assert breaker.state == CLOSED
+
+
+def test_circuit_breaker_ignores_non_failures() -> None:
+    """Test that errors rejected by is_failure do not open the circuit."""
+    breaker = CircuitBreaker(
+        "test", failure_threshold=1, is_failure=lambda error: not isinstance(error, ValueError)
+    )
+
+    with pytest.raises(ValueError):
+        breaker.call(int, "not a number")
+
+    assert breaker.state == CLOSED
+
+
+def test_circuit_breaker_half_open() -> None:
+    """Test the trial call after the reset timeout."""
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=10)
+
+    with patch("src.breaker.time.monotonic", return_value=100):
+        with pytest.raises(RuntimeError):
+            breaker.call(_fail)
+
+    with patch("src.breaker.time.monotonic", return_value=111):
+        assert breaker.state == HALF_OPEN
+        with pytest.raises(RuntimeError):
+            breaker.call(_fail)
+        assert breaker.state == OPEN
+
+    with patch("src.breaker.time.monotonic", return_value=122):
+        assert breaker.call(lambda: "ok") == "ok"
+        assert breaker.state == CLOSED
+        assert breaker.snapshot()["consecutive_failures"] == 0
+
+
+def test_circuit_breaker_single_trial_call() -> None:
+    """Test that only one trial call is let through while half open."""
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    with pytest.raises(RuntimeError):
+        breaker.call(_fail)
+
+    def trial() -> None:
+        with pytest.raises(CircuitOpenError):
+            breaker.call(lambda: None)
+
+    breaker.call(trial)
@@ -0,0 +1,137 @@
+import os
+import sqlite3
+from pathlib import Path
+from unittest.mock import patch
+
+import mongomock
+import pytest
+
+from src.cache import LRUCache, SQLiteCache, UserCache
+from src.db import CollectionRegistry
+from src.models import User
+from src.utils import delete_user, get_user_by_id, insert_user, update_user_fields
+
+
+def test_lru_cache_evicts_least_recently_used() -> None:
+    """Test that the least recently used entry is evicted when full."""
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.evictions == 1
+
+
+def test_lru_cache_expires() -> None:
+    """Test that entries expire after the ttl."""
+    cache = LRUCache(ttl=10)
+    with patch("src.cache.time.monotonic", return_value=100.0):
+        cache.set("a", 1)
+    with patch("src.cache.time.monotonic", return_value=110.0):
+        assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_sqlite_cache_is_shared(tmp_path: Path) -> None:
+    """Test that entries written by one process are read by another."""
+    path = str(tmp_path / "cache.sqlite3")
+    first_process = SQLiteCache(path)
+    second_process = SQLiteCache(path)
+
+    first_process.set("a", "value")
+    assert second_process.get("a") == "value"
+
+    second_process.delete("a")
+    assert first_process.get("a") is None
+    assert sqlite3.connect(path).execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_sqlite_cache_is_private(tmp_path: Path) -> None:
+    """Test that the database is created for the current user only, and others are refused."""
+    path = tmp_path / "cache.sqlite3"
+    SQLiteCache(str(path)).set("a", "value")
+    assert path.stat().st_mode & 0o777 == 0o600
+
+    path.chmod(0o644)
+    with pytest.raises(PermissionError):
+        SQLiteCache(str(path))
+
+    path.chmod(0o600)
+    with patch("src.cache.os.getuid", return_value=os.getuid() + 1), pytest.raises(PermissionError):
+        SQLiteCache(str(path))
+
+
+def test_sqlite_cache_prune(tmp_path: Path) -> None:
+    """Test that pruning removes expired entries and entries beyond the maximum size."""
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite3"), max_size=2, prune_every=1_000)
+    with patch("src.cache.time.time", return_value=100.0):
+        cache.set("expired", "value")
+    for key in ("a", "b", "c"):
+        cache.set(key, "value")
+
+    cache.prune()
+
+    assert cache.evictions == 2
+    assert cache.get("a") is None
+    assert cache.get("c") == "value"
+
+
+def test_sqlite_cache_errors_are_misses(tmp_path: Path) -> None:
+    """Test that an unusable database does not raise."""
+    cache = SQLiteCache(str(tmp_path / "missing" / "cache.sqlite3"))
+
+    cache.set("a", "value")
+    assert cache.get("a") is None
+
+
+def test_user_cache_tiers(tmp_path: Path) -> None:
+    """Test that a user cached by one process is a shared hit in another."""
+    path = str(tmp_path / "cache.sqlite3")
+    first_process = UserCache(shared=SQLiteCache(path))
+    second_process = UserCache(shared=SQLiteCache(path))
+    user = User(email="sample@mail.com", version=2)
+
+    assert second_process.get(user.id) is None
+    first_process.set(user.id, user)
+
+    cached_user = second_process.get(user.id)
+    assert cached_user is not None
+    assert cached_user.model_dump() == user.model_dump()
+    assert cached_user.changed_fields() == {}
+    cached_user = second_process.get(user.id)
+    assert cached_user is not None and cached_user.id == user.id
+    assert second_process.get(user.id, min_version=3) is None
+    assert second_process.stats() == {
+        "hits": 1,
+        "shared_hits": 1,
+        "misses": 2,
+        "evictions": 0,
+        "shared_evictions": 0,
+        "size": 1,
+    }
+
+
+def test_get_user_by_id_uses_cache() -> None:
+    """Test that cached users are not read from the collection, and writes invalidate them."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    user_cache = UserCache()
+    collections = CollectionRegistry(client, user_cache=user_cache)
+    user = insert_user(collections, User(email="sample@mail.com"))
+
+    assert get_user_by_id(collections, user.id) is not None
+    with patch.object(collections.users, "find_one") as mock_find_one:
+        cached_user = get_user_by_id(collections, user.id)
+    mock_find_one.assert_not_called()
+    assert cached_user is not None and cached_user.email == "sample@mail.com"
+
+    update_user_fields(collections, user.id, name="New Name")
+    updated_user = get_user_by_id(collections, user.id)
+    assert updated_user is not None and updated_user.name == "New Name"
+
+    delete_user(collections, user)
+    assert get_user_by_id(collections, user.id) is None
+    assert user_cache.stats()["hits"] == 1
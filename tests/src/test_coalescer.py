@@ -0,0 +1,95 @@
+import threading
+
+import mongomock
+import pytest
+from pymongo.errors import WriteError
+
+from src.coalescer import InsertCoalescer, get_link_coalescer
+from src.utils import get_magic_link_by_token, insert_magic_link
+
+
+def test_concurrent_inserts_are_batched() -> None:
+    """Test that concurrent inserts are written together, each caller getting its own id."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    coalescer = InsertCoalescer(client, max_wait=0.2)
+    barrier = threading.Barrier(20)
+    results: dict[int, object] = {}
+
+    def insert(number: int) -> None:
+        document = {"number": number}
+        barrier.wait()
+        results[number] = coalescer.insert(document)
+        assert results[number] == document["_id"]
+
+    threads = [threading.Thread(target=insert, args=(number,)) for number in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    coalescer.close()
+
+    collection = client["streamlit-magic-link"]["magic-links"]
+    assert coalescer.inserted == 20
+    assert coalescer.batches < 20
+    for number, inserted_id in results.items():
+        assert collection.find_one({"_id": inserted_id}, {"_id": 0}) == {"number": number}
+
+
+def test_max_batch_size() -> None:
+    """Test that a full batch is written without waiting for `max_wait`."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    coalescer = InsertCoalescer(client, max_batch_size=2, max_wait=60)
+
+    futures = [coalescer.submit({"number": number}) for number in range(4)]
+
+    for future in futures:
+        future.result(timeout=5)
+    assert coalescer.batches == 2
+    coalescer.close()
+
+
+def test_failed_insert_only_fails_its_caller() -> None:
+    """Test that a duplicate key fails the future of that document only."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    client["streamlit-magic-link"]["magic-links"].create_index("token", unique=True)
+    coalescer = InsertCoalescer(client, max_batch_size=3, max_wait=60)
+
+    first = coalescer.submit({"token": "a"})
+    duplicate = coalescer.submit({"token": "a"})
+    other = coalescer.submit({"token": "b"})
+
+    assert first.result(timeout=5) is not None
+    assert other.result(timeout=5) is not None
+    with pytest.raises(WriteError):
+        duplicate.result(timeout=5)
+    assert coalescer.inserted == 2
+    coalescer.close()
+
+
+def test_close_writes_pending_inserts() -> None:
+    """Test that closing writes the pending documents, and later inserts are written directly."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    coalescer = InsertCoalescer(client, max_wait=60)
+
+    future = coalescer.submit({"number": 1})
+    coalescer.close()
+
+    assert future.done()
+    assert coalescer.insert({"number": 2}) is not None
+    assert client["streamlit-magic-link"]["magic-links"].count_documents({}) == 2
+
+
+def test_insert_magic_link_with_coalescer() -> None:
+    """Test that magic links inserted through the coalescer can be redeemed."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    coalescer = get_link_coalescer(client)
+
+    magic_link = insert_magic_link(client, "user-id", coalescer=coalescer)
+
+    assert magic_link.is_saved
+    assert get_link_coalescer(client) is coalescer
+    assert coalescer.inserted == 1
+    stored_link = get_magic_link_by_token(client, magic_link.token)
+    assert stored_link is not None
+    assert stored_link.user_id == "user-id"
+    coalescer.close()
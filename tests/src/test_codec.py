@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+from bson.binary import Binary
+
+from src.codec import CompactCodec
+from src.db import MAGIC_LINKS, USERS, CollectionRegistry
+from src.models import MagicLink, User
+from src.purge import purge_user
+from src.utils import (
+    ensure_indexes,
+    get_active_magic_link,
+    get_magic_link_by_token,
+    get_user_by_email,
+    get_user_by_id,
+    insert_magic_link,
+    insert_user,
+    invalidate_magic_links,
+    update_magic_link,
+    update_user_fields,
+)
+
+
+def _compact_registry(client: mongomock.MongoClient, read_legacy: bool = True) -> CollectionRegistry:
+    return CollectionRegistry(client, codec=CompactCodec(read_legacy=read_legacy))
+
+
+def test_encode_and_decode() -> None:
+    """Test that documents are stored with binary UUIDs, short names and epoch expiry."""
+    codec = CompactCodec()
+    magic_link = MagicLink(user_id=User(email="sample@mail.com").id)
+
+    encoded = codec.encode(MAGIC_LINKS, magic_link.model_dump())
+
+    assert set(encoded) == {"t", "u", "s", "x", "c", "a", "r"}
+    assert isinstance(encoded["t"], Binary) and len(encoded["t"]) == 16
+    assert encoded["x"] == int(magic_link.expiration_time.timestamp())
+    decoded = MagicLink(**codec.decode(MAGIC_LINKS, encoded))
+    assert decoded.token == magic_link.token
+    assert decoded.user_id == magic_link.user_id
+    assert decoded.expiration_time == magic_link.expiration_time.replace(microsecond=0)
+    assert codec.decode(USERS, {"id": "legacy", "email": "a@b.c"}) == {"id": "legacy", "email": "a@b.c"}
+
+
+def test_query_translation() -> None:
+    """Test that queries with operators and logical clauses are translated."""
+    codec = CompactCodec()
+    user_id = User(email="sample@mail.com").id
+    now = datetime.now()
+
+    query = codec.query(
+        MAGIC_LINKS,
+        {"$or": [{"user_id": {"$in": [user_id, "not-a-uuid"]}}], "expiration_time": {"$gt": now}},
+    )
+
+    assert query == {
+        "$or": [{"u": {"$in": [codec.encode_value(MAGIC_LINKS, "user_id", user_id), "not-a-uuid"]}}],
+        "x": {"$gt": int(now.timestamp())},
+    }
+
+
+def test_helpers_with_compact_layout() -> None:
+    """Test that the helpers work unchanged on compact documents."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    registry = _compact_registry(client)
+    ensure_indexes(registry)
+
+    user = insert_user(registry, User(email="Sample@mail.com"))
+    stored_user = client["streamlit-magic-link"]["users"].find_one({}, {"_id": 0})
+    assert stored_user is not None
+    assert set(stored_user) == {"i", "e", "k", "n", "v", "p", "d", "c", "r"}
+
+    retrieved_user = get_user_by_email(registry, "sample@mail.com")
+    assert retrieved_user is not None and retrieved_user.id == user.id
+    updated_user = update_user_fields(registry, user.id, expected_version=0, name="Name")
+    assert updated_user is not None and updated_user.version == 1
+
+    magic_link = insert_magic_link(registry, user.id)
+    other_link = insert_magic_link(registry, user.id)
+    active_link = get_active_magic_link(registry, user.id, datetime.now() - timedelta(minutes=1))
+    assert active_link is not None and active_link.user_id == user.id
+    magic_link.is_used = True
+    assert update_magic_link(registry, magic_link) is not None
+    assert invalidate_magic_links(registry, user.id, except_token=magic_link.token) == 1
+    stored_link = get_magic_link_by_token(registry, other_link.token)
+    assert stored_link is not None and stored_link.is_used
+
+    report = purge_user(registry, user.id)
+    assert (report.users, report.magic_links) == (1, 2)
+    assert get_user_by_id(registry, user.id) is None
+
+
+def test_legacy_documents_are_read_and_written_in_place() -> None:
+    """Test that documents from before the compact layout keep working while they are migrated."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    user = User(email="sample@mail.com")
+    client["streamlit-magic-link"]["users"].insert_one(user.model_dump())
+    registry = _compact_registry(client)
+
+    assert update_user_fields(registry, user.id, expected_version=0, name="Name") is not None
+    retrieved_user = get_user_by_id(registry, user.id)
+    assert retrieved_user is not None and retrieved_user.name == "Name"
+    stored_user = client["streamlit-magic-link"]["users"].find_one({}, {"_id": 0})
+    assert stored_user == {**user.model_dump(), "name": "Name", "version": 1}
+    assert registry.users.count_documents({}) == 1
+
+    assert get_user_by_id(_compact_registry(client, read_legacy=False), user.id) is None
+
+
+def test_compact_layout_is_not_sharded() -> None:
+    """Test that the compact layout cannot be combined with the sharded layout."""
+    with pytest.raises(ValueError):
+        CollectionRegistry(mongomock.MongoClient(), sharded=True, codec=CompactCodec())
@@ -1,6 +1,19 @@
-from src.db import get_user_collection, get_magic_link_collection
+import gc
+import weakref
 from unittest import mock
 
+import mongomock
+from pymongo import WriteConcern
+
+from src.db import (
+    MAGIC_LINKS,
+    USERS,
+    CollectionRegistry,
+    get_magic_link_collection,
+    get_registry,
+    get_user_collection,
+)
+
 
 def test_get_user_collection() -> None:
     """
@@ -32,4 +45,95 @@ def test_get_magic_link_collection() -> None:
     assert result == mock_magic_link_collection
 
     assert mock_client.get_database.called_once()
-    assert mock_database.get_collection.called_once()
\ No newline at end of file
+    assert mock_database.get_collection.called_once()
+
+def test_collection_registry_caches_handles() -> None:
+    """
+    Test that the registry only creates a collection handle once.
+    """
+    mock_client = mock.MagicMock()
+    registry = CollectionRegistry(mock_client)
+
+    assert registry.users is registry.users
+    assert registry.magic_links is registry.magic_links
+    assert mock_client.get_database.call_count == 2
+
+
+def test_collection_registry_names_and_options() -> None:
+    """
+    Test the registry with custom names and per-collection options.
+    """
+    mock_client = mock.MagicMock()
+    write_concern = WriteConcern(w=1)
+    registry = CollectionRegistry(
+        mock_client,
+        database_name="other-db",
+        collection_names={USERS: "other-users"},
+        collection_options={MAGIC_LINKS: {"write_concern": write_concern}},
+    )
+    mock_database = mock_client.get_database.return_value
+
+    registry.users
+    registry.magic_links
+
+    mock_client.get_database.assert_called_with("other-db")
+    mock_database.get_collection.assert_any_call("other-users")
+    mock_database.get_collection.assert_any_call(
+        "magic-links", write_concern=write_concern
+    )
+
+
+def test_collection_registry_reads_env_on_creation() -> None:
+    """
+    Test that the registry reads the environment when it is created.
+    """
+    with mock.patch.dict(
+        "os.environ",
+        {"DATABASE_NAME": "env-db", "COLLECTION_NAME_USERS": "env-users"},
+    ):
+        registry = CollectionRegistry(mock.MagicMock())
+
+    assert registry.database_name == "env-db"
+    assert registry.collection_names[USERS] == "env-users"
+    assert registry.collection_names[MAGIC_LINKS] == "magic-links"
+
+
+def test_collection_registry_with_mongomock() -> None:
+    """
+    Test that the registry applies the write concern to the collection.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    registry = CollectionRegistry(
+        client, collection_options={USERS: {"write_concern": WriteConcern(w=1)}}
+    )
+
+    registry.users.insert_one({"id": "12345"})
+
+    assert registry.users.write_concern == WriteConcern(w=1)
+    assert client["streamlit-magic-link"]["users"].find_one({"id": "12345"})
+
+
+def test_get_registry() -> None:
+    """
+    Test the get_registry function.
+    """
+    mock_client = mock.MagicMock()
+    registry = CollectionRegistry(mock.MagicMock())
+
+    assert get_registry(mock_client) is get_registry(mock_client)
+    assert get_registry(mock_client).client is mock_client
+    assert get_registry(mock.MagicMock()) is not get_registry(mock_client)
+    assert get_registry(registry) is registry
+
+
+def test_get_registry_does_not_keep_the_client_alive() -> None:
+    """
+    Test that the default registry of a client is collected with the client.
+    """
+    mock_client = mock.MagicMock()
+    get_registry(mock_client)
+    reference = weakref.ref(mock_client)
+    del mock_client
+    gc.collect()
+
+    assert reference() is None
@@ -0,0 +1,107 @@
+from collections import deque
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import mongomock
+
+from src.cache import UserCache
+from src.db import CollectionRegistry
+from src.debug import HISTORY_KEY, DebugTrace, render_debug_panel
+from src.events import get_event_log
+from src.magiclink import StreamlitMagicLink
+from src.models import User
+from src.sessions import get_revocation_filter
+from src.transports import MemoryTransport
+from src.utils import insert_user
+
+
+def test_debug_off_wraps_nothing() -> None:
+    """Test that without debug the instance uses the objects it was given."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    collections = CollectionRegistry(mongo_client)
+    cookie_controller = MagicMock()
+    transport = MemoryTransport()
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client, "https://example.com", cookie_controller, collections, transport
+    )
+
+    assert magic_link_auth.collections is collections
+    assert magic_link_auth.cookie_controller is cookie_controller
+    assert magic_link_auth.mail_transport is transport
+    assert magic_link_auth.debug_trace is None
+
+
+def test_debug_shares_untraced_resources() -> None:
+    """Test that process-wide resources first used in a debug session do not record to its trace."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    collections = CollectionRegistry(mongo_client)
+
+    with patch("src.magiclink.st"):
+        magic_link_auth = StreamlitMagicLink(
+            mongo_client, "https://example.com", MagicMock(), collections, MemoryTransport(), debug=True
+        )
+    revocations = get_revocation_filter(magic_link_auth.collections)
+    trace = magic_link_auth.debug_trace
+    assert trace is not None
+    recorded = len(trace.events)
+
+    assert revocations is get_revocation_filter(collections)
+    assert revocations.collections is collections
+    assert get_event_log(magic_link_auth.collections).collections is collections
+    revocations.refresh()
+    assert len(trace.events) == recorded
+
+def test_debug_records_calls() -> None:
+    """Test that database, cookie, cache and mail calls are recorded."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    collections = CollectionRegistry(mongo_client, user_cache=UserCache())
+    user = insert_user(collections, User(email="sample@mail.com"))
+    cookie_controller = MagicMock()
+    cookie_controller.get.return_value = user.model_dump(mode="json")
+    transport = MemoryTransport()
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client,
+        "https://example.com",
+        cookie_controller,
+        collections,
+        transport,
+        legacy_sessions_until=datetime.now() + timedelta(days=1),
+        debug=True,
+    )
+    magic_link_auth.service.request_link("other@mail.com")
+
+    trace = magic_link_auth.debug_trace
+    assert trace is not None
+    names = {(event.kind, event.name) for event in trace.events}
+    assert ("mongo", "users.find_one") in names
+    assert ("mongo", "magic-links.insert_one") in names
+    assert ("cookie", "get") in names
+    assert ("cache", "user_cache.get") in names
+    assert ("mail", "MemoryTransport") in names
+    assert magic_link_auth.mail_transport.sent  # type: ignore[attr-defined]
+    summary = trace.summary()
+    assert summary["mail_calls"] == 1
+    assert summary["cache_misses"] == 1
+    assert collections.user_cache is not None
+    assert collections.user_cache.stats()["misses"] == 1
+
+
+def test_render_debug_panel_keeps_history() -> None:
+    """Test that the panel keeps the summaries of the last reruns."""
+    session_state: dict = {}
+
+    with patch("streamlit.session_state", session_state), patch("streamlit.expander"), patch(
+        "streamlit.columns", return_value=[MagicMock()] * 4
+    ), patch("streamlit.dataframe"), patch("streamlit.caption"):
+        for _ in range(5):
+            trace = DebugTrace()
+            trace.record("mongo", "users.find_one", 0.002)
+            render_debug_panel(trace, history_size=3)
+
+    history = session_state[HISTORY_KEY]
+    assert isinstance(history, deque)
+    assert len(history) == 3
+    assert history[-1]["mongo_calls"] == 1
+    assert history[-1]["mongo_ms"] == 2.0
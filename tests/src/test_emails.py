@@ -0,0 +1,42 @@
+import mongomock
+
+from src.db import CollectionRegistry
+from src.emails import GMAIL_RULES, EmailNormalizer, normalize_email
+from src.models import User
+from src.utils import create_or_retrieve_user, get_user_by_email
+
+
+def test_normalize_email() -> None:
+    """Test that the default normalizer only trims and case-folds."""
+    assert normalize_email(" Sample@Mail.COM\n") == "sample@mail.com"
+    assert normalize_email("first.last+tag@gmail.com") == "first.last+tag@gmail.com"
+    assert normalize_email("Straße@mail.com") == "strasse@mail.com"
+    assert normalize_email("not-an-email") == "not-an-email"
+
+
+def test_gmail_rules() -> None:
+    """Test the provider-specific rules of the Gmail preset."""
+    assert GMAIL_RULES("First.Last+news@Gmail.com") == "firstlast@gmail.com"
+    assert GMAIL_RULES("first.last@googlemail.com") == "firstlast@gmail.com"
+    assert GMAIL_RULES("first.last+news@mail.com") == "first.last+news@mail.com"
+
+
+def test_email_normalizer() -> None:
+    """Test custom provider-specific rules."""
+    normalizer = EmailNormalizer(plus_tag_domains=["Mail.com"], domain_aliases={"Old.com": "mail.com"})
+
+    assert normalizer("first.last+news@old.com") == "first.last@mail.com"
+
+
+def test_registry_email_normalizer() -> None:
+    """Test that lookups use the normalizer of the registry."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    registry = CollectionRegistry(client, email_normalizer=GMAIL_RULES)
+
+    user = create_or_retrieve_user(registry, "first.last@gmail.com")
+    retrieved_user = get_user_by_email(registry, "FirstLast+news@gmail.com")
+
+    assert retrieved_user is not None
+    assert retrieved_user.id == user.id
+    assert get_user_by_email(client, "FirstLast+news@gmail.com") is None
+    assert isinstance(retrieved_user, User)
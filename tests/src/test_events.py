@@ -0,0 +1,112 @@
+from unittest.mock import MagicMock
+
+import mongomock
+
+from src.db import CollectionRegistry
+from src.events import (
+    LINK_ISSUED,
+    LINK_REDEEMED,
+    EventLog,
+    ensure_event_indexes,
+    get_event_log,
+    hash_token,
+)
+
+
+def _events(mongo_client: mongomock.MongoClient) -> mongomock.Collection:
+    return mongo_client["streamlit-magic-link"]["auth-events"]
+
+
+def test_hash_token() -> None:
+    """Test that tokens are hashed to a stable digest."""
+    assert hash_token("token") == hash_token("token")
+    assert hash_token("token") != hash_token("other-token")
+    assert "token" not in hash_token("token")
+
+
+def test_record_is_buffered_until_flush() -> None:
+    """Test that recording an event does not write to the database."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    ensure_event_indexes(mongo_client)
+    event_log = EventLog(mongo_client, flush_interval=60)
+
+    event_log.record(LINK_ISSUED, outcome="sent", user_id="user-1", token="secret-token")
+
+    assert len(event_log) == 1
+    assert _events(mongo_client).count_documents({}) == 0
+
+    assert event_log.flush() == 1
+    event = _events(mongo_client).find_one({}, {"_id": 0})
+    assert event is not None
+    assert event["event"] == LINK_ISSUED
+    assert event["outcome"] == "sent"
+    assert event["token_hash"] == hash_token("secret-token")
+    assert "secret-token" not in str(event)
+    event_log.close()
+
+
+def test_flush_writes_in_batches() -> None:
+    """Test that the buffer is written with one insert per batch."""
+    collection = MagicMock()
+    collections = MagicMock(spec=CollectionRegistry)
+    collections.events = collection
+    collections.scope.side_effect = lambda document: document
+    event_log = EventLog(collections, batch_size=10, flush_interval=60)
+    event_log._stopped.set()  # no background writer
+
+    for _ in range(25):
+        event_log.record(LINK_REDEEMED, outcome="valid")
+
+    assert event_log.flush() == 25
+    assert [len(call.args[0]) for call in collection.insert_many.call_args_list] == [10, 10, 5]
+
+
+def test_buffer_is_bounded() -> None:
+    """Test that the oldest events are dropped when the buffer is full."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    event_log = EventLog(mongo_client, max_buffered=3, batch_size=100, flush_interval=60)
+    event_log._stopped.set()  # no background writer
+
+    for number in range(5):
+        event_log.record(LINK_ISSUED, user_id=f"user-{number}")
+
+    assert len(event_log) == 3
+    assert event_log.dropped == 2
+    event_log.flush()
+    assert sorted(_events(mongo_client).distinct("user_id")) == ["user-2", "user-3", "user-4"]
+
+
+def test_failed_write_is_counted() -> None:
+    """Test that events of a failed write are dropped and counted."""
+    collections = MagicMock(spec=CollectionRegistry)
+    collections.events.insert_many.side_effect = Exception("unavailable")
+    collections.scope.side_effect = lambda document: document
+    event_log = EventLog(collections, flush_interval=60)
+    event_log._stopped.set()  # no background writer
+
+    event_log.record(LINK_ISSUED)
+
+    assert event_log.flush() == 0
+    assert event_log.dropped == 1
+    assert len(event_log) == 0
+
+
+def test_background_writer_and_close() -> None:
+    """Test that the writer flushes full batches and close flushes the rest."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    event_log = EventLog(mongo_client, batch_size=2, flush_interval=60)
+
+    event_log.record(LINK_ISSUED)
+    event_log.record(LINK_ISSUED)
+    event_log.record(LINK_ISSUED)
+    event_log.close()
+
+    assert _events(mongo_client).count_documents({}) == 3
+    assert event_log._thread is not None and not event_log._thread.is_alive()
+
+
+def test_get_event_log_is_shared() -> None:
+    """Test that the event log is shared per registry."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+
+    assert get_event_log(mongo_client) is get_event_log(mongo_client)
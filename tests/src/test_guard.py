@@ -0,0 +1,140 @@
+from typing import Any
+from unittest.mock import MagicMock, patch
+
+import mongomock
+import pytest
+
+from src.guard import AuthState, PageGuard
+from src.magiclink import AUTH_STATE_KEY, StreamlitMagicLink
+from src.models import User
+from src.sessions import create_session
+from src.utils import get_user_fields, insert_user
+
+
+class _Stop(Exception):
+    """Raised by the fake `st.stop` and `st.switch_page`, like Streamlit stops the script."""
+
+
+class _Cookies:
+    def __init__(self, user: Any = None):
+        self.cookies = {"user": user} if user else {}
+
+    def get(self, name: str) -> Any:
+        return self.cookies.get(name)
+
+    def set(self, name: str, value: Any) -> None:
+        self.cookies[name] = value
+
+    def remove(self, name: str) -> None:
+        self.cookies.pop(name, None)
+
+
+@pytest.fixture
+def streamlit() -> Any:
+    with patch("src.guard.st") as mock_streamlit, patch("src.magiclink.st", mock_streamlit):
+        mock_streamlit.session_state = {}
+        mock_streamlit.query_params.get.return_value = None
+        mock_streamlit.stop.side_effect = _Stop
+        mock_streamlit.switch_page.side_effect = _Stop
+        yield mock_streamlit
+
+
+def _signed_in(client: mongomock.MongoClient, **fields: Any) -> _Cookies:
+    user = insert_user(client, User(email="sample@mail.com", **fields))
+    session = create_session(client, user.id)
+    return _Cookies({**user.model_dump(mode="json"), "session_id": session.id})
+
+
+def test_user_is_cached_for_the_session(streamlit: Any) -> None:
+    """Test that page switches within the freshness window do not construct StreamlitMagicLink."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    guard = PageGuard(client, "https://example.com", cookie_controller=_signed_in(client))
+
+    with patch("src.guard.StreamlitMagicLink", wraps=StreamlitMagicLink) as magic_link, patch(
+        "src.service.get_user_fields", wraps=get_user_fields
+    ) as user_fields:
+        for _ in range(3):
+            assert guard.user is not None
+            assert guard.check()["email"] == "sample@mail.com"
+
+    assert magic_link.call_count == 1
+    assert user_fields.call_count == 1
+    assert isinstance(streamlit.session_state[AUTH_STATE_KEY], AuthState)
+
+
+def test_user_is_checked_again_after_freshness(streamlit: Any) -> None:
+    """Test that a stale cached user is checked again."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    cookies = _signed_in(client)
+    guard = PageGuard(client, "https://example.com", cookie_controller=cookies)
+
+    with patch("src.guard.time.monotonic", return_value=100.0):
+        assert guard.user is not None
+    cookies.remove("user")
+    with patch("src.guard.time.monotonic", return_value=129.0):
+        assert guard.user is not None
+    with patch("src.guard.time.monotonic", return_value=130.0):
+        assert guard.user is None
+
+
+def test_unauthenticated_user_is_redirected(streamlit: Any) -> None:
+    """Test that nobody signed in switches to the login page, or stops the page."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+
+    with pytest.raises(_Stop):
+        PageGuard(client, "https://example.com", login_page="login.py", cookie_controller=_Cookies()).check()
+    streamlit.switch_page.assert_called_once_with("login.py")
+
+    with pytest.raises(_Stop):
+        PageGuard(client, "https://example.com", cookie_controller=_Cookies()).check()
+    streamlit.info.assert_called_once_with("Please sign in to see this page.")
+
+
+def test_require_payed_user(streamlit: Any) -> None:
+    """Test that a page requiring a paying user stops for other users."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    guard = PageGuard(client, "https://example.com", cookie_controller=_signed_in(client, is_verified=True))
+    page = MagicMock()
+
+    with pytest.raises(_Stop):
+        guard.require(payed_user=True)(page)()
+    page.assert_not_called()
+    streamlit.warning.assert_called_once_with("This page is only available to paying users.")
+
+    guard.require(verified=True)(page)()
+    page.assert_called_once()
+
+
+def test_require_payed_user_with_edited_cookie(streamlit: Any) -> None:
+    """Test that a paying user flag set by editing the cookie is not trusted."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    cookies = _signed_in(client)
+    cookies.set("user", {**cookies.get("user"), "is_payed_user": True})
+    guard = PageGuard(client, "https://example.com", cookie_controller=cookies)
+
+    with pytest.raises(_Stop):
+        guard.check(payed_user=True)
+    streamlit.warning.assert_called_once_with("This page is only available to paying users.")
+    assert cookies.get("user")["is_payed_user"] is False
+
+
+def test_require_as_context_manager(streamlit: Any) -> None:
+    """Test that the context manager returns the user."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    guard = PageGuard(client, "https://example.com", cookie_controller=_signed_in(client, is_payed_user=True))
+
+    with guard.require(payed_user=True) as user:
+        assert user["is_payed_user"]
+
+
+def test_changing_the_user_drops_the_cache(streamlit: Any) -> None:
+    """Test that updating the user through StreamlitMagicLink drops the cached user."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    guard = PageGuard(client, "https://example.com", cookie_controller=_signed_in(client))
+
+    assert guard.user is not None
+    guard.magic_link().update_user(name="Name")
+
+    assert AUTH_STATE_KEY not in streamlit.session_state
+    assert guard.user is not None
+    assert guard.user["name"] == "Name"
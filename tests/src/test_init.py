@@ -0,0 +1,43 @@
+import logging
+import subprocess
+import sys
+
+import pytest
+
+import src
+from benchmarks.import_time import measure_import
+from src.magiclink import StreamlitMagicLink
+
+
+@pytest.mark.parametrize(
+    "module, allowed",
+    [
+        ("src", []),
+        ("src.db", []),
+        ("src.models", ["pydantic"]),
+        ("src.utils", ["pydantic"]),
+        ("src.mail", ["requests"]),
+        ("src.service", ["pymongo", "pydantic"]),
+    ],
+)
+def test_import_does_not_load_heavy_modules(module: str, allowed: list[str]) -> None:
+    """Test that importing the package does not load heavy dependencies."""
+    _, loaded = measure_import(module)
+    assert set(loaded) <= set(allowed)
+
+
+def test_import_does_not_configure_logging() -> None:
+    """Test that importing the package leaves the logging setup untouched."""
+    code = "import logging, src.mail, src.utils; print(len(logging.getLogger().handlers))"
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "0"
+    assert logging.getLogger("src.mail").level == logging.NOTSET
+
+
+def test_lazy_streamlit_magic_link() -> None:
+    """Test that the public class is available from the package."""
+    assert src.StreamlitMagicLink is StreamlitMagicLink
+    with pytest.raises(AttributeError):
+        src.DoesNotExist  # noqa: B018
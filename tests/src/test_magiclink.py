@@ -1,17 +1,25 @@
+import uuid
 from datetime import datetime, timedelta
 from typing import Optional
-from unittest.mock import MagicMock, patch
+from unittest.mock import ANY, MagicMock, patch
 
 import mongomock
+import pytest
 
+from src.breaker import CircuitOpenError
+from src.db import CollectionRegistry
 from src.magiclink import StreamlitMagicLink
+from src.mail import DEFAULT_DEADLINE, DEFAULT_TIMEOUT
 from src.models import User, MagicLink
+from src.sessions import create_session, revoke_session
+from src.transports import MemoryTransport
 from src.utils import (
     get_user_by_email,
     get_user_by_id,
     insert_magic_link,
     update_magic_link,
     update_user,
+    update_user_fields,
 )
 
 
@@ -59,8 +67,8 @@ def test_authenticate() -> None:
 
     with (
         patch("src.magiclink.st.toast") as mock_toast,
-        patch("src.magiclink.send_email") as mock_send_email,
-        patch("src.magiclink.insert_magic_link") as mock_insert_magic_link,
+        patch("src.mail.send_email") as mock_send_email,
+        patch("src.service.insert_magic_link") as mock_insert_magic_link,
     ):
         mock_insert_magic_link.return_value = MagicLink(
             token=fake_magic_link_token, user_id=sample_user.id
@@ -74,6 +82,9 @@ def test_authenticate() -> None:
             to_email=sample_user.email,
             body=f"Click the link to sign in: {base_url}?token={fake_magic_link_token}",
             subject="Your Magic Link",
+            timeout=DEFAULT_TIMEOUT,
+            max_retries=2,
+            deadline=DEFAULT_DEADLINE,
         )
 
 
@@ -144,7 +155,8 @@ def test_sign_out() -> None:
     cookie_controller = MagicMock()
 
     sample_user = _set_user(mongo_client)
-    cookie_controller.get.return_value = sample_user.model_dump()
+    session = create_session(mongo_client, sample_user.id)
+    cookie_controller.get.return_value = {**sample_user.model_dump(), "session_id": session.id}
 
     magic_link_auth = StreamlitMagicLink(mongo_client, base_url, cookie_controller)
 
@@ -335,7 +347,7 @@ def test_handle_magic_link() -> None:
 
     magic_link_auth = StreamlitMagicLink(mongo_client, base_url, cookie_controller)
 
-    retrieved_user = magic_link_auth._handle_magic_link(magic_link.token)
+    retrieved_user = magic_link_auth.service.redeem(magic_link.token)
 
     assert retrieved_user is not None
     assert retrieved_user.id == sample_user.id
@@ -349,7 +361,7 @@ def test_handle_magic_link_invalid_token() -> None:
 
     magic_link_auth = StreamlitMagicLink(mongo_client, base_url, cookie_controller)
 
-    retrieved_user = magic_link_auth._handle_magic_link("invalid_token")
+    retrieved_user = magic_link_auth.service.redeem("invalid_token")
 
     assert retrieved_user is None
 
@@ -367,7 +379,7 @@ def test_handle_magic_link_expired_token() -> None:
 
     magic_link_auth = StreamlitMagicLink(mongo_client, base_url, cookie_controller)
 
-    retrieved_user = magic_link_auth._handle_magic_link(magic_link.token)
+    retrieved_user = magic_link_auth.service.redeem(magic_link.token)
 
     assert retrieved_user is None
 
@@ -382,7 +394,7 @@ def test_handle_magic_link_without_user() -> None:
 
     magic_link_auth = StreamlitMagicLink(mongo_client, base_url, cookie_controller)
 
-    retrieved_user = magic_link_auth._handle_magic_link(magic_link.token)
+    retrieved_user = magic_link_auth.service.redeem(magic_link.token)
 
     assert retrieved_user is None
 
@@ -396,7 +408,7 @@ def test_validate_magic_link() -> None:
 
     magic_link_auth = StreamlitMagicLink(mongo_client, "")
 
-    validated = magic_link_auth._validate_magic_link(magic_link, magic_link.token)
+    validated = magic_link_auth.service.validate(magic_link, magic_link.token)
 
     assert validated is True
 
@@ -412,7 +424,7 @@ def test_validate_magic_link_used_token() -> None:
 
     magic_link_auth = StreamlitMagicLink(mongo_client, "")
 
-    validated = magic_link_auth._validate_magic_link(magic_link, magic_link.token)
+    validated = magic_link_auth.service.validate(magic_link, magic_link.token)
 
     assert validated is False
 
@@ -428,7 +440,7 @@ def test_validate_magic_link_expired_token() -> None:
 
     magic_link_auth = StreamlitMagicLink(mongo_client, "")
 
-    validated = magic_link_auth._validate_magic_link(magic_link, magic_link.token)
+    validated = magic_link_auth.service.validate(magic_link, magic_link.token)
 
     assert validated is False
 
@@ -441,8 +453,8 @@ def test_send_magic_link() -> None:
 
     magic_link_auth = StreamlitMagicLink(mongo_client, "")
 
-    with patch("src.magiclink.send_email") as mock_send_email:
-        magic_link_auth._send_magic_link(email)
+    with patch("src.mail.send_email") as mock_send_email:
+        magic_link_auth.service.request_link(email)
 
         created_user = get_user_by_email(mongo_client, email)
         assert created_user is not None
@@ -470,3 +482,460 @@ def _set_user(
         user = User(email="sample@mail.com")
     mongo_client["streamlit-magic-link"]["users"].insert_one(user.model_dump())
     return user
+
+
+def test_initiate_magic_link_with_collection_registry() -> None:
+    """Test using a collection registry with custom names."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    collections = CollectionRegistry(
+        mongo_client, database_name="other-db", collection_names={"users": "people"}
+    )
+    cookie_controller = MagicMock()
+
+    sample_user = User(email="sample@mail.com")
+    mongo_client["other-db"]["people"].insert_one(sample_user.model_dump())
+    cookie_controller.get.return_value = sample_user.model_dump()
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client,
+        "https://example.com",
+        cookie_controller,
+        collections,
+        legacy_sessions_until=datetime.now() + timedelta(days=1),
+    )
+
+    assert magic_link_auth.collections is collections
+    cookie_controller.remove.assert_not_called()
+    cookie_controller.set.assert_called_once_with(
+        "user", {**sample_user.model_dump(), "session_id": ANY}
+    )
+
+
+def test_send_magic_link_with_mail_transport() -> None:
+    """Test sending a magic link through a custom mail transport."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    mail_transport = MemoryTransport()
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client, "https://example.com", MagicMock(), mail_transport=mail_transport
+    )
+    magic_link_auth.service.request_link("sample@mail.com")
+
+    created_magic_link = mongo_client["streamlit-magic-link"]["magic-links"].find_one()
+    assert created_magic_link is not None
+    assert len(mail_transport.sent) == 1
+    assert mail_transport.sent[0].to_email == "sample@mail.com"
+    assert mail_transport.sent[0].body == (
+        f"Click the link to sign in: https://example.com?token={created_magic_link['token']}"
+    )
+
+
+def test_send_magic_link_with_outbox() -> None:
+    """Test that the magic link email is written to the outbox."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    mail_transport = MemoryTransport()
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client,
+        "https://example.com",
+        MagicMock(),
+        mail_transport=mail_transport,
+        use_outbox=True,
+    )
+    magic_link_auth.service.request_link("sample@mail.com")
+
+    created_magic_link = mongo_client["streamlit-magic-link"]["magic-links"].find_one()
+    job = mongo_client["streamlit-magic-link"]["mail-outbox"].find_one()
+    assert created_magic_link is not None
+    assert job is not None
+    assert job["to_email"] == "sample@mail.com"
+    assert created_magic_link["token"] in job["body"]
+    assert mail_transport.sent == []
+
+
+def test_send_magic_link_with_outbox_transaction() -> None:
+    """Test that the magic link and its outbox job share a transaction."""
+    mongo_client = MagicMock()
+    session = mongo_client.start_session.return_value.__enter__.return_value
+    session.with_transaction.side_effect = lambda callback: callback(session)
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client,
+        "https://example.com",
+        MagicMock(get=MagicMock(return_value=None)),
+        use_outbox=True,
+        use_transactions=True,
+        reuse_window=None,
+    )
+    with (
+        patch("src.service.create_or_retrieve_user") as mock_create_user,
+        patch("src.service.insert_magic_link") as mock_insert_magic_link,
+        patch("src.service.enqueue_email") as mock_enqueue_email,
+    ):
+        mock_create_user.return_value = User(email="sample@mail.com")
+        mock_insert_magic_link.return_value = MagicLink(user_id="12345")
+        magic_link_auth.service.request_link("sample@mail.com")
+
+    session.with_transaction.assert_called_once()
+    assert mock_insert_magic_link.call_args.kwargs["session"] is session
+    assert mock_enqueue_email.call_args.kwargs["session"] is session
+
+
+def test_authenticate_with_open_circuit() -> None:
+    """Test that the user is asked to try again when the mail provider is unavailable."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    mail_transport = MagicMock()
+    mail_transport.send.side_effect = CircuitOpenError("Circuit for mailjet is open.")
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client, "https://example.com", MagicMock(), mail_transport=mail_transport
+    )
+    with patch("src.magiclink.st.toast") as mock_toast:
+        magic_link_auth.authenticate("sample@mail.com")
+
+    mock_toast.assert_called_once_with(
+        "Sign-in emails are temporarily unavailable. Please try again later.",
+        icon=":material/error:",
+    )
+    assert mongo_client["streamlit-magic-link"]["mail-outbox"].find_one() is None
+
+
+def test_send_magic_link_outbox_fallback() -> None:
+    """Test that the email is written to the outbox when the circuit is open."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    mail_transport = MagicMock()
+    mail_transport.send.side_effect = CircuitOpenError("Circuit for mailjet is open.")
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client,
+        "https://example.com",
+        MagicMock(),
+        mail_transport=mail_transport,
+        outbox_fallback=True,
+    )
+    magic_link_auth.service.request_link("sample@mail.com")
+
+    job = mongo_client["streamlit-magic-link"]["mail-outbox"].find_one()
+    assert job is not None
+    assert job["to_email"] == "sample@mail.com"
+
+
+def test_send_magic_link_reuses_outstanding_link() -> None:
+    """Test that a repeated request within the reuse window does not send another email."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    mail_transport = MemoryTransport()
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client, "https://example.com", MagicMock(), mail_transport=mail_transport
+    )
+    magic_link_auth.service.request_link("sample@mail.com")
+    magic_link_auth.service.request_link("sample@mail.com")
+
+    assert mongo_client["streamlit-magic-link"]["magic-links"].count_documents({}) == 1
+    assert len(mail_transport.sent) == 1
+
+
+def test_send_magic_link_without_reuse_window() -> None:
+    """Test that every request sends a new link without a reuse window."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    mail_transport = MemoryTransport()
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client,
+        "https://example.com",
+        MagicMock(),
+        mail_transport=mail_transport,
+        reuse_window=None,
+    )
+    magic_link_auth.service.request_link("sample@mail.com")
+    magic_link_auth.service.request_link("sample@mail.com")
+
+    assert mongo_client["streamlit-magic-link"]["magic-links"].count_documents({}) == 2
+    assert len(mail_transport.sent) == 2
+
+
+def test_send_magic_link_failed_send_is_not_reused() -> None:
+    """Test that a magic link whose email failed is not reused by the next request."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    mail_transport = MagicMock()
+    mail_transport.send.side_effect = [RuntimeError("provider down"), None]
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client, "https://example.com", MagicMock(), mail_transport=mail_transport
+    )
+    with pytest.raises(RuntimeError):
+        magic_link_auth.service.request_link("sample@mail.com")
+    magic_link_auth.service.request_link("sample@mail.com")
+
+    assert mail_transport.send.call_count == 2
+    assert mongo_client["streamlit-magic-link"]["magic-links"].count_documents(
+        {"is_used": False}
+    ) == 1
+
+
+def test_handle_magic_link_invalidates_other_links() -> None:
+    """Test that redeeming a magic link invalidates the user's other links."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+
+    sample_user = _set_user(mongo_client)
+    other_magic_link = insert_magic_link(mongo_client, sample_user.id)
+    magic_link = insert_magic_link(mongo_client, sample_user.id)
+
+    magic_link_auth = StreamlitMagicLink(mongo_client, "https://example.com", MagicMock())
+
+    assert magic_link_auth.service.redeem(magic_link.token) is not None
+    assert magic_link_auth.service.redeem(other_magic_link.token) is None
+
+
+def test_sign_in_creates_session() -> None:
+    """Test that signing in stores a new session id in the cookie."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    cookie_controller = MagicMock()
+    cookie_controller.get.return_value = None
+
+    sample_user = _set_user(mongo_client)
+    magic_link = insert_magic_link(mongo_client, sample_user.id)
+
+    magic_link_auth = StreamlitMagicLink(mongo_client, "https://example.com", cookie_controller)
+
+    with patch("src.magiclink.st") as mock_streamlit:
+        mock_streamlit.query_params.get.return_value = magic_link.token
+        magic_link_auth.sign_in()
+
+    name, value = cookie_controller.set.call_args.args
+    assert name == "user"
+    sessions = mongo_client["streamlit-magic-link"]["sessions"]
+    assert sessions.count_documents(
+        {"id": value["session_id"], "user_id": sample_user.id, "revoked_at": None}
+    ) == 1
+
+
+def test_sync_user_with_revoked_session() -> None:
+    """Test that a cookie of a revoked session is removed."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    cookie_controller = MagicMock()
+
+    sample_user = _set_user(mongo_client)
+    session = create_session(mongo_client, sample_user.id)
+    revoke_session(mongo_client, session.id)
+    cookie_controller.get.return_value = {**sample_user.model_dump(), "session_id": session.id}
+
+    with patch("src.magiclink.time.sleep"):
+        StreamlitMagicLink(mongo_client, "https://example.com", cookie_controller)
+
+    cookie_controller.remove.assert_called_once_with("user")
+    cookie_controller.set.assert_not_called()
+
+
+def test_sync_user_without_session_creates_one() -> None:
+    """Test that a cookie from before sessions gets a session."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    cookie_controller = MagicMock()
+
+    sample_user = _set_user(mongo_client)
+    cookie_controller.get.return_value = {**sample_user.model_dump(), "session_id": None}
+
+    StreamlitMagicLink(
+        mongo_client,
+        "https://example.com",
+        cookie_controller,
+        legacy_sessions_until=datetime.now() + timedelta(days=1),
+    )
+
+    _, value = cookie_controller.set.call_args.args
+    assert isinstance(value["session_id"], str)
+    assert mongo_client["streamlit-magic-link"]["sessions"].count_documents({}) == 1
+
+
+def test_sync_user_without_session_after_cutoff() -> None:
+    """Test that a cookie from before sessions is removed after the upgrade cutoff."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    cookie_controller = MagicMock()
+
+    sample_user = _set_user(mongo_client)
+    cookie_controller.get.return_value = {**sample_user.model_dump(), "session_id": None}
+
+    with patch("src.magiclink.time.sleep"):
+        StreamlitMagicLink(
+            mongo_client,
+            "https://example.com",
+            cookie_controller,
+            legacy_sessions_until=datetime.now() - timedelta(days=1),
+        )
+
+    cookie_controller.remove.assert_called_once_with("user")
+    assert mongo_client["streamlit-magic-link"]["sessions"].count_documents({}) == 0
+
+
+def test_sync_user_with_unknown_session() -> None:
+    """Test that a cookie with a made-up session or a session of another user is removed."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    sample_user = _set_user(mongo_client)
+    other_session = create_session(mongo_client, "other-user")
+
+    for session_id in (str(uuid.uuid4()), other_session.id):
+        cookie_controller = MagicMock()
+        cookie_controller.get.return_value = {**sample_user.model_dump(), "session_id": session_id}
+        with patch("src.magiclink.time.sleep"):
+            StreamlitMagicLink(mongo_client, "https://example.com", cookie_controller)
+        cookie_controller.remove.assert_called_once_with("user")
+        cookie_controller.set.assert_not_called()
+
+
+def test_sign_out_everywhere() -> None:
+    """Test that signing out everywhere revokes all sessions of the user."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    cookie_controller = MagicMock()
+
+    sample_user = _set_user(mongo_client)
+    session = create_session(mongo_client, sample_user.id)
+    other_session = create_session(mongo_client, sample_user.id)
+    cookie_controller.get.return_value = {**sample_user.model_dump(), "session_id": session.id}
+
+    magic_link_auth = StreamlitMagicLink(mongo_client, "https://example.com", cookie_controller)
+
+    with patch("src.magiclink.st") as mock_streamlit, patch("src.magiclink.time.sleep"):
+        magic_link_auth.sign_out_everywhere()
+
+        mock_streamlit.rerun.assert_called_once()
+    cookie_controller.remove.assert_called_once_with("user")
+    sessions = mongo_client["streamlit-magic-link"]["sessions"]
+    assert sessions.count_documents({"revoked_at": None}) == 0
+
+    other_cookie_controller = MagicMock()
+    other_cookie_controller.get.return_value = {
+        **sample_user.model_dump(),
+        "session_id": other_session.id,
+    }
+    with patch("src.magiclink.time.sleep"):
+        StreamlitMagicLink(mongo_client, "https://example.com", other_cookie_controller)
+    other_cookie_controller.remove.assert_called_once_with("user")
+
+    # Dropping the session id from the cookie does not undo signing out everywhere.
+    legacy_cookie_controller = MagicMock()
+    legacy_cookie_controller.get.return_value = {**sample_user.model_dump(), "session_id": None}
+    with patch("src.magiclink.time.sleep"):
+        StreamlitMagicLink(
+            mongo_client,
+            "https://example.com",
+            legacy_cookie_controller,
+            legacy_sessions_until=datetime.now() + timedelta(days=1),
+        )
+    legacy_cookie_controller.remove.assert_called_once_with("user")
+    legacy_cookie_controller.set.assert_not_called()
+
+
+def test_handle_magic_link_records_events() -> None:
+    """Test that redemption outcomes are recorded without the raw token."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    event_log = MagicMock()
+
+    sample_user = _set_user(mongo_client)
+    magic_link = insert_magic_link(mongo_client, sample_user.id)
+
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client, "https://example.com", MagicMock(), event_log=event_log
+    )
+
+    assert magic_link_auth.service.redeem(magic_link.token) is not None
+    unknown_token = str(uuid.uuid4())
+    assert magic_link_auth.service.redeem(unknown_token) is None
+
+    event_log.record.assert_any_call(
+        "link_redeemed", outcome="valid", user_id=sample_user.id, token=magic_link.token
+    )
+    event_log.record.assert_any_call(
+        "link_redeemed", outcome="not_found", user_id=None, token=unknown_token
+    )
+
+
+def test_send_magic_link_records_event() -> None:
+    """Test that issuing a magic link is recorded."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    event_log = MagicMock()
+    magic_link_auth = StreamlitMagicLink(
+        mongo_client,
+        "https://example.com",
+        MagicMock(),
+        mail_transport=MemoryTransport(),
+        event_log=event_log,
+    )
+
+    magic_link_auth.service.request_link("sample@mail.com")
+    magic_link_auth.service.request_link("sample@mail.com")
+
+    outcomes = [call.kwargs["outcome"] for call in event_log.record.call_args_list]
+    assert outcomes == ["sent", "reused"]
+
+
+def test_sync_user_skips_cookie_write_when_current() -> None:
+    """Test that an unchanged user is not loaded nor written to the cookie."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    cookie_controller = MagicMock()
+
+    sample_user = _set_user(mongo_client)
+    session = create_session(mongo_client, sample_user.id)
+    cookie_controller.get.return_value = {**sample_user.model_dump(), "session_id": session.id}
+
+    with patch("src.service.get_user_by_id") as mock_get_user_by_id:
+        StreamlitMagicLink(mongo_client, "https://example.com", cookie_controller)
+
+    mock_get_user_by_id.assert_not_called()
+    cookie_controller.set.assert_not_called()
+
+    update_user_fields(mongo_client, sample_user.id, name="Changed Elsewhere")
+    StreamlitMagicLink(mongo_client, "https://example.com", cookie_controller)
+
+    _, value = cookie_controller.set.call_args.args
+    assert value["name"] == "Changed Elsewhere"
+    assert value["version"] == 1
+
+
+def test_update_user_version_conflict() -> None:
+    """Test that a profile update based on a stale cookie is rejected."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    cookie_controller = MagicMock()
+
+    sample_user = _set_user(mongo_client)
+    session = create_session(mongo_client, sample_user.id)
+    cookie_controller.get.return_value = {**sample_user.model_dump(), "session_id": session.id}
+    magic_link_auth = StreamlitMagicLink(mongo_client, "https://example.com", cookie_controller)
+    update_user_fields(mongo_client, sample_user.id, name="Changed Elsewhere")
+
+    with patch("src.magiclink.st") as mock_streamlit:
+        magic_link_auth.update_user(name="New Name")
+
+        mock_streamlit.toast.assert_called_once_with(
+            "Your profile was changed elsewhere. Please review it and try again.",
+            icon=":material/error:",
+        )
+    updated_user = get_user_by_id(mongo_client, sample_user.id)
+    assert updated_user is not None
+    assert updated_user.name == "Changed Elsewhere"
+
+
+def test_handle_magic_link_rejects_malformed_token() -> None:
+    """Test that malformed tokens do not reach the database."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    magic_link_auth = StreamlitMagicLink(mongo_client, "https://example.com", MagicMock())
+
+    with patch("src.service.get_magic_link_by_token") as mock_get_magic_link_by_token:
+        assert magic_link_auth.service.redeem("../../etc/passwd") is None
+        assert magic_link_auth.service.redeem("x" * 10_000) is None
+
+    mock_get_magic_link_by_token.assert_not_called()
+
+
+def test_handle_magic_link_caches_unknown_token() -> None:
+    """Test that an unknown token is looked up only once."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    magic_link_auth = StreamlitMagicLink(mongo_client, "https://example.com", MagicMock())
+    unknown_token = str(uuid.uuid4())
+
+    with patch(
+        "src.service.get_magic_link_by_token", return_value=None
+    ) as mock_get_magic_link_by_token:
+        assert magic_link_auth.service.redeem(unknown_token) is None
+        assert magic_link_auth.service.redeem(unknown_token) is None
+
+    mock_get_magic_link_by_token.assert_called_once()
@@ -1,6 +1,16 @@
-from src.mail import send_email, _set_mailjet_api_auth, _create_email_payload
+from typing import Optional
 from unittest.mock import MagicMock, patch
+
 import pytest
+import requests
+
+from src.mail import (
+    _create_email_payload,
+    _retry_after,
+    _set_mailjet_api_auth,
+    is_transient_error,
+    send_email,
+)
 
 
 def test_send_email() -> None:
@@ -126,3 +136,162 @@ def test_create_email_payload() -> None:
     }
     payload = _create_email_payload(from_email, to_email, body, subject)
     assert payload == expected_payload
+
+
+def _response(status_code: int, headers: Optional[dict] = None) -> MagicMock:
+    response = MagicMock(status_code=status_code, headers=headers or {})
+    if status_code >= 400:
+        response.raise_for_status.side_effect = requests.HTTPError(response=response)
+    return response
+
+
+MAILJET_ENV = {
+    "MAILJET_API_KEY": "test_key",
+    "MAILJET_API_SECRET": "test_secret",
+    "FROM_EMAIL": "from@mail.com",
+}
+
+
+def test_send_email_uses_timeout() -> None:
+    """
+    Test that the request to Mailjet has a timeout.
+    """
+    with (
+        patch.dict("os.environ", MAILJET_ENV),
+        patch("src.mail.requests.Session") as mock_session,
+    ):
+        session = mock_session.return_value.__enter__.return_value
+        session.post.return_value = _response(200)
+        send_email(to_email="to@mail.com", body="body", subject="subject", timeout=2.5)
+
+    assert session.post.call_args.kwargs["timeout"] == 2.5
+
+
+def test_send_email_retries_transient_errors() -> None:
+    """
+    Test that 5xx responses and connection errors are retried.
+    """
+    with (
+        patch.dict("os.environ", MAILJET_ENV),
+        patch("src.mail.requests.Session") as mock_session,
+        patch("src.mail.time.sleep") as mock_sleep,
+    ):
+        session = mock_session.return_value.__enter__.return_value
+        session.post.side_effect = [
+            _response(503),
+            requests.ConnectionError("connection reset"),
+            _response(200),
+        ]
+        send_email(to_email="to@mail.com", body="body", subject="subject", max_backoff=1.0)
+
+    assert session.post.call_count == 3
+    assert mock_sleep.call_count == 2
+    assert all(0 <= call.args[0] <= 1.0 for call in mock_sleep.call_args_list)
+
+
+def test_send_email_respects_retry_after() -> None:
+    """
+    Test that the Retry-After header of a 429 response is respected.
+    """
+    with (
+        patch.dict("os.environ", MAILJET_ENV),
+        patch("src.mail.requests.Session") as mock_session,
+        patch("src.mail.time.sleep") as mock_sleep,
+    ):
+        session = mock_session.return_value.__enter__.return_value
+        session.post.side_effect = [_response(429, {"Retry-After": "2"}), _response(200)]
+        send_email(to_email="to@mail.com", body="body", subject="subject")
+
+    mock_sleep.assert_called_once_with(2.0)
+
+
+def test_send_email_gives_up_on_long_retry_after() -> None:
+    """
+    Test that a Retry-After longer than the maximum backoff is not waited for.
+    """
+    with (
+        patch.dict("os.environ", MAILJET_ENV),
+        patch("src.mail.requests.Session") as mock_session,
+        patch("src.mail.time.sleep") as mock_sleep,
+        pytest.raises(requests.HTTPError),
+    ):
+        session = mock_session.return_value.__enter__.return_value
+        session.post.return_value = _response(429, {"Retry-After": "120"})
+        send_email(to_email="to@mail.com", body="body", subject="subject")
+
+    mock_sleep.assert_not_called()
+
+
+def test_send_email_does_not_retry_client_errors() -> None:
+    """
+    Test that a rejected request is not retried.
+    """
+    with (
+        patch.dict("os.environ", MAILJET_ENV),
+        patch("src.mail.requests.Session") as mock_session,
+        patch("src.mail.time.sleep"),
+        pytest.raises(requests.HTTPError),
+    ):
+        session = mock_session.return_value.__enter__.return_value
+        session.post.return_value = _response(400)
+        send_email(to_email="to@mail.com", body="body", subject="subject")
+
+    assert session.post.call_count == 1
+
+
+def test_send_email_raises_after_retries() -> None:
+    """
+    Test that the last error is raised when all retries failed.
+    """
+    with (
+        patch.dict("os.environ", MAILJET_ENV),
+        patch("src.mail.requests.Session") as mock_session,
+        patch("src.mail.time.sleep"),
+        pytest.raises(requests.Timeout),
+    ):
+        session = mock_session.return_value.__enter__.return_value
+        session.post.side_effect = requests.Timeout("read timed out")
+        send_email(to_email="to@mail.com", body="body", subject="subject", max_retries=1)
+
+    assert session.post.call_count == 2
+
+
+def test_send_email_stops_at_deadline() -> None:
+    """
+    Test that the timeouts are cut to the time left, and no retry is made after the deadline.
+    """
+    with (
+        patch.dict("os.environ", MAILJET_ENV),
+        patch("src.mail.requests.Session") as mock_session,
+        patch("src.mail.time.monotonic", side_effect=[0.0, 8.0, 10.0]),
+        patch("src.mail.time.sleep") as mock_sleep,
+        pytest.raises(requests.Timeout),
+    ):
+        session = mock_session.return_value.__enter__.return_value
+        session.post.side_effect = requests.Timeout("read timed out")
+        send_email(to_email="to@mail.com", body="body", subject="subject", deadline=10.0)
+
+    assert session.post.call_count == 1
+    assert session.post.call_args.kwargs["timeout"] == (2.0, 2.0)
+    mock_sleep.assert_not_called()
+
+
+def test_is_transient_error() -> None:
+    """
+    Test the is_transient_error function.
+    """
+    assert is_transient_error(requests.Timeout())
+    assert is_transient_error(requests.ConnectionError())
+    assert is_transient_error(requests.HTTPError(response=_response(503)))
+    assert not is_transient_error(requests.HTTPError(response=_response(400)))
+    assert not is_transient_error(ValueError("FROM_EMAIL environment variable not set."))
+
+
+def test_retry_after() -> None:
+    """
+    Test the _retry_after function.
+    """
+    assert _retry_after(_response(429)) is None
+    assert _retry_after(_response(429, {"Retry-After": "3"})) == 3.0
+    assert _retry_after(_response(429, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0.0
+    assert _retry_after(_response(429, {"Retry-After": "soon"})) is None
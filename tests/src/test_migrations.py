@@ -0,0 +1,178 @@
+from types import SimpleNamespace
+from typing import Any, Iterator
+from unittest.mock import patch
+
+import mongomock
+import pytest
+from pymongo import UpdateOne
+
+from src.codec import CompactCodec
+from src.db import MAGIC_LINKS, USERS, CollectionRegistry
+from src.migrations import CollectionSize, backfill_email_keys, migrate_to_compact
+from src.models import User
+from src.utils import (
+    ensure_indexes,
+    get_magic_link_by_token,
+    get_user_by_email,
+    get_user_by_id,
+    insert_magic_link,
+    insert_user,
+)
+
+
+@pytest.fixture(autouse=True)
+def bulk_write() -> Iterator[Any]:
+    """
+    Mongomock's `bulk_write` does not accept the `UpdateOne` of recent pymongo
+    versions, apply the updates one by one instead.
+    """
+
+    def apply(collection: Any, requests: list[UpdateOne], ordered: bool = True) -> Any:
+        modified = sum(
+            collection.update_one(request._filter, request._doc).modified_count
+            for request in requests
+        )
+        return SimpleNamespace(modified_count=modified)
+
+    with patch.object(mongomock.Collection, "bulk_write", autospec=True, side_effect=apply) as mock:
+        yield mock
+
+
+def _insert_legacy_user(client: mongomock.MongoClient, email: str) -> User:
+    user = User(email=email)
+    client["streamlit-magic-link"]["users"].insert_one(user.model_dump())
+    return user
+
+
+def test_backfill_email_keys(bulk_write: Any) -> None:
+    """Test that users without an email key get one, with one bulk write per batch."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    users = [_insert_legacy_user(client, f"User{number}@Mail.com") for number in range(5)]
+
+    report = backfill_email_keys(client, batch_size=2)
+
+    assert report.updated == 5
+    assert report.duplicates == {}
+    assert bulk_write.call_count == 3
+    for number, user in enumerate(users):
+        retrieved_user = get_user_by_email(client, f"user{number}@mail.com")
+        assert retrieved_user is not None
+        assert retrieved_user.id == user.id
+    assert backfill_email_keys(client).updated == 0
+
+
+def test_backfill_email_keys_reports_duplicates() -> None:
+    """Test that users sharing a key are reported and keep no key."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    first = insert_user(client, User(email="sample@mail.com"))
+    second = _insert_legacy_user(client, "Sample@mail.com")
+    third = _insert_legacy_user(client, "SAMPLE@MAIL.COM")
+    other = _insert_legacy_user(client, "other@mail.com")
+
+    report = backfill_email_keys(client, batch_size=2)
+
+    assert report.updated == 1
+    assert report.duplicates == {"sample@mail.com": [first.id, second.id, third.id]}
+    users = client["streamlit-magic-link"]["users"]
+    assert users.count_documents({"email_key": "sample@mail.com"}) == 1
+    assert users.find_one({"id": other.id}, {"_id": 0, "email_key": 1}) == {
+        "email_key": "other@mail.com"
+    }
+    retrieved_user = get_user_by_email(client, "SAMPLE@MAIL.COM")
+    assert retrieved_user is not None
+    assert retrieved_user.id == first.id
+
+
+def test_backfill_email_keys_sharded() -> None:
+    """Test that the email lookups of the sharded layout move to the keys."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    registry = CollectionRegistry(client, tenant="app-a", sharded=True)
+    user = User(email="Sample@Mail.com")
+    registry.users.insert_one(registry.scope(user.model_dump()))
+    registry.user_emails.insert_one(registry.scope({"email": user.email, "user_id": user.id}))
+
+    report = backfill_email_keys(registry)
+
+    assert report.updated == 1
+    assert registry.user_emails.find_one({"email": "sample@mail.com"}, {"_id": 0}) == {
+        "tenant": "app-a", "email": "sample@mail.com", "user_id": user.id
+    }
+    assert registry.user_emails.count_documents({}) == 1
+    retrieved_user = get_user_by_email(registry, "sample@mail.com")
+    assert retrieved_user is not None
+    assert retrieved_user.id == user.id
+
+
+def test_migrate_to_compact() -> None:
+    """Test that users and magic links are converted in batches and stay usable."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    database = client["streamlit-magic-link"]
+    registry = CollectionRegistry(client, codec=CompactCodec())
+    # mongomock ignores partial filters when indexing existing documents, so create the
+    # compact indexes before the documents instead of during the migration.
+    ensure_indexes(registry)
+    ensure_indexes(client)
+    users = [insert_user(client, User(email=f"user{number}@mail.com")) for number in range(3)]
+    magic_link = insert_magic_link(client, users[0].id)
+    sizes = {USERS: CollectionSize(count=3, index_size=300), MAGIC_LINKS: CollectionSize(count=1)}
+
+    with patch("src.migrations.collection_sizes", return_value=sizes), patch(
+        "src.migrations.ensure_indexes"
+    ):
+        report = migrate_to_compact(registry, batch_size=2, drop_legacy_indexes=True)
+
+    assert report.migrated == {USERS: 3, MAGIC_LINKS: 1}
+    assert report.skipped == {USERS: 0, MAGIC_LINKS: 0}
+    assert report.before == report.after == sizes
+    table = report.table()
+    # A "before" and "after" title over each of the 6 values of a row, and one width for all lines.
+    assert [len(line.split()) for line in table[1:]] == [6, 8, 8]
+    assert len({len(line) for line in table}) == 1
+    assert database["users"].count_documents({"i": {"$exists": True}}) == 3
+    assert database["magic-links"].count_documents({"t": {"$exists": True}}) == 1
+    assert set(database["users"].index_information()) == {"_id_", "i_1", "e_1", "k_1"}
+    retrieved_user = get_user_by_id(CollectionRegistry(client, codec=CompactCodec(read_legacy=False)), users[1].id)
+    assert retrieved_user is not None
+    assert retrieved_user.model_dump(exclude={"created_at"}) == users[1].model_dump(exclude={"created_at"})
+    stored_link = get_magic_link_by_token(registry, magic_link.token)
+    assert stored_link is not None and stored_link.user_id == users[0].id
+
+
+def test_migrate_to_compact_keeps_legacy_unique_indexes_partial() -> None:
+    """Test that the legacy unique indexes only cover documents that were not converted."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    ensure_indexes(client)
+    insert_user(client, User(email="sample@mail.com"))
+    registry = CollectionRegistry(client, codec=CompactCodec())
+
+    with patch("src.migrations.collection_sizes", return_value={}):
+        migrate_to_compact(registry)
+
+    indexes = client["streamlit-magic-link"]["users"].index_information()
+    assert indexes["id_1"]["partialFilterExpression"] == {"id": {"$exists": True}}
+    assert indexes["i_1"]["partialFilterExpression"] == {"i": {"$exists": True}}
+
+
+def test_migrate_to_compact_requires_codec() -> None:
+    """Test that the migration needs a registry with a compact codec."""
+    with pytest.raises(ValueError):
+        migrate_to_compact(mongomock.MongoClient())
+
+
+def test_backfill_email_keys_compact() -> None:
+    """Test that the keys are written in the layout of every user."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    registry = CollectionRegistry(client, codec=CompactCodec())
+    compact = insert_user(registry, User(email="Compact@Mail.com"))
+    raw_users = client["streamlit-magic-link"]["users"]
+    raw_users.update_many({}, {"$unset": {"k": ""}})
+    legacy = _insert_legacy_user(client, "Legacy@Mail.com")
+
+    assert backfill_email_keys(registry).updated == 2
+
+    assert raw_users.count_documents({"k": "compact@mail.com"}) == 1
+    assert raw_users.count_documents({"email_key": "legacy@mail.com"}) == 1
+    for user, email in ((compact, "compact@mail.com"), (legacy, "legacy@mail.com")):
+        retrieved_user = get_user_by_email(registry, email)
+        assert retrieved_user is not None
+        assert retrieved_user.id == user.id
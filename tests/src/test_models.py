@@ -58,3 +58,18 @@ def test_magic_link_model() -> None:
     assert magic_link.user_id == user_id
     assert magic_link.is_used == is_used
     assert magic_link.expiration_time == expiration_time
+
+
+def test_changed_fields() -> None:
+    """Test that only fields changed after loading are reported"""
+    user = User(email="sample@mail.com")
+    assert set(user.changed_fields()) == set(User.model_fields)
+
+    loaded_user = User.from_document({**user.model_dump(), "_id": "object-id"})
+    assert loaded_user.changed_fields() == {}
+
+    loaded_user.is_verified = True
+    assert loaded_user.changed_fields() == {"is_verified": True}
+
+    loaded_user.mark_saved()
+    assert loaded_user.changed_fields() == {}
@@ -0,0 +1,176 @@
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+import mongomock
+
+from src.db import CollectionRegistry
+from src.outbox import (
+    DONE,
+    FAILED,
+    PENDING,
+    OutboxWorker,
+    enqueue_email,
+    ensure_outbox_indexes,
+)
+from src.transports import MemoryTransport
+
+
+def _outbox(client: mongomock.MongoClient):
+    return client["streamlit-magic-link"]["mail-outbox"]
+
+
+def test_enqueue_email() -> None:
+    """
+    Test the enqueue_email function.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+
+    job = enqueue_email(client, to_email="to@mail.com", body="body", subject="subject")
+
+    document = _outbox(client).find_one({"id": job.id})
+    assert document is not None
+    assert document["status"] == PENDING
+    assert document["to_email"] == "to@mail.com"
+    assert document["attempts"] == 0
+
+
+def test_ensure_outbox_indexes() -> None:
+    """
+    Test the ensure_outbox_indexes function.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+
+    ensure_outbox_indexes(client, retention=timedelta(days=1))
+
+    indexes = _outbox(client).index_information()
+    assert indexes["status_1_available_at_1"]["key"] == [("status", 1), ("available_at", 1)]
+    assert indexes["completed_at_1"]["expireAfterSeconds"] == 86400
+
+
+def test_claim_batch_leases_jobs() -> None:
+    """
+    Test that claimed jobs are leased and not claimed by another worker.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    for i in range(3):
+        enqueue_email(client, to_email=f"{i}@mail.com", body="body", subject="subject")
+
+    worker = OutboxWorker(client, MemoryTransport(), batch_size=2)
+    other_worker = OutboxWorker(client, MemoryTransport(), batch_size=2)
+
+    jobs = worker.claim_batch()
+    other_jobs = other_worker.claim_batch()
+
+    assert len(jobs) == 2
+    assert len(other_jobs) == 1
+    assert {job.id for job in jobs}.isdisjoint(job.id for job in other_jobs)
+    assert all(job.lease_owner == worker.worker_id for job in jobs)
+    assert all(job.attempts == 1 for job in jobs)
+    assert other_worker.claim_batch() == []
+
+
+def test_claim_batch_reclaims_expired_lease() -> None:
+    """
+    Test that a job becomes available again when its lease expired.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    job = enqueue_email(client, to_email="to@mail.com", body="body", subject="subject")
+
+    crashed_worker = OutboxWorker(
+        client, MemoryTransport(), batch_size=1, lease=timedelta(seconds=-1)
+    )
+    assert len(crashed_worker.claim_batch()) == 1
+
+    worker = OutboxWorker(client, MemoryTransport())
+    jobs = worker.claim_batch()
+    assert [claimed.id for claimed in jobs] == [job.id]
+    assert jobs[0].attempts == 2
+
+
+def test_claim_batch_of_tenant() -> None:
+    """
+    Test that a worker with a tenant only claims the jobs of its tenant.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    first = CollectionRegistry(client, tenant="first")
+    second = CollectionRegistry(client, tenant="second")
+    job = enqueue_email(first, to_email="to@mail.com", body="body", subject="subject")
+    enqueue_email(second, to_email="to@mail.com", body="body", subject="subject")
+
+    assert [claimed.id for claimed in OutboxWorker(first, MemoryTransport()).claim_batch()] == [job.id]
+    assert OutboxWorker(first, MemoryTransport()).claim_batch() == []
+    assert len(OutboxWorker(client, MemoryTransport()).claim_batch()) == 1
+
+
+def test_process_batch() -> None:
+    """
+    Test that processed jobs are sent and marked as done.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    job = enqueue_email(client, to_email="to@mail.com", body="body", subject="subject")
+    transport = MemoryTransport()
+
+    assert OutboxWorker(client, transport).process_batch() == 1
+
+    assert [email.to_email for email in transport.sent] == ["to@mail.com"]
+    document = _outbox(client).find_one({"id": job.id})
+    assert document["status"] == DONE
+    assert document["completed_at"] is not None
+    assert document["lease_owner"] is None
+
+
+def test_process_batch_retries_with_backoff() -> None:
+    """
+    Test that a failed job is rescheduled with a backoff.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    job = enqueue_email(client, to_email="to@mail.com", body="body", subject="subject")
+    transport = MagicMock()
+    transport.send.side_effect = RuntimeError("provider down")
+
+    before = datetime.now()
+    OutboxWorker(client, transport, backoff=timedelta(minutes=1)).process_batch()
+
+    document = _outbox(client).find_one({"id": job.id})
+    assert document["status"] == PENDING
+    assert document["last_error"] == "provider down"
+    assert document["lease_owner"] is None
+    assert before <= document["available_at"] <= datetime.now() + timedelta(minutes=1)
+
+
+def test_process_batch_marks_failed_after_max_attempts() -> None:
+    """
+    Test that a job is marked as failed after the maximum number of attempts.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    job = enqueue_email(client, to_email="to@mail.com", body="body", subject="subject")
+    transport = MagicMock()
+    transport.send.side_effect = RuntimeError("provider down")
+
+    worker = OutboxWorker(client, transport, max_attempts=2, backoff=timedelta(0))
+    worker.process_batch()
+    worker.process_batch()
+
+    document = _outbox(client).find_one({"id": job.id})
+    assert document["status"] == FAILED
+    assert document["attempts"] == 2
+    assert worker.process_batch() == 0
+
+
+def test_run_forever_stops() -> None:
+    """
+    Test that the worker loop ends when it is stopped.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    enqueue_email(client, to_email="to@mail.com", body="body", subject="subject")
+
+    class StoppingTransport(MemoryTransport):
+        def send(self, to_email: str, body: str, subject: str) -> None:
+            super().send(to_email=to_email, body=body, subject=subject)
+            worker.stop()
+
+    transport = StoppingTransport()
+    worker = OutboxWorker(client, transport)
+    worker.run_forever(poll_interval=0)
+
+    assert len(transport.sent) == 1
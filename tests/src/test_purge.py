@@ -0,0 +1,137 @@
+from unittest.mock import MagicMock, patch
+
+import mongomock
+import pytest
+
+from src.cache import UserCache
+from src.db import CollectionRegistry
+from src.events import EventLog
+from src.models import User
+from src.outbox import enqueue_email
+from src.purge import purge_user, purge_users
+from src.sessions import create_session
+from src.utils import get_user_by_id, insert_magic_link, insert_user
+
+
+def _insert_user_with_data(client: CollectionRegistry, email: str, **fields) -> User:
+    user = insert_user(client, User(email=email, **fields))
+    insert_magic_link(client, user.id)
+    insert_magic_link(client, user.id)
+    create_session(client, user.id)
+    enqueue_email(client, to_email=email, body="link", subject="subject", user_id=user.id)
+    event_log = EventLog(client)
+    event_log._stopped.set()  # no background writer
+    event_log.record("link_issued", user_id=user.id)
+    event_log.flush()
+    return user
+
+
+def test_purge_user() -> None:
+    """Test that purging a user removes their links, sessions, events and queued emails."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    collections = CollectionRegistry(client)
+    user = _insert_user_with_data(collections, "sample@mail.com")
+    other = _insert_user_with_data(collections, "other@mail.com")
+
+    report = purge_user(collections, user.id)
+
+    assert report.model_dump() == {
+        "users": 1,
+        "magic_links": 2,
+        "sessions": 1,
+        "events": 1,
+        "user_emails": 0,
+        "outbox": 1,
+    }
+    assert get_user_by_id(collections, user.id) is None
+    assert collections.magic_links.count_documents({"user_id": user.id}) == 0
+    assert collections.magic_links.count_documents({"user_id": other.id}) == 2
+    assert collections.sessions.count_documents({}) == 1
+    assert collections.events.count_documents({}) == 1
+    assert collections.outbox.count_documents({}) == 1
+
+
+def test_purge_users_by_query_in_batches() -> None:
+    """Test purging the users matching a filter, in batches."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    collections = CollectionRegistry(client)
+    for number in range(5):
+        _insert_user_with_data(collections, f"user-{number}@mail.com")
+    verified = _insert_user_with_data(collections, "verified@mail.com", is_verified=True)
+
+    with patch.object(
+        collections.magic_links, "delete_many", wraps=collections.magic_links.delete_many
+    ) as mock_delete_many:
+        report = purge_users(collections, query={"is_verified": False}, batch_size=2)
+
+    assert report.users == 5
+    assert report.magic_links == 10
+    assert mock_delete_many.call_count == 3
+    assert collections.users.count_documents({}) == 1
+    assert get_user_by_id(collections, verified.id) is not None
+
+
+def test_purge_users_sharded_and_cached() -> None:
+    """Test that purging removes email lookups and cached users."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    user_cache = UserCache()
+    collections = CollectionRegistry(client, sharded=True, user_cache=user_cache)
+    user = insert_user(collections, User(email="sample@mail.com"))
+    assert get_user_by_id(collections, user.id) is not None
+
+    report = purge_users(collections, user_ids=[user.id, "unknown-id"])
+
+    assert report.users == 1
+    assert report.user_emails == 1
+    assert get_user_by_id(collections, user.id) is None
+
+
+def test_purge_users_in_transaction() -> None:
+    """Test that every batch is deleted in a transaction."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    collections = CollectionRegistry(client)
+    collections.client = MagicMock()
+    session = collections.client.start_session.return_value.__enter__.return_value
+    session.with_transaction.side_effect = lambda callback: callback(session)
+
+    with patch("src.purge._purge_batch") as mock_purge_batch:
+        purge_users(collections, user_ids=["a", "b", "c"], batch_size=2, use_transaction=True)
+
+    assert session.with_transaction.call_count == 2
+    assert [call.args[1] for call in mock_purge_batch.call_args_list] == [["a", "b"], ["c"]]
+    assert all(call.args[3] is session for call in mock_purge_batch.call_args_list)
+
+
+def test_purge_users_requires_ids_or_query() -> None:
+    """Test that exactly one of user_ids and query is required."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+
+    with pytest.raises(ValueError):
+        purge_users(client)
+    with pytest.raises(ValueError):
+        purge_users(client, user_ids=["id"], query={})
+
+
+def test_purge_user_removes_queued_emails_without_user_id() -> None:
+    """Test that outbox jobs queued before they carried a user id are purged by email."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    collections = CollectionRegistry(client)
+    user = insert_user(collections, User(email="Sample@mail.com"))
+    enqueue_email(collections, to_email="Sample@mail.com", body="link", subject="subject")
+    enqueue_email(collections, to_email="sample@mail.com", body="link", subject="subject")
+    enqueue_email(collections, to_email="other@mail.com", body="link", subject="subject")
+
+    assert purge_user(collections, user.id).outbox == 2
+    assert [job["to_email"] for job in collections.outbox.find()] == ["other@mail.com"]
+
+
+def test_purge_user_keeps_queued_emails_of_other_tenants() -> None:
+    """Test that purging a user only removes the queued emails of their tenant."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    first = CollectionRegistry(client, tenant="first")
+    second = CollectionRegistry(client, tenant="second")
+    user = _insert_user_with_data(first, "sample@mail.com")
+    _insert_user_with_data(second, "sample@mail.com")
+
+    assert purge_user(first, user.id).outbox == 1
+    assert [job["tenant"] for job in client["streamlit-magic-link"]["mail-outbox"].find()] == ["second"]
@@ -0,0 +1,111 @@
+import json
+from unittest.mock import MagicMock, patch
+
+import mongomock
+
+from src.magiclink import StreamlitMagicLink
+from src.models import User
+from src.recorder import TraceRecorder, annotate, load_trace
+from src.transports import MemoryTransport
+from src.utils import get_user_by_email, get_user_by_id, insert_user
+
+
+def test_anonymize() -> None:
+    """Test that identifiers are hashed with the salt of the recorder."""
+    recorder = TraceRecorder(salt=b"salt")
+
+    assert recorder.anonymize("user@mail.com") == recorder.anonymize("user@mail.com")
+    other = TraceRecorder(salt=b"other")
+    assert recorder.anonymize("user@mail.com") != other.anonymize("user@mail.com")
+    assert "user" not in str(recorder.anonymize("user@mail.com"))
+    assert recorder.anonymize(None) is None
+
+
+def test_helpers_are_recorded_within_recording() -> None:
+    """Test that the helpers are only recorded while recording, nested below operations."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    user = insert_user(client, User(email="user@mail.com"))
+    recorder = TraceRecorder()
+
+    get_user_by_id(client, user.id)
+    assert recorder.entries == []
+
+    with recorder.recording():
+        get_user_by_email(client, "unknown@mail.com")
+        with recorder.operation("page", session="session-1") as entry:
+            get_user_by_id(client, user_id=user.id)
+            annotate(outcome="shown", token=None)
+
+    missing, found, page = recorder.entries
+    assert (missing.op, missing.outcome, missing.depth) == ("get_user_by_email", "none", 0)
+    assert missing.email == recorder.anonymize("unknown@mail.com")
+    assert (found.op, found.outcome, found.depth) == ("get_user_by_id", "ok", 1)
+    assert found.user_id == recorder.anonymize(user.id)
+    assert found.session == page.session == recorder.anonymize("session-1")
+    assert page is entry and page.outcome == "shown" and page.token is None
+    assert page.duration_ms >= found.duration_ms
+
+
+def test_errors_are_recorded() -> None:
+    """Test that an operation that raises is recorded with the error type."""
+    recorder = TraceRecorder()
+
+    try:
+        with recorder.operation("failing"):
+            raise KeyError("secret")
+    except KeyError:
+        pass
+
+    assert recorder.entries[0].outcome == "error"
+    assert recorder.entries[0].error == "KeyError"
+
+
+def test_trace_file(tmp_path) -> None:
+    """Test that the trace is written as JSON lines without clear identifiers."""
+    path = tmp_path / "trace.jsonl"
+    recorder = TraceRecorder(str(path))
+    with recorder.operation("authenticate", email="user@mail.com", fields=["name"]):
+        pass
+    recorder.close()
+    path.write_text(path.read_text() + "not json\n")
+
+    assert "user@mail.com" not in path.read_text()
+    assert json.loads(path.read_text().splitlines()[0])["op"] == "authenticate"
+    entries = load_trace(str(path))
+    assert len(entries) == 1
+    assert entries[0].fields == ["name"]
+    assert recorder.written == 1
+
+
+def test_magic_link_operations_are_recorded() -> None:
+    """Test that the operations of StreamlitMagicLink are recorded with their outcomes."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    recorder = TraceRecorder()
+    transport = MemoryTransport()
+    cookies = MagicMock()
+    cookies.get.return_value = None
+
+    with patch("src.magiclink.st") as mock_st:
+        mock_st.session_state = {}
+        magic_link = StreamlitMagicLink(
+            client, "https://example.com/", cookies, mail_transport=transport, recorder=recorder
+        )
+        magic_link.authenticate("user@mail.com")
+        token = transport.sent[0].body.rsplit("token=", 1)[1]
+        mock_st.query_params = {"token": "not-a-token"}
+        magic_link.sign_in()
+        mock_st.query_params = {"token": token}
+        magic_link.sign_in()
+
+    top = [entry for entry in recorder.entries if entry.depth == 0]
+    assert [(entry.op, entry.outcome) for entry in top] == [
+        ("rerun", "anonymous"),
+        ("authenticate", "sent"),
+        ("sign_in", "malformed"),
+        ("sign_in", "valid"),
+    ]
+    assert top[1].token == top[3].token == recorder.anonymize(token)
+    assert top[1].email == recorder.anonymize("user@mail.com")
+    assert len({entry.session for entry in top}) == 1
+    helpers = {entry.op for entry in recorder.entries if entry.depth == 1}
+    assert {"create_or_retrieve_user", "insert_magic_link", "get_magic_link_by_token"} <= helpers
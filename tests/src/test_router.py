@@ -0,0 +1,136 @@
+import time
+
+import pytest
+import requests
+
+from src.router import DeliveryRouter, ProviderStats, idempotency_key
+from src.transports import FakeTransport
+
+
+def test_provider_stats() -> None:
+    """Test the rolling error rate and latency percentiles of a provider."""
+    stats = ProviderStats(window=60.0)
+    for latency in (0.1, 0.2, 0.3, 0.4):
+        stats.record(latency, ok=True)
+    stats.record(5.0, ok=False)
+
+    assert len(stats) == 5
+    assert stats.error_rate() == pytest.approx(0.2)
+    assert stats.percentile(50) == pytest.approx(0.25)
+    assert stats.snapshot()["samples"] == 5
+
+    stats.window = 0.0
+    assert len(stats) == 0
+    assert stats.error_rate() == 0.0
+    assert stats.percentile(50) is None
+
+
+def test_send_through_healthiest_provider() -> None:
+    """Test that sends go through the provider with the fewest errors, then the lowest latency."""
+    primary, secondary = FakeTransport(), FakeTransport()
+    router = DeliveryRouter({"primary": primary, "secondary": secondary})
+
+    router.send(to_email="to@mail.com", body="body", subject="subject")
+    assert len(primary.sent) == 1 and not secondary.sent
+
+    router.stats["primary"].record(0.5, ok=True)
+    router.stats["secondary"].record(0.1, ok=True)
+    assert router.ranked() == ["secondary", "primary"]
+
+    router.stats["secondary"].record(0.1, ok=False)
+    assert router.ranked() == ["primary", "secondary"]
+
+
+def test_failover() -> None:
+    """Test that a failed send is sent through the next provider, and the error is recorded."""
+    failing = FakeTransport(error=requests.ConnectionError("down"))
+    working = FakeTransport()
+    router = DeliveryRouter({"failing": failing, "working": working})
+
+    router.send(to_email="to@mail.com", body="body", subject="subject")
+
+    assert [email.to_email for email in working.sent] == ["to@mail.com"]
+    assert router.failovers == 1
+    assert router.stats["failing"].error_rate() == 1.0
+    assert router.ranked() == ["working", "failing"]
+
+
+def test_all_providers_fail() -> None:
+    """Test that the error of the last provider is raised when all providers fail."""
+    router = DeliveryRouter({
+        "first": FakeTransport(error=requests.ConnectionError("first")),
+        "second": FakeTransport(error=requests.Timeout("second")),
+    })
+
+    with pytest.raises(requests.Timeout):
+        router.send(to_email="to@mail.com", body="body", subject="subject")
+
+
+def test_same_email_is_not_sent_twice() -> None:
+    """Test that an email accepted by a provider is not sent again."""
+    transport = FakeTransport()
+    router = DeliveryRouter({"only": transport})
+
+    router.send(to_email="to@mail.com", body="body", subject="subject")
+    router.send(to_email="to@mail.com", body="body", subject="subject")
+    router.send(to_email="to@mail.com", body="other body", subject="subject")
+
+    assert [email.body for email in transport.sent] == ["body", "other body"]
+    assert router.deduplicated == 1
+
+
+def test_hedged_send() -> None:
+    """Test that a send slower than the latency percentile is hedged through the next provider."""
+    slow = FakeTransport()
+    fast = FakeTransport(latency=0.01)
+    router = DeliveryRouter(
+        {"slow": slow, "fast": fast}, hedge_percentile=90, min_samples=5, hedge_budget=1.0
+    )
+    for _ in range(5):
+        router.stats["slow"].record(0.01, ok=True)
+        router.stats["fast"].record(0.02, ok=True)
+    slow.latency = 0.5
+
+    started = time.perf_counter()
+    router.send(to_email="to@mail.com", body="body", subject="subject")
+    elapsed = time.perf_counter() - started
+    router.close()
+
+    assert elapsed < 0.3
+    assert router.hedges == 1
+    assert len(fast.sent) == 1
+    key = idempotency_key("to@mail.com", "body", "subject")
+    assert fast.idempotency_keys == [key]
+    # The slow copy was in flight already, it is sent with the same key.
+    assert slow.idempotency_keys == [key]
+
+
+def test_hedge_is_skipped_when_first_copy_is_accepted() -> None:
+    """Test that a queued hedge is not sent once another copy was accepted."""
+    first, second = FakeTransport(), FakeTransport()
+    router = DeliveryRouter({"first": first, "second": second})
+
+    router.send(to_email="to@mail.com", body="body", subject="subject")
+    key = idempotency_key("to@mail.com", "body", "subject")
+    router._attempt("second", "to@mail.com", "body", "subject", key)
+
+    assert len(first.sent) == 1
+    assert not second.sent
+
+
+def test_hedge_budget() -> None:
+    """Test that no more than the hedge budget of the sends is hedged."""
+    slow, fast = FakeTransport(), FakeTransport()
+    router = DeliveryRouter(
+        {"slow": slow, "fast": fast}, hedge_percentile=50, min_samples=1, hedge_budget=0.0
+    )
+    router.stats["slow"].record(0.001, ok=True)
+    router.stats["fast"].record(0.01, ok=True)
+    slow.latency = 0.05
+
+    router.send(to_email="to@mail.com", body="body", subject="subject")
+    router.close()
+
+    assert router.hedges == 0
+    assert len(slow.sent) == 1
+    assert not fast.sent
@@ -0,0 +1,194 @@
+import threading
+from datetime import datetime, timedelta
+from typing import Any
+from unittest.mock import MagicMock, patch
+
+import mongomock
+
+from benchmarks.load_test import _LockedRegistry
+from src.magiclink import StreamlitMagicLink
+from src.service import MagicLinkService, SyncResult
+from src.sessions import revoke_session
+from src.transports import MemoryTransport
+from src.models import User
+from src.utils import get_user_by_email, insert_magic_link, insert_user, update_user_fields
+
+
+def _service(**options: Any) -> tuple[MagicLinkService, MemoryTransport]:
+    transport = MemoryTransport()
+    service = MagicLinkService(
+        mongomock.MongoClient(), "https://example.com/", mail_transport=transport, **options
+    )
+    return service, transport
+
+
+def test_request_link_and_sign_in() -> None:
+    """Test the sign in flow without Streamlit."""
+    service, transport = _service()
+
+    assert service.request_link("user@mail.com") == "sent"
+    assert service.request_link("user@mail.com") == "reused"
+    token = transport.sent[0].body.rsplit("token=", 1)[1]
+    signed_in = service.sign_in(token)
+
+    assert signed_in is not None
+    assert signed_in.user.email == "user@mail.com"
+    assert signed_in.user.is_verified
+    assert service.sign_in("not-a-token") is None
+
+
+def test_request_link_to_outbox_keeps_user_id() -> None:
+    """Test that a queued magic link email carries the user id, so it is purged with the user."""
+    service, _ = _service(use_outbox=True)
+
+    assert service.request_link("user@mail.com") == "queued"
+    user = get_user_by_email(service.collections, "user@mail.com")
+    assert user is not None
+    job = service.collections.outbox.find_one({})
+    assert job is not None
+    assert job["user_id"] == user.id
+    service.delete_user(user.id)
+    assert service.collections.outbox.count_documents({}) == 0
+
+
+def test_sync() -> None:
+    """Test that a stored user is checked against the database."""
+    service, _ = _service(legacy_sessions_until=datetime.now() + timedelta(days=1))
+    service.request_link("user@mail.com")
+    user_model = get_user_by_email(service.collections, "user@mail.com")
+    assert user_model is not None
+
+    legacy = service.sync(user_model.model_dump(mode="json"))
+    assert legacy.changed and legacy.user is not None and legacy.session_id
+    stored_user = {**legacy.user.model_dump(mode="json"), "session_id": legacy.session_id}
+    assert service.sync(stored_user) == SyncResult(None, legacy.session_id, changed=False)
+
+    updated = update_user_fields(service.collections, user_model.id, name="New")
+    assert updated is not None
+    result = service.sync(stored_user)
+    assert result.changed and result.user is not None and result.user.name == "New"
+
+    revoke_session(service.collections, legacy.session_id)
+    assert service.sync(stored_user) == SyncResult(None, None, changed=True)
+    assert service.sync(None) == SyncResult(None, None, changed=False)
+
+    # The user had a session, so the session id cannot be dropped to get a new one.
+    stored_user.pop("session_id")
+    assert service.sync(stored_user) == SyncResult(None, None, changed=True)
+
+
+def test_sync_corrects_edited_user() -> None:
+    """Test that authorization fields edited in a stored user are read from the database."""
+    service, transport = _service()
+    service.request_link("user@mail.com")
+    signed_in = service.sign_in(transport.sent[0].body.rsplit("token=", 1)[1])
+    assert signed_in is not None
+    stored_user = {**signed_in.user.model_dump(mode="json"), "session_id": signed_in.session_id}
+    assert not service.sync(stored_user).changed
+
+    result = service.sync({**stored_user, "is_payed_user": True})
+    assert result.changed and result.user is not None
+    assert result.user.is_payed_user is False
+    assert result.session_id == signed_in.session_id
+
+
+def test_magic_link_is_redeemed_once() -> None:
+    """Test that the conditional write lets only one of concurrent redemptions succeed."""
+    # Mongomock is not thread-safe, serialize its operations like a server would.
+    collections = _LockedRegistry(mongomock.MongoClient())
+    service = MagicLinkService(collections, "https://example.com/", mail_transport=MemoryTransport())
+    token = insert_magic_link(collections, insert_user(collections, User(email="a@mail.com")).id).token
+    barrier = threading.Barrier(8)
+    results = []
+
+    def sign_in() -> None:
+        barrier.wait()
+        results.append(service.sign_in(token))
+
+    threads = [threading.Thread(target=sign_in) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(result is not None for result in results) == 1
+    assert service.sign_in(token) is None
+    assert collections.sessions.count_documents({}) == 1
+
+
+def test_magic_link_sign_in_is_not_repeated() -> None:
+    """Test that a used link fails right after it was redeemed, unless it is a rerun of the same session."""
+    service, transport = _service()
+    service.request_link("user@mail.com")
+    token = transport.sent[0].body.rsplit("token=", 1)[1]
+
+    signed_in = service.sign_in(token, session="first")
+
+    assert signed_in is not None
+    assert service.sign_in(token, session="first") == signed_in
+    assert service.sign_in(token, session="second") is None
+    assert service.sign_in(token) is None
+    assert service.collections.sessions.count_documents({}) == 1
+    magic_link = service.collections.magic_links.find_one({"token": token})
+    assert magic_link is not None
+    assert magic_link["version"] == 1
+
+
+def test_concurrent_sign_ins_share_one_service() -> None:
+    """Test that one service signs in the users of concurrent sessions."""
+    # Mongomock is not thread-safe, serialize its operations like a server would.
+    collections = _LockedRegistry(mongomock.MongoClient())
+    service = MagicLinkService(collections, "https://example.com/", mail_transport=MemoryTransport())
+    tokens = [
+        insert_magic_link(collections, insert_user(collections, User(email=f"{n}@mail.com")).id).token
+        for n in range(8)
+    ]
+    barrier = threading.Barrier(len(tokens))
+    results = {}
+
+    def sign_in(token: str) -> None:
+        barrier.wait()
+        results[token] = service.sign_in(token)
+
+    threads = [threading.Thread(target=sign_in, args=(token,)) for token in tokens]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(result is not None for result in results.values())
+    assert len({result.session_id for result in results.values() if result}) == len(tokens)
+    assert {result.user.email for result in results.values() if result} == {
+        f"{n}@mail.com" for n in range(8)
+    }
+
+
+def test_adapter_uses_shared_service() -> None:
+    """Test that StreamlitMagicLink instances share a given service."""
+    service, transport = _service()
+
+    with patch("src.magiclink.st"):
+        first, second = (
+            StreamlitMagicLink(service.collections.client, "ignored", MagicMock(), service=service)
+            for _ in range(2)
+        )
+        first.authenticate("user@mail.com")
+
+    assert first.service is second.service is service
+    assert first.base_url == "https://example.com/"
+    assert first.mail_transport is transport
+    assert len(transport.sent) == 1
+
+
+def test_replace_shares_caches() -> None:
+    """Test that a copy of a service shares the sign in cache, but not its replaced attributes."""
+    service, _ = _service()
+    other_transport = MemoryTransport()
+
+    copy = service.replace(mail_transport=other_transport)
+    assert not service.validate(None, "token")
+    copy.request_link("user@mail.com")
+
+    assert copy._sign_ins is service._sign_ins
+    assert service.mail_transport is not other_transport
+    assert len(other_transport.sent) == 1
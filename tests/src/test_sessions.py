@@ -0,0 +1,173 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import mongomock
+
+from src.db import CollectionRegistry
+from src.sessions import (
+    RevocationFilter,
+    create_session,
+    ensure_session_indexes,
+    get_revocation_filter,
+    get_session,
+    is_session_active,
+    revoke_session,
+    revoke_user_sessions,
+)
+
+
+def _sessions(mongo_client: mongomock.MongoClient) -> mongomock.Collection:
+    return mongo_client["streamlit-magic-link"]["sessions"]
+
+
+def test_create_and_revoke_session() -> None:
+    """Test creating and revoking a session."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    ensure_session_indexes(mongo_client)
+
+    session = create_session(mongo_client, "user-1")
+
+    assert _sessions(mongo_client).count_documents({"id": session.id, "revoked_at": None}) == 1
+    assert revoke_session(mongo_client, session.id) is True
+    assert revoke_session(mongo_client, session.id) is False
+    assert _sessions(mongo_client).count_documents({"id": session.id, "revoked_at": None}) == 0
+    assert get_revocation_filter(mongo_client).is_revoked(session.id)
+
+
+def test_revoke_user_sessions() -> None:
+    """Test revoking all sessions of a user."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    sessions = [create_session(mongo_client, "user-1") for _ in range(3)]
+    other = create_session(mongo_client, "user-2")
+
+    assert revoke_user_sessions(mongo_client, "user-1") == 3
+
+    revocations = get_revocation_filter(mongo_client)
+    assert all(revocations.is_revoked(session.id) for session in sessions)
+    assert not revocations.is_revoked(other.id)
+
+
+def test_revocation_filter_skips_database_when_fresh() -> None:
+    """Test that checks within the refresh interval do not read the database."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    session = create_session(mongo_client, "user-1")
+    revocations = RevocationFilter(mongo_client, refresh_interval=60)
+
+    assert not revocations.is_revoked(session.id)
+    _sessions(mongo_client).update_one(
+        {"id": session.id}, {"$set": {"revoked_at": datetime.now()}}
+    )
+    assert not revocations.is_revoked(session.id)
+
+    revocations.refresh()
+    assert revocations.is_revoked(session.id)
+
+
+def test_revocation_filter_picks_up_other_processes() -> None:
+    """Test that revocations of other processes are seen after the interval."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    session = create_session(mongo_client, "user-1")
+    revocations = RevocationFilter(mongo_client, refresh_interval=0)
+    assert not revocations.is_revoked(session.id)
+
+    # Another process with its own filter.
+    other_process = CollectionRegistry(mongo_client)
+    revoke_session(other_process, session.id)
+
+    assert revocations.is_revoked(session.id)
+
+
+def test_revocation_filter_overlap() -> None:
+    """Test that revocations committed before the watermark are still picked up."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    first = create_session(mongo_client, "user-1")
+    late = create_session(mongo_client, "user-1")
+    _sessions(mongo_client).update_one(
+        {"id": first.id}, {"$set": {"revoked_at": datetime.now()}}
+    )
+    revocations = RevocationFilter(mongo_client, refresh_interval=0)
+    assert revocations.is_revoked(first.id)
+
+    _sessions(mongo_client).update_one(
+        {"id": late.id}, {"$set": {"revoked_at": datetime.now() - timedelta(seconds=30)}}
+    )
+    assert revocations.is_revoked(late.id)
+
+
+def test_session_indexes_expire_sessions() -> None:
+    """Test that sessions are deleted by a TTL index once they expired."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    ensure_session_indexes(mongo_client)
+
+    indexes = _sessions(mongo_client).index_information()
+    assert indexes["expires_at_1"]["expireAfterSeconds"] == 0
+
+
+def test_is_session_active() -> None:
+    """Test that only existing, unexpired and unrevoked sessions of the user are active."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    session = create_session(mongo_client, "user-1")
+    expired = create_session(mongo_client, "user-1")
+    _sessions(mongo_client).update_one(
+        {"id": expired.id}, {"$set": {"expires_at": datetime.now() - timedelta(minutes=1)}}
+    )
+
+    assert is_session_active(mongo_client, session.id, "user-1")
+    assert not is_session_active(mongo_client, session.id, "user-2")
+    assert not is_session_active(mongo_client, "made-up", "user-1")
+    assert not is_session_active(mongo_client, expired.id, "user-1")
+
+    revoke_session(mongo_client, session.id)
+    assert not is_session_active(mongo_client, session.id, "user-1")
+
+
+def test_is_session_active_caches_active_sessions() -> None:
+    """Test that an active session is checked without reading it again."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    session = create_session(mongo_client, "user-1")
+    assert is_session_active(mongo_client, session.id, "user-1")
+
+    with patch("src.sessions.get_session") as get:
+        assert is_session_active(mongo_client, session.id, "user-1")
+    get.assert_not_called()
+
+    # Revoked by another process, seen once the filter is refreshed.
+    _sessions(mongo_client).update_one(
+        {"id": session.id}, {"$set": {"revoked_at": datetime.now()}}
+    )
+    get_revocation_filter(mongo_client).refresh()
+    assert not is_session_active(mongo_client, session.id, "user-1")
+
+
+def test_get_session_without_expiry() -> None:
+    """Test that a session stored without an expiry expires after the session lifetime."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    created_at = datetime.now() - timedelta(days=60)
+    _sessions(mongo_client).insert_one(
+        {"id": "old", "user_id": "user-1", "created_at": created_at, "revoked_at": None}
+    )
+
+    session = get_session(mongo_client, "old")
+    assert session is not None and session.expires_at < datetime.now()
+    assert not is_session_active(mongo_client, "old", "user-1")
+
+
+def test_revocation_filter_forgets_expired_sessions() -> None:
+    """Test that the filter only keeps the revocations of sessions that did not expire."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+    expired = create_session(mongo_client, "user-1")
+    active = create_session(mongo_client, "user-1")
+    _sessions(mongo_client).update_one(
+        {"id": expired.id},
+        {"$set": {"revoked_at": datetime.now(), "expires_at": datetime.now() - timedelta(days=1)}},
+    )
+    revoke_session(mongo_client, active.id)
+
+    revocations = RevocationFilter(mongo_client, refresh_interval=0)
+    assert revocations.is_revoked(active.id)
+    assert not revocations.is_revoked(expired.id)
+    assert len(revocations) == 1
+
+    revocations.add("soon-expired", datetime.now() - timedelta(seconds=1))
+    revocations.refresh()
+    assert not revocations.is_revoked("soon-expired")
@@ -0,0 +1,187 @@
+from typing import Any
+from unittest.mock import MagicMock
+
+import mongomock
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from src.db import MAGIC_LINKS, USER_EMAILS, USERS, CollectionRegistry
+from src.models import User
+from src.sharding import is_targeted, shard_collections, shard_key
+from src.utils import (
+    create_or_retrieve_user,
+    ensure_indexes,
+    delete_user,
+    get_magic_link_by_token,
+    get_user_by_email,
+    get_user_by_id,
+    insert_magic_link,
+    insert_user,
+    update_magic_link,
+    update_user,
+)
+
+
+class _ShardedCollection:
+    """Stand-in for a sharded collection that records untargeted operations."""
+
+    def __init__(self, collection: Any, key: dict):
+        self.collection = collection
+        self.key = key
+        self.untargeted: list[tuple[str, dict]] = []
+
+    def __getattr__(self, name: str) -> Any:
+        method = getattr(self.collection, name)
+
+        def call(document_or_filter: dict, *args: Any, **kwargs: Any) -> Any:
+            if not is_targeted(document_or_filter, self.key):
+                self.untargeted.append((name, document_or_filter))
+            return method(document_or_filter, *args, **kwargs)
+
+        return call
+
+
+def _sharded_registry(
+    client: mongomock.MongoClient, tenant: str = "app-a"
+) -> tuple[CollectionRegistry, dict[str, _ShardedCollection]]:
+    registry = CollectionRegistry(client, tenant=tenant, sharded=True)
+    collections = {
+        key: _ShardedCollection(registry.get(key), shard_key(registry, key))
+        for key in (USERS, MAGIC_LINKS, USER_EMAILS)
+    }
+    registry._collections.update(collections)  # type: ignore[arg-type]
+    return registry, collections
+
+
+def test_shard_key() -> None:
+    """Test the shard keys with and without a tenant."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+
+    assert shard_key(CollectionRegistry(client), USERS) == {"id": "hashed"}
+    assert shard_key(CollectionRegistry(client, tenant="app-a"), MAGIC_LINKS) == {
+        "tenant": 1,
+        "token": "hashed",
+    }
+
+
+def test_shard_collections() -> None:
+    """Test that every collection is sharded on its shard key."""
+    client = MagicMock()
+    registry = CollectionRegistry(client, database_name="db", tenant="app-a")
+
+    shard_collections(registry)
+
+    admin = client.get_database.return_value
+    client.get_database.assert_called_with("admin")
+    admin.command.assert_any_call("enableSharding", "db")
+    admin.command.assert_any_call(
+        "shardCollection", "db.users", key={"tenant": 1, "id": "hashed"}
+    )
+    admin.command.assert_any_call(
+        "shardCollection", "db.user-emails", key={"tenant": 1, "email": "hashed"}
+    )
+
+
+def test_is_targeted() -> None:
+    """Test the is_targeted function."""
+    key = {"tenant": 1, "id": "hashed"}
+
+    assert is_targeted({"tenant": "a", "id": "1", "email": "x"}, key)
+    assert is_targeted({"tenant": "a", "id": {"$eq": "1"}}, key)
+    assert not is_targeted({"id": "1"}, key)
+    assert not is_targeted({"tenant": "a", "id": {"$in": ["1", "2"]}}, key)
+    assert not is_targeted({"tenant": "a", "$or": [{"id": "1"}]}, key)
+
+
+def test_helpers_issue_targeted_queries() -> None:
+    """Test that the user and token helpers only issue targeted queries."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    registry, collections = _sharded_registry(client)
+
+    user = create_or_retrieve_user(registry, "sample@mail.com")
+    assert create_or_retrieve_user(registry, "sample@mail.com").id == user.id
+    assert get_user_by_id(registry, user.id) is not None
+
+    user.email = "updated@mail.com"
+    assert update_user(registry, user) is not None
+    assert get_user_by_email(registry, "sample@mail.com") is None
+    updated_user = get_user_by_email(registry, "updated@mail.com")
+    assert updated_user is not None and updated_user.id == user.id
+
+    magic_link = insert_magic_link(registry, user.id)
+    magic_link.is_used = True
+    assert update_magic_link(registry, magic_link) is not None
+    assert get_magic_link_by_token(registry, magic_link.token) is not None
+
+    assert delete_user(registry, user) is not None
+    assert get_user_by_email(registry, "updated@mail.com") is None
+
+    for collection in collections.values():
+        assert collection.untargeted == []
+
+
+def test_tenants_are_isolated() -> None:
+    """Test that apps with different tenants do not see each other's data."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    registry_a, _ = _sharded_registry(client, tenant="app-a")
+    registry_b, _ = _sharded_registry(client, tenant="app-b")
+
+    user_a = create_or_retrieve_user(registry_a, "sample@mail.com")
+    user_b = create_or_retrieve_user(registry_b, "sample@mail.com")
+    magic_link = insert_magic_link(registry_a, user_a.id)
+
+    assert user_a.id != user_b.id
+    assert get_user_by_id(registry_b, user_a.id) is None
+    assert get_magic_link_by_token(registry_b, magic_link.token) is None
+    document = client["streamlit-magic-link"]["users"].find_one({"id": user_a.id})
+    assert document is not None
+    assert document["tenant"] == "app-a"
+
+
+def test_sharded_layout_rejects_duplicate_email() -> None:
+    """Test that the email lookup prevents a second user with the same email."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    registry, _ = _sharded_registry(client)
+
+    create_or_retrieve_user(registry, "sample@mail.com")
+    insert_user(registry, User(email="sample@mail.com"))
+
+    assert client["streamlit-magic-link"]["users"].count_documents({}) == 1
+
+
+def test_sharded_layout_rejects_taken_email_on_update() -> None:
+    """Test that changing the email to one of another user leaves the user and the lookups unchanged."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    registry, _ = _sharded_registry(client)
+    ensure_indexes(registry)
+    user = create_or_retrieve_user(registry, "sample@mail.com")
+    other = create_or_retrieve_user(registry, "other@mail.com")
+
+    user.email = "Other@mail.com"
+    with pytest.raises(DuplicateKeyError):
+        update_user(registry, user)
+
+    stored = get_user_by_id(registry, user.id)
+    assert stored is not None and stored.email == "sample@mail.com"
+    found = get_user_by_email(registry, "sample@mail.com")
+    assert found is not None and found.id == user.id
+    found = get_user_by_email(registry, "other@mail.com")
+    assert found is not None and found.id == other.id
+    assert client["streamlit-magic-link"]["user-emails"].count_documents({}) == 2
+
+
+def test_sharded_layout_normalizes_emails() -> None:
+    """Test that the email lookup is stored by key and queried with targeted queries."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    registry, collections = _sharded_registry(client)
+
+    user = create_or_retrieve_user(registry, "Sample@Mail.com")
+    assert create_or_retrieve_user(registry, "sample@mail.com").id == user.id
+    assert client["streamlit-magic-link"]["user-emails"].find_one(
+        {"email": "sample@mail.com"}
+    ) is not None
+
+    assert delete_user(registry, user) is not None
+    assert client["streamlit-magic-link"]["user-emails"].count_documents({}) == 0
+    for collection in collections.values():
+        assert collection.untargeted == []
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+from typing import Any
+
+import mongomock
+
+from src.db import CollectionRegistry
+from src.models import User
+from src.stats import get_dashboard_stats, refresh_stats, rollup_pipelines
+from src.utils import insert_magic_link, insert_user, update_user_fields
+
+
+class _MergingCollection:
+    """Collection that runs `$merge` stages, which mongomock does not implement."""
+
+    def __init__(self, collection: Any, database: Any):
+        self._collection = collection
+        self._database = database
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._collection, name)
+
+    def aggregate(self, pipeline: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        merge = pipeline[-1]["$merge"]
+        target = self._database[merge["into"]]
+        for document in self._collection.aggregate(pipeline[:-1]):
+            target.replace_one({"_id": document["_id"]}, document, upsert=True)
+        return []
+
+
+class _MergingRegistry(CollectionRegistry):
+    def get(self, key: str) -> Any:
+        collection = super().get(key)
+        return _MergingCollection(collection, collection.database)
+
+
+def _insert_users(client: mongomock.MongoClient) -> list[User]:
+    users = [
+        insert_user(client, User(email="a@mail.com")),
+        insert_user(client, User(email="b@mail.com", is_verified=True)),
+        insert_user(client, User(email="c@mail.com", is_verified=True, is_payed_user=True)),
+    ]
+    old = User(email="old@mail.com", created_at=datetime.now() - timedelta(days=10))
+    client["streamlit-magic-link"]["users"].insert_one(old.model_dump())
+    return users + [old]
+
+
+def test_refresh_and_read_stats() -> None:
+    """Test that the dashboard numbers are read from the rollup."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    collections = _MergingRegistry(client)
+    users = _insert_users(client)
+    insert_magic_link(client, users[0].id)
+    used_link = insert_magic_link(client, users[1].id)
+    client["streamlit-magic-link"]["magic-links"].update_one(
+        {"token": used_link.token}, {"$set": {"is_used": True, "used_at": datetime.now()}}
+    )
+
+    refresh_stats(collections, days=None)
+    stats = get_dashboard_stats(collections)
+
+    today = datetime.now().strftime("%Y-%m-%d")
+    ten_days_ago = (datetime.now() - timedelta(days=10)).strftime("%Y-%m-%d")
+    assert stats.total_users == 4
+    assert stats.verified_users == 2
+    assert stats.paying_users == 1
+    assert stats.signups_per_day == {today: 3, ten_days_ago: 1}
+    assert stats.links_issued_per_day == {today: 2}
+    assert stats.redemptions_per_day == {today: 1}
+    assert stats.updated_at is not None
+
+    assert get_dashboard_stats(collections, days=7).signups_per_day == {today: 3}
+
+
+def test_refresh_stats_removes_stale_groups() -> None:
+    """Test that a flag combination without users is removed from the rollup."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    collections = _MergingRegistry(client)
+    users = _insert_users(client)
+    refresh_stats(collections, days=None)
+
+    update_user_fields(client, users[0].id, is_verified=True)
+    refresh_stats(collections)
+    stats = get_dashboard_stats(collections)
+
+    assert stats.total_users == 4
+    assert stats.verified_users == 3
+    assert sum(stats.signups_per_day.values()) == 4
+
+
+def test_rollup_pipelines_merge_into_stats() -> None:
+    """Test that every pipeline merges into the stats collection of the tenant."""
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    collections = CollectionRegistry(
+        client, collection_names={"stats": "app-stats"}, tenant="app"
+    )
+
+    pipelines = rollup_pipelines(collections, None, datetime.now())
+
+    assert [kind for kind, _, _ in pipelines] == [
+        "users",
+        "signups",
+        "links_issued",
+        "redemptions",
+    ]
+    for _, _, pipeline in pipelines:
+        assert pipeline[0]["$match"]["tenant"] == "app"
+        assert pipeline[1]["$group"]["_id"]["tenant"] == "app"
+        assert pipeline[-1]["$merge"]["into"] == "app-stats"
@@ -0,0 +1,63 @@
+import uuid
+from unittest.mock import patch
+
+import mongomock
+
+from src.tokens import NegativeTokenCache, get_negative_token_cache, is_well_formed_token
+
+
+def test_is_well_formed_token() -> None:
+    """Test that only UUID4 strings are well-formed tokens."""
+    assert is_well_formed_token(str(uuid.uuid4()))
+    assert not is_well_formed_token(None)
+    assert not is_well_formed_token("")
+    assert not is_well_formed_token("fake_token")
+    assert not is_well_formed_token(str(uuid.uuid4()).upper())
+    assert not is_well_formed_token(str(uuid.uuid1()))
+    assert not is_well_formed_token(str(uuid.uuid4()) + "\n")
+    assert not is_well_formed_token("a" * 10_000)
+
+
+def test_negative_token_cache_expires() -> None:
+    """Test that cached tokens expire after the ttl."""
+    cache = NegativeTokenCache(ttl=10)
+
+    with patch("src.tokens.time.monotonic", return_value=100.0):
+        cache.add("token")
+        assert "token" in cache
+        assert "other-token" not in cache
+    with patch("src.tokens.time.monotonic", return_value=110.0):
+        assert "token" not in cache
+    assert len(cache) == 0
+
+
+def test_negative_token_cache_is_bounded() -> None:
+    """Test that the oldest tokens are evicted when the cache is full."""
+    cache = NegativeTokenCache(max_size=3)
+
+    for number in range(5):
+        cache.add(f"token-{number}")
+
+    assert len(cache) == 3
+    assert "token-0" not in cache
+    assert "token-1" not in cache
+    assert "token-4" in cache
+
+
+def test_negative_token_cache_evicts_expired_tokens_on_add() -> None:
+    """Test that adding a token evicts expired tokens."""
+    cache = NegativeTokenCache(ttl=10)
+
+    with patch("src.tokens.time.monotonic", return_value=100.0):
+        cache.add("old-token")
+    with patch("src.tokens.time.monotonic", return_value=120.0):
+        cache.add("new-token")
+
+    assert len(cache) == 1
+
+
+def test_get_negative_token_cache_is_shared() -> None:
+    """Test that the cache is shared per registry."""
+    mongo_client: mongomock.MongoClient = mongomock.MongoClient()
+
+    assert get_negative_token_cache(mongo_client) is get_negative_token_cache(mongo_client)
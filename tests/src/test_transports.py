@@ -0,0 +1,258 @@
+import json
+import smtplib
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from src.breaker import CircuitBreaker, CircuitOpenError
+from src.mail import DEFAULT_DEADLINE, DEFAULT_TIMEOUT, is_transient_error
+from src.models import Email
+from src.transports import (
+    FakeTransport,
+    MailjetTransport,
+    MemoryTransport,
+    SMTPTransport,
+    get_default_transport,
+)
+
+
+def test_mailjet_transport() -> None:
+    """
+    Test that the Mailjet transport sends with send_email.
+    """
+    with patch("src.mail.send_email") as mock_send_email:
+        MailjetTransport().send(to_email="to@mail.com", body="body", subject="subject")
+
+    mock_send_email.assert_called_once_with(
+        to_email="to@mail.com",
+        body="body",
+        subject="subject",
+        timeout=DEFAULT_TIMEOUT,
+        max_retries=2,
+        deadline=DEFAULT_DEADLINE,
+    )
+
+
+def test_get_default_transport() -> None:
+    """
+    Test that the default transport is shared.
+    """
+    assert isinstance(get_default_transport(), MailjetTransport)
+    assert get_default_transport() is get_default_transport()
+
+
+def test_memory_transport(tmp_path) -> None:
+    """
+    Test the memory transport.
+    """
+    path = tmp_path / "outbox.jsonl"
+    transport = MemoryTransport(path=str(path))
+
+    transport.send(to_email="to@mail.com", body="body", subject="subject")
+    transport.send_many([Email(to_email="other@mail.com", body="b", subject="s")])
+
+    assert [email.to_email for email in transport.sent] == ["to@mail.com", "other@mail.com"]
+    lines = path.read_text().splitlines()
+    assert json.loads(lines[0]) == {"to_email": "to@mail.com", "subject": "subject", "body": "body"}
+    assert len(lines) == 2
+
+
+def test_smtp_transport_without_from_email() -> None:
+    """
+    Test that the SMTP transport requires a sender.
+    """
+    with (
+        patch.dict("os.environ", {}, clear=True),
+        pytest.raises(ValueError, match="FROM_EMAIL environment variable not set."),
+    ):
+        SMTPTransport("smtp.example.com")
+
+
+def test_smtp_transport_reuses_connection() -> None:
+    """
+    Test that the SMTP transport reuses a connection across sends.
+    """
+    with patch("src.transports.smtplib.SMTP") as mock_smtp:
+        transport = SMTPTransport(
+            "smtp.example.com", username="user", password="secret", from_email="from@mail.com"
+        )
+        transport.send(to_email="a@mail.com", body="body", subject="subject")
+        transport.send(to_email="b@mail.com", body="body", subject="subject")
+
+    mock_smtp.assert_called_once_with("smtp.example.com", 587, timeout=10.0)
+    connection = mock_smtp.return_value
+    connection.starttls.assert_called_once()
+    connection.login.assert_called_once_with("user", "secret")
+    assert connection.send_message.call_count == 2
+    message = connection.send_message.call_args.args[0]
+    assert message["From"] == "from@mail.com"
+    assert message["To"] == "b@mail.com"
+
+
+def test_smtp_transport_send_idempotent_sets_message_id() -> None:
+    """
+    Test that copies of an email sent with the same idempotency key share the Message-ID.
+    """
+    with patch("src.transports.smtplib.SMTP") as mock_smtp:
+        transport = SMTPTransport("smtp.example.com", from_email="from@mail.com")
+        transport.send_idempotent("a@mail.com", "body", "subject", idempotency_key="abc")
+        transport.send(to_email="a@mail.com", body="body", subject="subject")
+
+    first, second = (call.args[0] for call in mock_smtp.return_value.send_message.call_args_list)
+    assert first["Message-ID"] == "<abc@mail.com>"
+    assert second["Message-ID"] is None
+
+
+def test_fake_transport() -> None:
+    """
+    Test the simulated latency and failures of the fake transport.
+    """
+    transport = FakeTransport(latency=lambda: 0.0, error=requests.Timeout("slow"), error_rate=0.0)
+    transport.send_idempotent("to@mail.com", "body", "subject", idempotency_key="abc")
+    assert transport.idempotency_keys == ["abc"]
+
+    transport.error_rate = 1.0
+    with pytest.raises(requests.Timeout):
+        transport.send(to_email="to@mail.com", body="body", subject="subject")
+    assert len(transport.sent) == 1
+
+
+def test_smtp_transport_send_many_uses_one_session() -> None:
+    """
+    Test that send_many sends all messages over one connection.
+    """
+    emails = [Email(to_email=f"{i}@mail.com", body="b", subject="s") for i in range(5)]
+    with patch("src.transports.smtplib.SMTP") as mock_smtp:
+        SMTPTransport("smtp.example.com", from_email="from@mail.com").send_many(emails)
+
+    assert mock_smtp.call_count == 1
+    assert mock_smtp.return_value.send_message.call_count == 5
+
+
+def test_smtp_transport_rotates_connections() -> None:
+    """
+    Test that a connection is replaced after the maximum number of messages.
+    """
+    emails = [Email(to_email=f"{i}@mail.com", body="b", subject="s") for i in range(5)]
+    with patch("src.transports.smtplib.SMTP") as mock_smtp:
+        transport = SMTPTransport(
+            "smtp.example.com", from_email="from@mail.com", max_messages_per_connection=2
+        )
+        transport.send_many(emails)
+
+    assert mock_smtp.call_count == 3
+    assert mock_smtp.return_value.quit.call_count == 2
+
+
+def test_smtp_transport_reconnects_on_disconnect() -> None:
+    """
+    Test that the SMTP transport reconnects when the server closed the connection.
+    """
+    stale, fresh = MagicMock(), MagicMock()
+    stale.send_message.side_effect = smtplib.SMTPServerDisconnected()
+    with patch("src.transports.smtplib.SMTP", side_effect=[stale, fresh]):
+        SMTPTransport("smtp.example.com", from_email="from@mail.com").send(
+            to_email="a@mail.com", body="body", subject="subject"
+        )
+
+    fresh.send_message.assert_called_once()
+
+
+def test_smtp_transport_closes_failed_reconnection() -> None:
+    """
+    Test that a connection opened to resend a message is closed when the resend fails,
+    and the dropped connection is closed only once.
+    """
+    stale, fresh = MagicMock(), MagicMock()
+    stale.send_message.side_effect = smtplib.SMTPServerDisconnected()
+    fresh.send_message.side_effect = smtplib.SMTPRecipientsRefused({})
+    with (
+        patch("src.transports.smtplib.SMTP", side_effect=[stale, fresh]),
+        pytest.raises(smtplib.SMTPRecipientsRefused),
+    ):
+        SMTPTransport("smtp.example.com", from_email="from@mail.com").send(
+            to_email="a@mail.com", body="body", subject="subject"
+        )
+
+    stale.quit.assert_called_once()
+    fresh.quit.assert_called_once()
+
+
+def test_smtp_transport_closes_connection_on_failed_reconnect() -> None:
+    """
+    Test that the dropped connection is closed only once when reconnecting fails.
+    """
+    stale = MagicMock()
+    stale.send_message.side_effect = smtplib.SMTPServerDisconnected()
+    with (
+        patch("src.transports.smtplib.SMTP", side_effect=[stale, OSError("unreachable")]),
+        pytest.raises(OSError),
+    ):
+        SMTPTransport("smtp.example.com", from_email="from@mail.com").send(
+            to_email="a@mail.com", body="body", subject="subject"
+        )
+
+    stale.quit.assert_called_once()
+
+
+def test_smtp_transport_checks_idle_connections() -> None:
+    """
+    Test that an idle connection is checked before reuse and replaced when broken.
+    """
+    broken, fresh = MagicMock(), MagicMock()
+    broken.noop.side_effect = smtplib.SMTPServerDisconnected()
+    with patch("src.transports.smtplib.SMTP", side_effect=[broken, fresh]):
+        transport = SMTPTransport(
+            "smtp.example.com", from_email="from@mail.com", max_idle_seconds=0
+        )
+        transport.send(to_email="a@mail.com", body="body", subject="subject")
+        transport.send(to_email="b@mail.com", body="body", subject="subject")
+
+    broken.noop.assert_called_once()
+    assert broken.send_message.call_count == 1
+    assert fresh.send_message.call_count == 1
+
+
+def test_smtp_transport_close() -> None:
+    """
+    Test that closing the transport quits the pooled connections.
+    """
+    with patch("src.transports.smtplib.SMTP") as mock_smtp:
+        transport = SMTPTransport("smtp.example.com", from_email="from@mail.com")
+        transport.send(to_email="a@mail.com", body="body", subject="subject")
+        transport.close()
+
+    mock_smtp.return_value.quit.assert_called_once()
+
+
+def test_mailjet_transport_circuit_breaker() -> None:
+    """
+    Test that the Mailjet transport fails fast after repeated provider errors.
+    """
+    transport = MailjetTransport(
+        breaker=CircuitBreaker("mailjet", failure_threshold=2, is_failure=is_transient_error)
+    )
+    with patch("src.mail.send_email", side_effect=requests.Timeout()) as mock_send_email:
+        for _ in range(2):
+            with pytest.raises(requests.Timeout):
+                transport.send(to_email="to@mail.com", body="body", subject="subject")
+        with pytest.raises(CircuitOpenError):
+            transport.send(to_email="to@mail.com", body="body", subject="subject")
+
+    assert mock_send_email.call_count == 2
+    assert transport.breaker.snapshot()["state"] == "open"
+
+
+def test_mailjet_transport_circuit_breaker_ignores_rejected_requests() -> None:
+    """
+    Test that rejected requests do not open the circuit.
+    """
+    transport = MailjetTransport()
+    error = requests.HTTPError(response=MagicMock(status_code=400))
+    with patch("src.mail.send_email", side_effect=error):
+        for _ in range(10):
+            with pytest.raises(requests.HTTPError):
+                transport.send(to_email="to@mail.com", body="body", subject="subject")
+
+    assert transport.breaker.state == "closed"
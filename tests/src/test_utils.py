@@ -1,16 +1,31 @@
+from datetime import datetime, timedelta
+
 import mongomock
+from unittest.mock import patch
+
+from src.db import CollectionRegistry
+from src.events import hash_token
 from src.utils import (
+    ensure_indexes,
+    get_active_magic_link,
+    invalidate_magic_links,
     insert_user,
     get_user_by_id,
     get_user_by_email,
     update_user,
+    update_user_fields,
+    get_user_fields,
+    get_user_version,
+    VersionConflictError,
     delete_user,
     create_or_retrieve_user,
     insert_magic_link,
     get_magic_link_by_token,
     update_magic_link,
+    redeem_magic_link,
 )
 from src.models import User, MagicLink
+import pytest
 
 
 def test_insert_user()-> None:
@@ -74,6 +89,47 @@ def test_get_user_by_email() -> None:
     assert retrieved_user is not None
     assert retrieved_user.email == "sample@mail.com"
 
+def test_get_user_by_email_is_case_insensitive() -> None:
+    """
+    Test that users are found by their normalized email.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    user = insert_user(client, User(email="Sample@Mail.com"))
+
+    retrieved_user = get_user_by_email(client, " sample@MAIL.com ")
+    assert retrieved_user is not None
+    assert retrieved_user.id == user.id
+    assert retrieved_user.email == "Sample@Mail.com"
+    assert create_or_retrieve_user(client, "SAMPLE@mail.com").id == user.id
+    assert client["streamlit-magic-link"]["users"].count_documents({}) == 1
+
+def test_get_user_by_email_without_email_key() -> None:
+    """
+    Test that users stored before email keys are still found by their exact email.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    user = User(email="Sample@Mail.com")
+    client["streamlit-magic-link"]["users"].insert_one(user.model_dump())
+
+    retrieved_user = get_user_by_email(client, "Sample@Mail.com")
+    assert retrieved_user is not None
+    assert retrieved_user.id == user.id
+    assert get_user_by_email(client, "sample@mail.com") is None
+
+def test_update_user_fields_updates_email_key() -> None:
+    """
+    Test that changing the email changes the email key.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    user = insert_user(client, User(email="sample@mail.com"))
+
+    update_user_fields(client, user.id, email="Updated@Mail.com")
+
+    assert get_user_by_email(client, "sample@mail.com") is None
+    retrieved_user = get_user_by_email(client, "updated@mail.com")
+    assert retrieved_user is not None
+    assert retrieved_user.id == user.id
+
 def test_get_user_by_email_no_user_found(caplog) -> None:
     """
     Test the get_user_by_email function.
@@ -113,6 +169,109 @@ def test_update_user_no_user_found(caplog)-> None:
     assert updated_user is None
     assert f"User with id {user.id} not found." in caplog.text
 
+def test_update_user_only_writes_changed_fields() -> None:
+    """
+    Test that update_user does not overwrite fields changed concurrently.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    insert_user(client, User(email="sample@mail.com"))
+    user = get_user_by_email(client, "sample@mail.com")
+    assert user is not None
+
+    client["streamlit-magic-link"]["users"].update_one(
+        {"id": user.id}, {"$set": {"is_payed_user": True}}
+    )
+    user.name = "New Name"
+    updated_user = update_user(client, user)
+
+    assert updated_user is not None
+    assert updated_user.name == "New Name"
+    assert updated_user.is_payed_user
+    assert user.changed_fields() == {}
+
+
+def test_update_user_fields() -> None:
+    """
+    Test the update_user_fields function.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    user = insert_user(client, User(email="sample@mail.com", name="Name"))
+
+    updated_user = update_user_fields(client, user.id, is_verified=True)
+
+    assert updated_user is not None
+    assert updated_user.is_verified
+    assert updated_user.name == "Name"
+    assert updated_user.changed_fields() == {}
+    assert update_user_fields(client, "unknown-id", is_verified=True) is None
+
+
+def test_update_user_version_conflict() -> None:
+    """
+    Test that updating a stale user raises a conflict instead of overwriting.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    user = insert_user(client, User(email="sample@mail.com"))
+    stale_user = get_user_by_id(client, user.id)
+    assert stale_user is not None
+
+    user.name = "First"
+    updated_user = update_user(client, user)
+    assert updated_user is not None
+    assert updated_user.version == 1
+    assert user.version == 1
+
+    stale_user.name = "Second"
+    with pytest.raises(VersionConflictError):
+        update_user(client, stale_user)
+    assert get_user_version(client, user.id) == 1
+    with pytest.raises(VersionConflictError):
+        update_user_fields(client, user.id, expected_version=0, name="Second")
+    assert update_user_fields(client, user.id, expected_version=1, name="Second") is not None
+
+
+def test_get_user_version() -> None:
+    """
+    Test the get_user_version function, also for users stored before versioning.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    client["streamlit-magic-link"]["users"].insert_one({"id": "legacy", "email": "a@b.c"})
+
+    assert get_user_version(client, "legacy") == 0
+    assert get_user_version(client, "unknown-id") is None
+    updated_user = update_user_fields(client, "legacy", expected_version=0, name="Name")
+    assert updated_user is not None
+    assert updated_user.version == 1
+
+
+def test_get_user_fields() -> None:
+    """
+    Test the get_user_fields function, with defaults for fields that are not stored.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    client["streamlit-magic-link"]["users"].insert_one({"id": "legacy", "email": "a@b.c"})
+
+    assert get_user_fields(client, "legacy", "email", "is_payed_user") == {
+        "version": 0,
+        "email": "a@b.c",
+        "is_payed_user": False,
+    }
+    assert get_user_fields(client, "unknown-id", "email") is None
+
+
+def test_update_user_fields_unknown_field() -> None:
+    """
+    Test that update_user_fields rejects unknown fields and the id.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    user = insert_user(client, User(email="sample@mail.com"))
+
+    with pytest.raises(ValueError):
+        update_user_fields(client, user.id, nickname="Nick")
+    with pytest.raises(ValueError):
+        update_user_fields(client, user.id, id="other-id")
+
+
 def test_delete_user()-> None:
     """
     Test the delete_user function.
@@ -154,6 +313,26 @@ def test_create_or_retrieve_user()-> None:
     assert existing_user.id == user.id
 
 
+@pytest.mark.parametrize("sharded", [False, True])
+def test_create_or_retrieve_user_created_concurrently(sharded: bool) -> None:
+    """
+    Test that a user inserted by a concurrent request after the lookup is retrieved.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    registry = CollectionRegistry(client, sharded=sharded)
+    ensure_indexes(registry)
+    first = insert_user(registry, User(email="sample@mail.com"))
+
+    # Both requests looked the user up before either inserted it.
+    with patch("src.utils.get_user_by_email", side_effect=[None, first]), patch("src.utils._find_email_lookup", return_value=None), patch(
+        "src.utils._email_query", return_value=[{"id": None}]
+    ):
+        user = create_or_retrieve_user(registry, "Sample@mail.com")
+
+    assert user.id == first.id
+    assert registry.users.count_documents({}) == 1
+
+
 def test_insert_magic_link()-> None:
     """
     Test the insert_magic_link function.
@@ -189,7 +368,8 @@ def test_get_magic_link_by_token_no_link_found(caplog)-> None:
 
     retrieved_magic_link = get_magic_link_by_token(client, token)
     assert retrieved_magic_link is None
-    assert f"Magic link with token {token} not found." in caplog.text
+    assert f"Magic link {hash_token(token)} not found." in caplog.text
+    assert token not in caplog.text
 
 def test_update_magic_link():
     """
@@ -206,6 +386,46 @@ def test_update_magic_link():
     assert updated_magic_link.is_used
     assert client["streamlit-magic-link"]["magic-links"].find_one({"is_used": True}) is not None
 
+def test_update_magic_link_version_conflict() -> None:
+    """
+    Test that only one of two concurrent redemptions of a magic link succeeds.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    magic_link = insert_magic_link(client, "12345")
+    first = get_magic_link_by_token(client, magic_link.token)
+    second = get_magic_link_by_token(client, magic_link.token)
+    assert first is not None and second is not None
+
+    first.is_used = True
+    updated_magic_link = update_magic_link(client, first)
+    assert updated_magic_link is not None
+    assert updated_magic_link.version == 1
+
+    second.is_used = True
+    with pytest.raises(VersionConflictError):
+        update_magic_link(client, second)
+
+
+def test_redeem_magic_link() -> None:
+    """
+    Test that a magic link is only redeemed once, and not when it is expired.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    magic_link = insert_magic_link(client, "12345")
+    expired = insert_magic_link(client, "12345")
+    client["streamlit-magic-link"]["magic-links"].update_one(
+        {"token": expired.token}, {"$set": {"expiration_time": datetime.now() - timedelta(minutes=1)}}
+    )
+
+    redeemed = redeem_magic_link(client, magic_link.token)
+
+    assert redeemed is not None
+    assert redeemed.is_used
+    assert redeemed.version == 1
+    assert redeem_magic_link(client, magic_link.token) is None
+    assert redeem_magic_link(client, expired.token) is None
+
+
 def test_update_magic_link_no_magic_link_found(caplog):
     """
     Test the update_magic_link function.
@@ -218,4 +438,81 @@ def test_update_magic_link_no_magic_link_found(caplog):
     updated_magic_link = update_magic_link(client, magic_link)
 
     assert updated_magic_link is None
-    assert f"Magic link with token {magic_link.token} not found." in caplog.text
\ No newline at end of file
+    assert f"Magic link {hash_token(magic_link.token)} not found." in caplog.text
+    assert magic_link.token not in caplog.text
+def test_ensure_indexes() -> None:
+    """
+    Test the ensure_indexes function.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    ensure_indexes(client)
+
+    user_indexes = client["streamlit-magic-link"]["users"].index_information()
+    magic_link_indexes = client["streamlit-magic-link"]["magic-links"].index_information()
+    assert user_indexes["id_1"]["unique"]
+    assert "email_1" in user_indexes
+    assert user_indexes["email_key_1"]["unique"]
+    assert user_indexes["email_key_1"]["partialFilterExpression"] == {
+        "email_key": {"$exists": True}
+    }
+    assert magic_link_indexes["token_1"]["unique"]
+    assert magic_link_indexes["user_id_1_is_used_1_created_at_-1"]["key"] == [
+        ("user_id", 1), ("is_used", 1), ("created_at", -1)
+    ]
+
+def test_get_active_magic_link() -> None:
+    """
+    Test the get_active_magic_link function.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    older_magic_link = insert_magic_link(client, "12345")
+    older_magic_link.created_at = datetime.now() - timedelta(seconds=30)
+    update_magic_link(client, older_magic_link)
+    newest_magic_link = insert_magic_link(client, "12345")
+    insert_magic_link(client, "67890")
+
+    active_magic_link = get_active_magic_link(
+        client, "12345", issued_after=datetime.now() - timedelta(minutes=1)
+    )
+    assert active_magic_link is not None
+    assert active_magic_link.token == newest_magic_link.token
+
+def test_get_active_magic_link_outside_window() -> None:
+    """
+    Test that used, expired and old magic links are not returned.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    used_magic_link = insert_magic_link(client, "12345")
+    used_magic_link.is_used = True
+    update_magic_link(client, used_magic_link)
+    expired_magic_link = insert_magic_link(client, "12345")
+    expired_magic_link.expiration_time = datetime.now() - timedelta(minutes=1)
+    update_magic_link(client, expired_magic_link)
+    old_magic_link = insert_magic_link(client, "12345")
+    old_magic_link.created_at = datetime.now() - timedelta(minutes=10)
+    update_magic_link(client, old_magic_link)
+
+    assert get_active_magic_link(
+        client, "12345", issued_after=datetime.now() - timedelta(minutes=1)
+    ) is None
+
+def test_invalidate_magic_links() -> None:
+    """
+    Test the invalidate_magic_links function.
+    """
+    client: mongomock.MongoClient = mongomock.MongoClient()
+    redeemed_magic_link = insert_magic_link(client, "12345")
+    insert_magic_link(client, "12345")
+    insert_magic_link(client, "12345")
+    other_user_magic_link = insert_magic_link(client, "67890")
+
+    invalidated = invalidate_magic_links(client, "12345", except_token=redeemed_magic_link.token)
+
+    assert invalidated == 2
+    redeemed = get_magic_link_by_token(client, redeemed_magic_link.token)
+    other = get_magic_link_by_token(client, other_user_magic_link.token)
+    assert redeemed is not None and not redeemed.is_used
+    assert other is not None and not other.is_used
+    assert client["streamlit-magic-link"]["magic-links"].count_documents(
+        {"user_id": "12345", "is_used": True}
+    ) == 2
@@ -0,0 +1,105 @@
+from unittest.mock import MagicMock, patch
+
+from src.widgets import _login_form, _profile_form, _sign_out_button
+
+
+def test_login_form_sends_magic_link() -> None:
+    """Test that submitting the login form sends a magic link."""
+    magic_link = MagicMock()
+
+    with patch("src.widgets.st") as mock_streamlit:
+        mock_streamlit.text_input.return_value = " sample@mail.com "
+        mock_streamlit.form_submit_button.return_value = True
+        _login_form(magic_link)
+
+    magic_link.authenticate.assert_called_once_with("sample@mail.com")
+    mock_streamlit.rerun.assert_not_called()
+
+
+def test_login_form_without_submit() -> None:
+    """Test that the login form does nothing until it is submitted."""
+    magic_link = MagicMock()
+
+    with patch("src.widgets.st") as mock_streamlit:
+        mock_streamlit.form_submit_button.return_value = False
+        _login_form(magic_link)
+
+    magic_link.authenticate.assert_not_called()
+
+
+def test_sign_out_button() -> None:
+    """Test that the sign out button signs the user out."""
+    magic_link = MagicMock()
+    magic_link.user = {"email": "sample@mail.com"}
+
+    with patch("src.widgets.st") as mock_streamlit:
+        mock_streamlit.button.side_effect = [True, False]
+        _sign_out_button(magic_link, everywhere=True)
+
+    magic_link.sign_out.assert_called_once()
+    magic_link.sign_out_everywhere.assert_not_called()
+
+
+def test_sign_out_button_without_user() -> None:
+    """Test that the sign out button is not shown without a user."""
+    magic_link = MagicMock()
+    magic_link.user = None
+
+    with patch("src.widgets.st") as mock_streamlit:
+        _sign_out_button(magic_link)
+
+    mock_streamlit.button.assert_not_called()
+
+
+def test_profile_form_updates_changed_fields() -> None:
+    """Test that saving the profile only updates the changed fields."""
+    magic_link = MagicMock()
+    magic_link.user = {
+        "email": "sample@mail.com",
+        "name": "Name",
+        "is_payed_user": False,
+        "additional_data": None,
+    }
+
+    with patch("src.widgets.st") as mock_streamlit:
+        mock_streamlit.text_input.side_effect = ["New Name", ""]
+        mock_streamlit.form_submit_button.return_value = True
+        mock_streamlit.button.return_value = False
+        _profile_form(magic_link)
+
+    magic_link.update_user.assert_called_once_with(name="New Name")
+    magic_link.delete_user.assert_not_called()
+    mock_streamlit.checkbox.assert_not_called()
+    assert [call.args[0] for call in mock_streamlit.text_input.call_args_list] == [
+        "Name",
+        "Additional data",
+    ]
+
+
+def test_profile_form_with_authorization_fields() -> None:
+    """Test that an admin form can edit the email and the payed flag."""
+    magic_link = MagicMock()
+    magic_link.user = {"email": "sample@mail.com", "is_payed_user": False}
+
+    with patch("src.widgets.st") as mock_streamlit:
+        mock_streamlit.text_input.return_value = "sample@mail.com"
+        mock_streamlit.checkbox.return_value = True
+        mock_streamlit.form_submit_button.return_value = True
+        mock_streamlit.button.return_value = False
+        _profile_form(magic_link, fields=("email", "is_payed_user"))
+
+    magic_link.update_user.assert_called_once_with(is_payed_user=True)
+
+
+def test_profile_form_delete_user() -> None:
+    """Test that the delete button deletes the user."""
+    magic_link = MagicMock()
+    magic_link.user = {"email": "sample@mail.com"}
+
+    with patch("src.widgets.st") as mock_streamlit:
+        mock_streamlit.form_submit_button.return_value = False
+        mock_streamlit.button.return_value = True
+        _profile_form(magic_link)
+
+    magic_link.update_user.assert_not_called()
+    magic_link.delete_user.assert_called_once()